@@ -27,29 +27,183 @@ Review details:
 
 I'm going to try a class based approach for this one, since it'll take the longest and it'll need to be fairly robust.
 
+Every new concurrent consumer of the queue pays for importing this module (a cold start), so the heavy stuff
+(``boto3``, ``requests``, ``bs4``) only gets imported, and the clients and session only get built, the first time
+they're actually needed. After that they're kept at module level, so warm invocations reuse them.
+``scripts/benchmark_lambda_startup.py`` measures what a cold start costs.
+
 """
 import csv
+import gzip
+import io
+import json
 import os
+import random
 import re
+import threading
 import time
-from dataclasses import asdict, dataclass
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
+from functools import lru_cache
 from itertools import cycle, zip_longest
-from io import StringIO
-
-import requests
-from bs4 import BeautifulSoup
-import boto3
 
-s3 = boto3.client("s3")
 BASE_URL = "https://trustpilot.com"
 BASE_DIR = os.path.dirname(__file__)
 S3_BUCKET = os.environ.get("S3_BUCKET")
+# The queue this lambda reads from, so it can fan big companies out into page ranges for other invocations
+SQS_ADDRESS = os.environ.get("SQS_ADDRESS")
+REVIEWS_PER_PAGE = 20
+# How many pages a single invocation crawls. This is what keeps us under the 15 minute timeout, no matter how many
+# reviews a company has.
+PAGES_PER_MESSAGE = int(os.environ.get("PAGES_PER_MESSAGE", 25))
+# Connections kept alive per host. This should match however many pages a single invocation has in flight.
+POOL_SIZE = int(os.environ.get("POOL_SIZE", 10))
+# How many of a batch's messages get worked on at once. Each one holds a connection while it's fetching, so this
+# shouldn't be more than POOL_SIZE.
+RECORD_WORKERS = int(os.environ.get("RECORD_WORKERS", POOL_SIZE))
+# Where messages go once they've failed MAX_RECEIVES times, instead of being retried forever (see notes.md)
+DLQ_ADDRESS = os.environ.get("DLQ_ADDRESS")
+MAX_RECEIVES = int(os.environ.get("MAX_RECEIVES", 3))
+# How many times we resend the messages in a batch that SQS wouldn't take, before failing the invocation
+ENQUEUE_RETRIES = int(os.environ.get("ENQUEUE_RETRIES", 5))
+# How long before the lambda gets killed we stop crawling, save what we've got, and leave the rest for another
+# invocation. This has to cover fetching the page we're on, uploading, and sending the continuation message.
+CHECKPOINT_MARGIN_MS = int(os.environ.get("CHECKPOINT_MARGIN_MS", 60_000))
+# ... but never more than this fraction of the time the invocation's got, so a short timeout still leaves time to crawl
+CHECKPOINT_MARGIN_FRACTION = float(os.environ.get("CHECKPOINT_MARGIN_FRACTION", 0.25))
+# Gzip everything we upload (as reviews/<company>.csv.gz). Review text compresses to about a quarter of its size, so
+# this cuts storage and makes every object cheaper to read back.
+COMPRESS_OUTPUT = os.environ.get("COMPRESS_OUTPUT", "true").lower() == "true"
+# The CloudWatch namespace the metrics logged at the end of every invocation end up in
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "trustpilot_scraper")
+
+
+@lru_cache(maxsize=None)
+def client(service: str):
+    """ A boto3 client for ``service``, built the first time it's asked for and reused after that """
+    import boto3
+
+    return boto3.client(service)
+
+
+def accept_encoding() -> str:
+    """ urllib3 can only decode brotli if it's installed, so only ask for it if we can read it """
+    try:
+        import brotli  # noqa: F401
+
+        return "gzip, deflate, br"
+    except ImportError:
+        return "gzip, deflate"
+
+
+def build_session(pool_size: int = POOL_SIZE):
+    """
+    Build a keep-alive session with a connection pool, so each page isn't paying for its own tcp + tls handshake.
+    Mirrors ``scrape/sessions.py``.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(
+        {"Accept-Encoding": accept_encoding(), "Connection": "keep-alive"}
+    )
+    return session
+
+
+class InvocationMetrics(object):
+    """
+    Counts and timings for one invocation (fetch, parse and write, like ``scrape/metrics.py`` keeps for a local
+    crawl), logged as one json line when it's done. The line is in CloudWatch's embedded metric format, so the
+    numbers in it show up as metrics in ``METRICS_NAMESPACE`` without any extra calls, and it's still just a
+    structured log line that logs insights can query.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = dict()
+        self.observations = dict()
+
+    def count(self, name: str, amount: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            self.observations.setdefault(name, []).append(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        """ Observe how many ms the ``with`` block took """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - started) * 1000)
+
+    @staticmethod
+    def unit(name: str) -> str:
+        if name.endswith("_ms"):
+            return "Milliseconds"
+        if name.endswith("_bytes"):
+            return "Bytes"
+        return "Count"
+
+    def summary(self) -> dict:
+        """ ``{name: (value, unit)}`` for every counter, plus the count, p50, p99 and max of everything observed """
+        with self.lock:
+            values = {name: (value, self.unit(name)) for name, value in self.counters.items()}
+            for name, observed in self.observations.items():
+                observed = sorted(observed)
+                unit = self.unit(name)
+                values[f"{name}_count"] = (len(observed), "Count")
+                values[f"{name}_p50"] = (observed[int(0.50 * (len(observed) - 1))], unit)
+                values[f"{name}_p99"] = (observed[int(0.99 * (len(observed) - 1))], unit)
+                values[f"{name}_max"] = (observed[-1], unit)
+        return values
+
+    def emit(self, **properties):
+        """ Log everything as one line. ``properties`` go along with it, but aren't metrics. """
+        summary = self.summary()
+        print(
+            json.dumps(
+                {
+                    "_aws": {
+                        "Timestamp": int(time.time() * 1000),
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": METRICS_NAMESPACE,
+                                "Dimensions": [[]],
+                                "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in summary.items()],
+                            }
+                        ],
+                    },
+                    "message": "metrics",
+                    **properties,
+                    **{name: value for name, (value, _) in summary.items()},
+                }
+            )
+        )
+
+
+# one per container, reset at the start of every invocation
+metrics = InvocationMetrics()
 
 
 @dataclass
 class Company(object):
     """ A company with reviews """
 
+    __slots__ = ("url", "name", "categories", "review_count", "rating")
+
     url: str
     name: str
     categories: list
@@ -61,6 +215,8 @@ class Company(object):
 class Review(object):
     """ A review for a company """
 
+    __slots__ = ("company_url", "title", "body", "rating")
+
     company_url: str
     title: str
     body: str
@@ -69,7 +225,23 @@ class Review(object):
 
 @dataclass
 class CompanyReviews(object):
-    """ The flatfile review, which will be used for sentiment analysis """
+    """
+    The flatfile review, which will be used for sentiment analysis.
+
+    There's one of these for every review we save, so (like ``Company`` and ``Review``) it uses ``__slots__`` instead
+    of a per-instance ``__dict__``, which makes each one a good bit smaller.
+    """
+
+    __slots__ = (
+        "company_url",
+        "company_name",
+        "company_review_count",
+        "company_rating",
+        "company_categories",
+        "review_rating",
+        "review_title",
+        "review_body",
+    )
 
     company_url: str
     company_name: str
@@ -95,8 +267,156 @@ class CompanyReviews(object):
         )
 
     def as_dict(self) -> dict:
-        """ Serializes to a json/csv compatible dictionary. I just hate the default name... """
-        return asdict(self)
+        """
+        Serializes to a json/csv compatible dictionary. I just hate the default name...
+
+        Everything in here is a str or an int, so there's no need for ``dataclasses.asdict`` (which recursively deep
+        copies every field of every row).
+        """
+        return dict(zip(self.__slots__, self.as_row()))
+
+    def as_row(self) -> tuple:
+        """ Serializes to a tuple, in the same order as the fields (and ``HEADERS``) """
+        return (
+            self.company_url,
+            self.company_name,
+            self.company_review_count,
+            self.company_rating,
+            self.company_categories,
+            self.review_rating,
+            self.review_title,
+            self.review_body,
+        )
+
+
+HEADERS = [field.name for field in fields(CompanyReviews)]
+
+# S3 won't take multipart parts smaller than 5MB (other than the last one)
+MIN_PART_SIZE = 5 * 2 ** 20
+
+
+class S3MultipartSink(object):
+    """
+    Writes reviews as a csv to S3, using a multipart upload so we never have the whole file in memory. Rows get
+    buffered until there's ``part_size`` bytes of them, then that part is uploaded and the buffer starts over.
+
+    If everything fits in one part, we skip the multipart upload and just ``put_object`` it. Nothing gets uploaded if
+    there weren't any rows. Mirrors ``scrape/sinks.py``.
+    """
+
+    def __init__(
+        self,
+        s3,
+        bucket: str,
+        key: str,
+        part_size: int = MIN_PART_SIZE,
+        compress: bool = False,
+        **put_kwargs,
+    ):
+        self.rows_written = 0
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.compress = compress
+        self.put_kwargs = put_kwargs
+        if compress:
+            self.put_kwargs.setdefault("ContentEncoding", "gzip")
+
+        self.upload_id = None
+        self.parts = []
+        # rows written since the last part was uploaded
+        self.pending = 0
+        self.buffer = io.BytesIO()
+        self.gzip = None
+        self.new_part()
+        # rows get written as text here, then encoded into the buffer. The header goes out with the first rows.
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(HEADERS)
+
+    def new_part(self):
+        """ Start a fresh buffer. Compressed parts are each their own gzip member, which gunzip reads back as one. """
+        self.buffer = io.BytesIO()
+        if self.compress:
+            self.gzip = gzip.GzipFile(fileobj=self.buffer, mode="wb")
+
+    def write(self, rows: list):
+        if not rows:
+            return
+        self.writer.writerows(row.as_row() for row in rows)
+        self.rows_written += len(rows)
+        self.pending += len(rows)
+
+        encoded = self.text.getvalue().encode("utf-8")
+        self.text.seek(0)
+        self.text.truncate()
+        (self.gzip if self.gzip is not None else self.buffer).write(encoded)
+
+        if self.buffer.tell() >= self.part_size:
+            self.upload_part()
+
+    def finish_part(self) -> bytes:
+        """ Close off the current buffer and get its bytes """
+        if self.gzip is not None:
+            self.gzip.close()
+        return self.buffer.getvalue()
+
+    def upload_part(self):
+        """ Upload whatever's in the buffer as the next part """
+        if self.upload_id is None:
+            upload = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.put_kwargs
+            )
+            self.upload_id = upload["UploadId"]
+
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=self.finish_part(),
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.pending = 0
+        self.new_part()
+
+    def close(self):
+        if not self.rows_written:
+            return
+
+        if self.upload_id is None:
+            # small enough to never need a multipart upload
+            self.s3.put_object(
+                Bucket=self.bucket, Key=self.key, Body=self.finish_part(), **self.put_kwargs
+            )
+            return
+
+        if self.pending:
+            self.upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def abort(self):
+        # a half-finished multipart upload sits around (and costs money) until it's aborted
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
 
 
 class CompanyPageCrawler(object):
@@ -121,8 +441,31 @@ class CompanyPageCrawler(object):
         """ Replace line breaks with ``replace_char`` """
         return string.replace("\n", replace_char).replace("\r", replace_char)
 
-    def __init__(self):
-        self.soup = None
+    @staticmethod
+    def normalize_text(string: str):
+        """ Squash every run of whitespace to one space, the same as ``scrape/models.normalize_text`` """
+        return " ".join(string.split())
+
+    def __init__(self, session=None):
+        # each thread handling a message gets its own soup, so they can share one crawler (and its session)
+        self.local = threading.local()
+        self._session = session
+
+    @property
+    def soup(self):
+        """ The page this thread is on """
+        return getattr(self.local, "soup", None)
+
+    @soup.setter
+    def soup(self, soup):
+        self.local.soup = soup
+
+    @property
+    def session(self):
+        """ The session gets built on first use, so creating a crawler doesn't import ``requests`` """
+        if self._session is None:
+            self._session = build_session()
+        return self._session
 
     def get(self, url: str):
         """ 
@@ -130,8 +473,19 @@ class CompanyPageCrawler(object):
         2-  Fetches a url with ``self.soup``, resetting ``retries`` times if an invalid sessionID is found, 
             if the soup isn't pointed at the current page already
         """
-        response = requests.get(BASE_URL + url)
-        self.soup = BeautifulSoup(response.text, features="html.parser")
+        from bs4 import BeautifulSoup
+
+        try:
+            with metrics.timer("fetch_ms"):
+                response = self.session.get(BASE_URL + url)
+        except Exception:
+            metrics.count("fetch_errors")
+            raise
+        metrics.count(f"status_{response.status_code}")
+        metrics.count("fetched_bytes", len(response.content))
+
+        with metrics.timer("parse_ms"):
+            self.soup = BeautifulSoup(response.text, features="html.parser")
         return response
 
     def get_company_reviews(self, company_url: str) -> list:
@@ -147,7 +501,10 @@ class CompanyPageCrawler(object):
     def get_company(self, company_url: str) -> Company:
         """ Populate a company object from ``company_url`` """
         self.get(company_url)
+        return self.parse_company(company_url)
 
+    def parse_company(self, company_url: str) -> Company:
+        """ Populate a company object from the page we're already on """
         # The page header has the company name, and a subheader with the review count/rating
         header = self.soup.find(attrs={"class": "header-section"})
         name = header.find(attrs={"class": "multi-size-header__big"}).text
@@ -189,7 +546,7 @@ class CompanyPageCrawler(object):
             title = review_element.find(
                 attrs={"class": "review-content__title"}
             ).text
-            title = self.replace_breaks(title)
+            title = self.normalize_text(title)
             # Sometimes there's no review body, so we'll pass '' instead
             body = review_element.find(attrs={"class": "review-content__text"})
             if not body:
@@ -198,7 +555,7 @@ class CompanyPageCrawler(object):
                 # newlines in the body break the csv file and aren't necessary for this anyways, so we'll
                 # replace them with spaces.
                 body = body.text
-                body = self.replace_breaks(body)
+                body = self.normalize_text(body)
 
             rating_img = review_element.find(attrs={"class": "star-rating"}).find(
                 "img"
@@ -239,33 +596,249 @@ class CompanyPageCrawler(object):
             return url, True
         return url, False
 
-    def save_reviews_for_company(self, company_url: str) -> list:
-        """ Saves the reviews for a company in save_dir"""
-
+    def save_reviews_for_company(self, company_url: str, key: str) -> int:
+        """
+        Saves the reviews for a company to ``key`` in ``S3_BUCKET``, streaming them up rather than building the whole
+        csv in memory first. Returns how many reviews were saved.
+        """
         reviews = self.get_company_reviews(company_url)
-        headers = list(reviews[0].as_dict().keys())
 
-        f = StringIO()
-        writer = csv.DictWriter(f, headers)
-        writer.writeheader()
-        writer.writerows([review.as_dict() for review in reviews])
+        with output_sink(key) as sink:
+            sink.write(reviews)
 
-        return f
+        return sink.rows_written
 
+    def save_page_range(
+        self, company_url: str, first_page: int, last_page: int, key: str, deadline: float = None
+    ) -> tuple:
+        """
+        Saves the reviews on pages ``first_page`` through ``last_page`` (inclusive) of a company to ``key`` in
+        ``S3_BUCKET``, a page at a time.
 
+        If we get past ``deadline`` (a ``time.monotonic()``), we stop before the next page and save what we've got so
+        far. Returns ``(reviews saved, the page we stopped at)``, where the page is ``None`` if we got through them all.
+        We always get at least ``first_page``, even if we're already past the deadline, so every invocation makes
+        some progress instead of just sending the same range round the queue again.
+        """
+        next_page = None
+        with output_sink(key) as sink:
+            for page in range(first_page, last_page + 1):
+                if page > first_page and deadline is not None and time.monotonic() > deadline:
+                    next_page = page
+                    break
+
+                page_url = f"{company_url}?page={page}"
+                response = self.get(page_url)
+                if page > 1 and not response.url.endswith(page_url):
+                    # We get redirected back to the first page once we're out of pages, and new reviews can shift
+                    # things around between counting pages and getting here.
+                    break
+
+                company = self.parse_company(company_url)
+                reviews = self.get_reviews(company_url)
+                metrics.observe("reviews_per_page", len(reviews))
+                with metrics.timer("write_ms"):
+                    sink.write(
+                        [CompanyReviews.from_company_and_review(company, review) for review in reviews]
+                    )
+
+        return sink.rows_written, next_page
+
+
+def output_sink(key: str) -> S3MultipartSink:
+    """ A sink for ``key`` in ``S3_BUCKET``, gzipped if ``COMPRESS_OUTPUT`` """
+    return S3MultipartSink(client("s3"), S3_BUCKET, key, compress=COMPRESS_OUTPUT, ContentType="text/csv")
+
+
+def object_key(url: str) -> str:
+    """ Where the reviews for ``url`` go in ``S3_BUCKET`` """
+    extension = ".csv.gz" if COMPRESS_OUTPUT else ".csv"
+    return "reviews/" + url.replace("/review/", "").replace("/", "%2F").replace('?','%3F') + extension
+
+
+def page_range_messages(company_url: str, page_count: int, pages_per_message: int = PAGES_PER_MESSAGE) -> list:
+    """ Split a company's pages into chunks of ``pages_per_message`` pages """
+    return [
+        {
+            "url": company_url,
+            "first_page": first_page,
+            "last_page": min(first_page + pages_per_message - 1, page_count),
+        }
+        for first_page in range(1, page_count + 1, pages_per_message)
+    ]
+
+
+def send_batch(messages: list, retries: int = ENQUEUE_RETRIES) -> list:
+    """
+    Send up to 10 messages in one call. Anything that fails gets retried (with jittered exponential backoff) up to
+    ``retries`` times. Returns whatever still failed after that.
+    """
+    pending = messages
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+        try:
+            response = client("sqs").send_message_batch(
+                QueueUrl=SQS_ADDRESS,
+                Entries=[
+                    {"Id": str(n), "MessageBody": json.dumps(message)}
+                    for n, message in enumerate(pending)
+                ],
+            )
+        except Exception as e:
+            print(f"Batch failed ({e!r}), retrying")
+            continue
+
+        failed = response.get("Failed", [])
+        if not failed:
+            return []
+        # Ids are our index into ``pending``, so we can pick out just the ones to resend
+        pending = [pending[int(failure["Id"])] for failure in failed]
+
+    return pending
+
+
+def enqueue(messages: list):
+    """
+    Send messages back to our own queue, 10 at a time (the most SQS takes in one batch). Only resends the ones that
+    failed, since redelivering the message that sent them would send every one of them again (and they'd all get
+    crawled twice), so this only raises if some still won't go after ``ENQUEUE_RETRIES`` tries.
+    """
+    failed = []
+    for i in range(0, len(messages), 10):
+        failed += send_batch(messages[i : i + 10])
+    if failed:
+        raise RuntimeError(f"Couldn't enqueue {len(failed)} of {len(messages)} messages: {failed}")
+
+
+def save_page_range(url: str, first_page: int, last_page: int, key: str, deadline: float = None):
+    """
+    ``CompanyPageCrawler.save_page_range``, checkpointing if we run out of time: the pages we did get are moved to
+    their own object (named for just those pages, so nothing thinks the rest are done), and the pages we didn't get
+    are sent back to the queue as a new range, for another invocation to pick up where we stopped.
+    """
+    rows_written, next_page = crawler.save_page_range(url, first_page, last_page, key, deadline)
+    if next_page is None:
+        return
+    if next_page <= first_page:
+        # we didn't get anywhere, so fail the message rather than re-queueing the same range forever
+        raise RuntimeError(f"{url}: out of time before page {first_page}")
+
+    if rows_written:
+        partial_key = object_key(f"{url}?pages={first_page}-{next_page - 1}")
+        s3 = client("s3")
+        s3.copy_object(Bucket=S3_BUCKET, Key=partial_key, CopySource={"Bucket": S3_BUCKET, "Key": key})
+        s3.delete_object(Bucket=S3_BUCKET, Key=key)
+
+    print(f"{url}: out of time at page {next_page}, leaving pages {next_page}-{last_page} for later")
+    enqueue([{"url": url, "first_page": next_page, "last_page": last_page}])
+
+
+def handle_message(body: str, deadline: float = None):
+    """
+    Process one message off the queue. There's three kinds:
+
+        /review/<company>?page=<n>                                          just that page
+        {"url": "/review/<company>", "first_page": 1, "last_page": 25}      that range of pages
+        /review/<company>                                                   the whole company
+
+    A whole company gets crawled right here if it's small enough, otherwise it gets split into page ranges that are
+    sent back to the queue, so other invocations can crawl them in parallel.
+
+    Ranges (including a small company's, which is one range) stop at ``deadline``, see ``save_page_range``.
+    """
+    if body.startswith("{"):
+        message = json.loads(body)
+        url, first_page, last_page = message["url"], message["first_page"], message["last_page"]
+        key = object_key(f"{url}?pages={first_page}-{last_page}")
+        save_page_range(url, first_page, last_page, key, deadline)
+        return
+
+    if "?page=" in body:
+        crawler.save_reviews_for_company(body, object_key(body))
+        return
+
+    company = crawler.get_company(body)
+    page_count = (company.review_count // REVIEWS_PER_PAGE) + 1
+    if page_count <= PAGES_PER_MESSAGE:
+        save_page_range(body, 1, page_count, object_key(body), deadline)
+    else:
+        enqueue(page_range_messages(body, page_count))
+
+
+# This lives at module level so warm invocations reuse it, and with it the session's open connections
 crawler = CompanyPageCrawler()
 
 
-
-def lambda_handler(event, context):
-    """ process an aws event """
+def dead_letter(record: dict, error: Exception):
+    """ Send a message that keeps failing to ``DLQ_ADDRESS``, with what went wrong, so it stops being retried """
+    client("sqs").send_message(
+        QueueUrl=DLQ_ADDRESS,
+        MessageBody=record["body"],
+        MessageAttributes={
+            "error": {"DataType": "String", "StringValue": repr(error)[:1000]},
+            "receive_count": {
+                "DataType": "Number",
+                "StringValue": record["attributes"]["ApproximateReceiveCount"],
+            },
+        },
+    )
+
+
+def process_record(record: dict, deadline: float = None) -> bool:
+    """
+    Handle one message, returning ``False`` if it failed and should be retried. Once a message has been received
+    ``MAX_RECEIVES`` times, it goes to the dead-letter queue instead (and counts as handled, so it's deleted here).
+    """
     try:
-        for record in event['Records']:
-            url = record['body']
-            review_body = crawler.save_reviews_for_company(url)
-            file_name = "reviews/" + url.replace("/review/", "").replace("/", "%2F").replace('?','%3F') + ".csv"
-            s3.put_object(Bucket=S3_BUCKET, Key=file_name, Body=review_body.getvalue())
-        return {"status": 200, "response": "nailed it"}
+        handle_message(record["body"], deadline)
+        return True
     except Exception as e:
-        return {"status": 500, "response": repr(e)}
+        print(f"{record['body']} failed: {e!r}\n{traceback.format_exc()}")
+        metrics.count("failed_messages")
+        receive_count = int(record.get("attributes", {}).get("ApproximateReceiveCount", 1))
+        if DLQ_ADDRESS and receive_count >= MAX_RECEIVES:
+            try:
+                dead_letter(record, e)
+                metrics.count("dead_lettered_messages")
+                return True
+            except Exception as dlq_error:
+                print(f"couldn't dead-letter {record['body']}: {dlq_error!r}")
+        return False
+
+
+def lambda_handler(event, context):
+    """
+    process an aws event
+
+    The batch's messages get handled at the same time, and only the ones that failed are reported back (in
+    ``batchItemFailures``), so SQS only retries those instead of the whole batch. This needs ``ReportBatchItemFailures``
+    turned on for the queue's trigger.
+
+    Crawling stops ``CHECKPOINT_MARGIN_MS`` before the lambda would be killed, and whatever's left gets queued up
+    again, so long crawls finish across several invocations instead of losing everything to the timeout.
+    """
+    metrics.reset()
+    started = time.perf_counter()
+    deadline = None
+    if context is not None:
+        remaining_ms = context.get_remaining_time_in_millis()
+        margin_ms = min(CHECKPOINT_MARGIN_MS, remaining_ms * CHECKPOINT_MARGIN_FRACTION)
+        deadline = time.monotonic() + (remaining_ms - margin_ms) / 1000
+
+    records = event["Records"]
+    with ThreadPoolExecutor(max_workers=max(1, min(RECORD_WORKERS, len(records)))) as pool:
+        handled = list(pool.map(lambda record: process_record(record, deadline), records))
+
+    metrics.count("messages", len(records))
+    metrics.count("invocation_ms", (time.perf_counter() - started) * 1000)
+    metrics.emit(request_id=getattr(context, "aws_request_id", None))
+
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": record["messageId"]}
+            for record, ok in zip(records, handled)
+            if not ok
+        ]
+    }
 
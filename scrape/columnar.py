@@ -0,0 +1,140 @@
+"""
+Columnar (parquet) output for reviews.
+
+Every ``CompanyReviews`` row repeats all five company fields, so in a csv the company name and url get written out
+again for every single review. Parquet stores each column on its own, and we dictionary-encode the company columns,
+so each company's details are stored once per row group instead of once per review. Ratings get stored as actual
+small integers instead of text, and everything gets compressed on top of that.
+
+Since it's columnar, reading back just the columns you need (``review_body`` and ``review_rating`` for training) only
+reads those columns off disk:
+
+    read_reviews("reviews.parquet", columns=["review_body", "review_rating"])
+
+This needs ``pyarrow``, which isn't in requirements.txt, since nothing else needs it.
+"""
+
+from sinks import HEADERS, ReviewSink
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Columns that are the same for every review of a company, so dictionary encoding shrinks them to almost nothing
+COMPANY_COLUMNS = ["company_url", "company_name", "company_categories"]
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet output needs pyarrow (pip install pyarrow).")
+
+
+def review_schema():
+    """ The parquet schema for ``CompanyReviews`` """
+    require_pyarrow()
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema(
+        [
+            ("company_url", dictionary),
+            ("company_name", dictionary),
+            ("company_review_count", pa.int32()),
+            ("company_rating", pa.int8()),
+            ("company_categories", dictionary),
+            ("review_rating", pa.int8()),
+            ("review_title", pa.string()),
+            ("review_body", pa.string()),
+        ]
+    )
+
+
+def to_int(value):
+    """ Ratings and counts come out of csvs as strings (and can be blank) """
+    if value is None or value == "":
+        return None
+    return int(value)
+
+
+class ParquetSink(ReviewSink):
+    """
+    Writes reviews to a parquet file. Rows are held until there's ``row_group_size`` of them, then written out as a
+    row group, so memory is bounded by the row group size, not by how many reviews there are.
+    """
+
+    def __init__(self, path: str, row_group_size: int = 100_000, compression: str = "zstd"):
+        require_pyarrow()
+        super().__init__()
+        self.path = path
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.schema = review_schema()
+        self.writer = None
+        self.columns = {name: [] for name in HEADERS}
+        self.pending = 0
+
+    def write(self, rows: list):
+        if not rows:
+            return
+        for row in rows:
+            for column, value in zip(self.columns.values(), row.as_row()):
+                column.append(value)
+        self.pending += len(rows)
+        self.rows_written += len(rows)
+        if self.pending >= self.row_group_size:
+            self.flush()
+
+    def write_dicts(self, rows):
+        """ Write rows that came out of a csv ``DictReader`` """
+        for row in rows:
+            # the whole row first, so a bad value (or a missing column) can't leave the columns different lengths
+            values = [
+                to_int(row[name]) if name in ("company_review_count", "company_rating", "review_rating") else row[name]
+                for name in self.columns
+            ]
+            for column, value in zip(self.columns.values(), values):
+                column.append(value)
+            self.pending += 1
+            self.rows_written += 1
+            if self.pending >= self.row_group_size:
+                self.flush()
+
+    def flush(self):
+        """ Write out whatever rows we're holding as a row group """
+        if not self.pending:
+            return
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(
+                self.path,
+                self.schema,
+                compression=self.compression,
+                use_dictionary=COMPANY_COLUMNS,
+            )
+        table = pa.Table.from_pydict(self.columns, schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self.columns = {name: [] for name in HEADERS}
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def read_reviews(path: str, columns: list = None, row_groups: list = None, filters=None):
+    """
+    Read reviews back as a ``pyarrow.Table``. ``path`` can be a file or a folder of them. Only ``columns`` get read
+    (all of them by default), and for a single file, only ``row_groups`` if that's given. ``filters`` are passed on to
+    ``pyarrow.parquet.read_table``, e.g. ``[("review_rating", "<=", 2)]``.
+    """
+    require_pyarrow()
+    if row_groups is not None:
+        return pq.ParquetFile(path).read_row_groups(row_groups, columns=columns)
+    return pq.read_table(path, columns=columns, filters=filters)
+
+
+def iter_reviews(path: str, columns: list = None, batch_size: int = 65_536):
+    """ Read reviews a batch (``pyarrow.RecordBatch``) at a time, so a huge file never has to fit in memory """
+    require_pyarrow()
+    yield from pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns)
@@ -0,0 +1,232 @@
+"""
+Keeps track of where every company (and every page of every company) is at, in a little sqlite database.
+
+Before this, working out what was left to crawl meant globbing every csv we'd saved, un-escaping the file names, and
+diffing that against ``companies.txt`` (then diffing again against ``inactive_companies.txt``). Now the crawler marks
+companies and pages as it goes, the scripts mark what they know about, and what's left is just a query:
+
+    state = CrawlState()
+    state.remaining_companies()
+
+Company (and page) statuses go:
+
+    pending     we know about it, but haven't crawled it yet
+    queued      its pages were sent off to SQS for the lambda to crawl
+    crawling    we've started, but haven't finished
+    done        all its reviews are saved
+    inactive    the page is live, but there's no reviews on it (see ``get_company``)
+    failed      something went wrong, see ``last_error``
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), "crawl_state.sqlite3")
+
+# Statuses that still need work
+REMAINING = ("pending", "queued", "crawling", "failed")
+
+# Same as settings.REVIEWS_PER_PAGE (this doesn't import settings, so the scripts can use it without selenium)
+REVIEWS_PER_PAGE = 20
+
+# A company's done once it's got this many pages done: all of them, going by its review count if we know it
+PAGES_NEEDED = f"COALESCE(review_count / {REVIEWS_PER_PAGE} + 1, page_count)"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS companies (
+    url TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    review_count INTEGER,
+    page_count INTEGER,
+    pages_done INTEGER NOT NULL DEFAULT 0,
+    duplicates INTEGER NOT NULL DEFAULT 0,
+    last_crawled REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS companies_status ON companies (status);
+
+CREATE TABLE IF NOT EXISTS pages (
+    company_url TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    review_count INTEGER,
+    last_crawled REAL,
+    last_error TEXT,
+    PRIMARY KEY (company_url, page)
+);
+CREATE INDEX IF NOT EXISTS pages_status ON pages (status);
+"""
+
+
+class CrawlState(object):
+    """ The crawl state database. Safe to share between threads. """
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        # WAL lets the scripts read while the crawler's writing
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        """ Add any columns that came along after the database was made """
+        columns = {row["name"] for row in self.connection.execute("PRAGMA table_info(companies)")}
+        if "duplicates" not in columns:
+            with self.connection:
+                self.connection.execute(
+                    "ALTER TABLE companies ADD COLUMN duplicates INTEGER NOT NULL DEFAULT 0"
+                )
+
+    def execute(self, sql: str, params=()):
+        """ Run one statement in its own transaction """
+        with self.lock, self.connection:
+            return self.connection.execute(sql, params)
+
+    def executemany(self, sql: str, params):
+        """ Run one statement for every set of ``params``, all in one transaction """
+        with self.lock, self.connection:
+            return self.connection.executemany(sql, params)
+
+    def close(self):
+        self.connection.close()
+
+    def add_companies(self, urls: list):
+        """ Start tracking ``urls``, leaving any we already know about alone """
+        self.executemany(
+            "INSERT OR IGNORE INTO companies (url) VALUES (?)",
+            ((url,) for url in urls if url),
+        )
+
+    def company(self, url: str) -> sqlite3.Row:
+        """ Everything we know about a company, or ``None`` """
+        return self.execute("SELECT * FROM companies WHERE url = ?", (url,)).fetchone()
+
+    def set_company(self, url: str, status: str, error: str = None, **columns):
+        """ Update a company's status (adding it if it's new), plus any other ``columns`` """
+        columns.update(status=status, last_error=error, last_crawled=time.time())
+        names = ", ".join(columns)
+        updates = ", ".join(f"{name} = excluded.{name}" for name in columns)
+        self.execute(
+            f"INSERT INTO companies (url, {names}) VALUES (?{', ?' * len(columns)}) "
+            f"ON CONFLICT (url) DO UPDATE SET {updates}",
+            (url, *columns.values()),
+        )
+
+    def start_company(self, url: str, review_count: int, page_count: int):
+        """ We're about to crawl ``page_count`` pages of ``url`` """
+        self.set_company(url, "crawling", review_count=review_count, page_count=page_count)
+
+    def finish_company(self, url: str, status: str = "done", error: str = None):
+        """ We're done with ``url``, one way or another """
+        self.set_company(url, status, error)
+
+    def set_company_duplicates(self, url: str, duplicates: int):
+        """ How many duplicate reviews we've dropped for a company """
+        self.execute("UPDATE companies SET duplicates = ? WHERE url = ?", (duplicates, url))
+
+    def mark_inactive(self, urls: list):
+        """ These companies don't have any reviews to get """
+        for url in urls:
+            if url:
+                self.set_company(url, "inactive")
+
+    def mark_page(self, company_url: str, page: int, status: str, review_count: int = None, error: str = None):
+        """ Record how a page went, and keep the company's ``pages_done`` up to date """
+        self.mark_pages(company_url, [page], status, review_count, error)
+
+    def mark_pages(self, company_url: str, pages, status: str, review_count: int = None, error: str = None):
+        """
+        Record the same status for a bunch of pages at once. Once every one of a company's pages is done (however
+        many calls, jobs or lambdas that took), the company is done too, see ``finish_completed_companies``.
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            # keep pages_done up to date by how many pages this changes to (or from) done, rather than counting all
+            # the company's pages again, which adds up to a lot for a company with thousands of them
+            change = 0
+            for page in pages:
+                old = self.connection.execute(
+                    "SELECT status FROM pages WHERE company_url = ? AND page = ?", (company_url, page)
+                ).fetchone()
+                was_done = old is not None and old["status"] == "done"
+                change += (status == "done") - was_done
+                self.connection.execute(
+                    "INSERT INTO pages (company_url, page, status, review_count, last_crawled, last_error) "
+                    "VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (company_url, page) DO UPDATE SET status = excluded.status, "
+                    "review_count = excluded.review_count, last_crawled = excluded.last_crawled, "
+                    "last_error = excluded.last_error",
+                    (company_url, page, status, review_count, now, error),
+                )
+            if change:
+                self.connection.execute(
+                    "UPDATE companies SET pages_done = pages_done + ? WHERE url = ?", (change, company_url)
+                )
+            if status == "done":
+                self._finish_completed(company_url, now)
+
+    def _finish_completed(self, company_url: str = None, now: float = None) -> int:
+        """ Mark ``company_url`` (or every company) done if all its pages are. Call with the lock held. """
+        params = [now or time.time(), *REMAINING]
+        condition = ""
+        if company_url is not None:
+            condition = " AND url = ?"
+            params.append(company_url)
+        return self.connection.execute(
+            f"UPDATE companies SET status = 'done', last_error = NULL, last_crawled = ? "
+            f"WHERE status IN ({', '.join('?' * len(REMAINING))}) AND pages_done >= {PAGES_NEEDED}{condition}",
+            params,
+        ).rowcount
+
+    def finish_completed_companies(self) -> int:
+        """
+        Mark every company that's got all its pages done as done, returning how many there were. Companies the lambda
+        crawled a page range at a time (or that were split into work queue jobs) only ever get their pages marked, so
+        this is what finishes them. We need to know a company's review (or page) count to know it's got them all.
+        """
+        with self.lock, self.connection:
+            return self._finish_completed()
+
+    def remaining_companies(self) -> list:
+        """ Every company that still needs crawling """
+        rows = self.execute(
+            f"SELECT url FROM companies WHERE status IN ({', '.join('?' * len(REMAINING))}) ORDER BY url",
+            REMAINING,
+        )
+        return [row["url"] for row in rows]
+
+    def companies_with_status(self, status: str) -> list:
+        """ Every company with ``status`` """
+        rows = self.execute("SELECT url FROM companies WHERE status = ? ORDER BY url", (status,))
+        return [row["url"] for row in rows]
+
+    def review_counts(self) -> dict:
+        """ ``{url: review count}`` for every company we know the review count of """
+        rows = self.execute("SELECT url, review_count FROM companies WHERE review_count IS NOT NULL")
+        return {row["url"]: row["review_count"] for row in rows}
+
+    def set_review_counts(self, review_counts: dict):
+        """ Record review counts (``{url: review count}``) we've found out without crawling, leaving statuses alone """
+        self.executemany(
+            "UPDATE companies SET review_count = ? WHERE url = ?",
+            ((count, url) for url, count in review_counts.items()),
+        )
+
+    def remaining_pages(self) -> list:
+        """ Every ``(company_url, page)`` that still needs crawling """
+        rows = self.execute(
+            f"SELECT company_url, page FROM pages WHERE status IN ({', '.join('?' * len(REMAINING))}) "
+            "ORDER BY company_url, page",
+            REMAINING,
+        )
+        return [(row["company_url"], row["page"]) for row in rows]
+
+    def counts(self) -> dict:
+        """ How many companies are in each status """
+        rows = self.execute("SELECT status, COUNT(*) AS n FROM companies GROUP BY status")
+        return {row["status"]: row["n"] for row in rows}
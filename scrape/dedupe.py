@@ -0,0 +1,231 @@
+"""
+Drops duplicate reviews before they get written.
+
+Pages shift while we crawl (a new review pushes everything down one, so the last review on page 3 shows up again as
+the first on page 4), so the same review can come in twice. Each review gets a fingerprint, a 64 bit hash of
+``(company_url, title, body, rating)``, and anything whose fingerprint we've already seen gets dropped.
+
+Fingerprints are kept in a ``FingerprintIndex``: a sorted array of 8 byte hashes (so ~8 bytes a review, instead of the
+~100 a python set would take), plus a small set of recent ones that gets merged into the array every so often. It's
+saved to disk, so it carries over between runs.
+
+How a company's reviews get checked depends on how they're being written:
+
+    full crawl      the output gets written from scratch, so we only drop what's repeated within this crawl. Checking
+                    the saved fingerprints would drop every review we got last time we crawled the company.
+    incremental     new reviews get added to what we already have, so anything in the saved fingerprints is dropped
+
+Either way, everything that gets written is added to the saved fingerprints once the company is done.
+
+A company that's been split into page ranges (see schedule.py) gets crawled by more than one job, so the reviews that
+shift across the edge of a range would only ever be seen once by each job. The fingerprints from the first and last
+page of every range get kept for the company, and the other ranges check against those. That only works between jobs
+that run in the same process, so ``join_paged_files.py`` drops what's left of the overlap when the ranges are joined.
+
+Several workers on one host share the saved index, so saving merges with whatever's on disk (under a file lock)
+rather than overwriting it.
+"""
+
+import hashlib
+import heapq
+import os
+import threading
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+    import msvcrt
+
+from models import normalize_text
+
+
+def fingerprint(company_url: str, title: str, body: str, rating) -> int:
+    """ A 64 bit fingerprint for a review """
+    text = "\x1f".join((company_url, normalize_text(title), normalize_text(body), str(rating)))
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def merge_unique(*sorted_values):
+    """ Merge sorted iterables, leaving out repeats """
+    last = None
+    for value in heapq.merge(*sorted_values):
+        if value != last:
+            yield value
+            last = value
+
+
+@contextmanager
+def file_lock(path: str):
+    """ Hold an exclusive lock on the file at ``path`` (making it if it's not there) while the ``with`` block runs """
+    with open(path, "a+b") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            # locks the first byte. LK_LOCK gives up (with an OSError) after 10 tries a second apart, so keep at it
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FingerprintIndex(object):
+    """ A compact, persistent set of fingerprints (see above). Safe to share between threads. """
+
+    def __init__(self, path: str = None, merge_every: int = 100_000):
+        self.path = path
+        self.merge_every = merge_every
+        self.lock = threading.Lock()
+        self.sorted = array("Q")
+        self.recent = set()
+
+        if path and os.path.exists(path):
+            self.sorted = self.read(path)
+
+    def __len__(self):
+        return len(self.sorted) + len(self.recent)
+
+    def __contains__(self, value: int) -> bool:
+        with self.lock:
+            return self.contains(value)
+
+    def contains(self, value: int) -> bool:
+        if value in self.recent:
+            return True
+        i = bisect_left(self.sorted, value)
+        return i < len(self.sorted) and self.sorted[i] == value
+
+    def add(self, value: int) -> bool:
+        """ Add a fingerprint, returning ``False`` if it was already there """
+        with self.lock:
+            if self.contains(value):
+                return False
+            self.recent.add(value)
+            if len(self.recent) >= self.merge_every:
+                self.merge()
+            return True
+
+    def update(self, values):
+        """ Add a bunch of fingerprints at once """
+        with self.lock:
+            self.recent.update(value for value in values if not self.contains(value))
+            if len(self.recent) >= self.merge_every:
+                self.merge()
+
+    def merge(self):
+        """ Fold the recent fingerprints into the sorted array """
+        if self.recent:
+            self.sorted = array("Q", heapq.merge(self.sorted, sorted(self.recent)))
+            self.recent = set()
+
+    @staticmethod
+    def read(path: str) -> array:
+        values = array("Q")
+        with open(path, "rb") as f:
+            values.frombytes(f.read())
+        return values
+
+    def save(self, path: str = None):
+        """
+        Write the index to disk, along with anything other processes have saved there since we loaded it (which we
+        pick up too). The lock file stops two of them saving at once, and one's fingerprints getting lost.
+        """
+        path = path or self.path
+        with self.lock, file_lock(path + ".lock"):
+            self.merge()
+            if os.path.exists(path):
+                self.sorted = array("Q", merge_unique(self.sorted, self.read(path)))
+            temp_path = path + ".tmp"
+            with open(temp_path, "wb") as f:
+                self.sorted.tofile(f)
+            os.replace(temp_path, path)
+
+
+class CompanyDeduper(object):
+    """
+    Checks the reviews for one company as they come in (see ``Deduplicator.company``). For a page range, ``edges`` is
+    the company's fingerprints from the first and last pages of the ranges crawled so far.
+    """
+
+    def __init__(
+        self,
+        index: FingerprintIndex,
+        company_url: str,
+        incremental: bool,
+        first_page: int = None,
+        last_page: int = None,
+        edges: set = None,
+    ):
+        self.index = index
+        self.company_url = company_url
+        self.incremental = incremental
+        self.first_page = first_page
+        self.last_page = last_page
+        self.edges = edges if edges is not None else set()
+        self.seen = set()
+        self.duplicates = 0
+
+    def filter(self, reviews: list, page: int = None) -> list:
+        """ Drop any ``Review`` we've already seen. ``page`` is which page they're from, for page ranges. """
+        at_edge = page is not None and self.last_page is not None and page in (self.first_page, self.last_page)
+        kept = list()
+        for review in reviews:
+            value = fingerprint(self.company_url, review.title, review.body, review.rating)
+            if value in self.seen or value in self.edges or (self.incremental and value in self.index):
+                self.duplicates += 1
+                continue
+            self.seen.add(value)
+            if at_edge:
+                self.edges.add(value)
+            kept.append(review)
+        return kept
+
+    def commit(self):
+        """ Everything we kept got written, so remember it for next time """
+        self.index.update(self.seen)
+        self.seen = set()
+
+
+class Deduplicator(object):
+    """ Hands out a ``CompanyDeduper`` per company, and keeps count of duplicates for each """
+
+    def __init__(self, index: FingerprintIndex):
+        self.index = index
+        self.duplicates = dict()
+        # {company url: fingerprints from the edges of its page ranges}, only for companies crawled in page ranges
+        self.edges = dict()
+
+    def company(
+        self, company_url: str, incremental: bool = False, first_page: int = None, last_page: int = None
+    ) -> CompanyDeduper:
+        """ A deduper for a company, or with ``last_page``, for pages ``first_page`` to ``last_page`` of it """
+        if last_page is None:
+            return CompanyDeduper(self.index, company_url, incremental)
+        edges = self.edges.setdefault(company_url, set())
+        return CompanyDeduper(self.index, company_url, incremental, first_page, last_page, edges)
+
+    def finish(self, deduper: CompanyDeduper):
+        """ The company's done, so save its fingerprints and count """
+        deduper.commit()
+        self.duplicates[deduper.company_url] = (
+            self.duplicates.get(deduper.company_url, 0) + deduper.duplicates
+        )
+
+    def save(self):
+        if self.index.path:
+            self.index.save()
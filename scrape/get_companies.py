@@ -1,5 +1,9 @@
+import argparse
 import re  # yeah things are about to get weird
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
 
 from bs4 import BeautifulSoup
 from retry import retry
@@ -12,9 +16,16 @@ from selenium.common.exceptions import (
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.keys import Keys
 
-from get_subcategories import get_subcategories
+import settings
+from get_subcategories import get_subcategories, get_subcategories_http
+from rate_control import ControlledSession, RateController
+from sessions import build_session
 from settings import BASE_URL, CHROME_OPTIONS, BASE_DIR
 
+# See the "unspeakable" comment in ``get_companies``. Compiled once, since we run it over every page.
+NAME_DEMANGLER_PATTERN = re.compile(r"\bclass=\"(.+?)___.+?\"")
+NAME_DEMANGLER_REPLACE = r'class="\1"'
+
 
 @retry(ElementClickInterceptedException, tries=10, delay=0.5)
 def keep_clicking(browser, element):
@@ -25,6 +36,97 @@ def keep_clicking(browser, element):
     element.click()
 
 
+def demangle(html: str) -> str:
+    """ Strip the mangling off the class names in ``html`` (see ``get_companies``) """
+    return NAME_DEMANGLER_PATTERN.sub(NAME_DEMANGLER_REPLACE, html)
+
+
+def parse_company_links(soup: BeautifulSoup) -> list:
+    """ The hrefs for every company on a (demangled) subcategory page """
+    # get the container w/ all the links we want
+    container = soup.find(attrs={"class": "businessUnitCardsContainer"})
+    if container is None:
+        # if we didn't get the element we wanted, there's just no links on this page
+        return []
+    # get all the a tags in here, and then get their hrefs
+    company_elements = container.find_all("a", attrs={"class": "wrapper"})
+    return [element.attrs.get("href") for element in company_elements]
+
+
+def parse_next_page(soup: BeautifulSoup) -> str:
+    """ The href of the "Next page" link, or ``None`` if this is the last page """
+    for link in soup.find_all("a"):
+        if link.get_text(strip=True) == "Next page" and link.attrs.get("href"):
+            return link.attrs["href"]
+    return None
+
+
+def get_subcategory_companies(session, subcategory_link: str, max_pages: int = 1000) -> set:
+    """
+    Every company link in a subcategory, following "Next page" links with plain http requests. Raises
+    ``requests.HTTPError`` if a page doesn't come back (a 404, or still throttled after the session's retries).
+    """
+    company_links = set()
+    url = urljoin(BASE_URL, subcategory_link)
+
+    for _ in range(max_pages):
+        response = session.get(url)
+        response.raise_for_status()
+        soup = BeautifulSoup(demangle(response.text), features="lxml")
+        company_links.update(parse_company_links(soup))
+
+        next_page = parse_next_page(soup)
+        if not next_page:
+            break
+        url = urljoin(url, next_page)
+
+    return company_links
+
+
+def get_companies_http(subcategory_links=None, workers: int = 16) -> tuple:
+    """
+    The same as ``get_companies``, but without a browser.
+
+    The listing pages come back with everything we need in the html, so we can fetch them directly, and work through
+    ``workers`` subcategories at once (the pages within a subcategory still go one after another, since each one
+    tells us where the next one is).
+
+    A subcategory that fails gets logged and skipped, rather than losing every other one with it. Returns
+    ``(company links, failed subcategory links)``, so the failed ones can be tried again with ``subcategory_links``.
+    """
+    session = build_session(pool_size=workers)
+    if settings.RATE_CONTROL:
+        controller = RateController(
+            max_limit=workers, host_rate=settings.HOST_RATE, host_burst=settings.HOST_BURST
+        )
+        session = ControlledSession(session, controller, settings.MAX_RETRIES)
+
+    if subcategory_links is None:
+        subcategory_links = get_subcategories_http(session)
+
+    def crawl_subcategory(link):
+        try:
+            return get_subcategory_companies(session, link)
+        except Exception as e:
+            print(f"{link}: failed, {e!r}")
+            return None
+
+    company_links = set()
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for subcategory_link, links in zip(subcategory_links, pool.map(crawl_subcategory, subcategory_links)):
+            if links is None:
+                failed.append(subcategory_link)
+                continue
+            print(f"{subcategory_link}: {len(links)} companies")
+            company_links.update(links)
+
+    if failed:
+        print(f"{len(failed)} subcategories failed:")
+        print("\n".join(failed))
+    return company_links, failed
+
+
 def get_companies():
     """
     Each subcategory has a number of companies, listed in pages of 20 at a time.
@@ -66,28 +168,10 @@ def get_companies():
         while True:
 
             # get the content of the current page into some tasty soup
-            html = browser.page_source
-            name_demangler_pattern = r"\bclass=\"(.+?)___.+?\""
-            name_demangler_replace = r'class="\1"'
-            demangled_html = re.sub(
-                name_demangler_pattern, name_demangler_replace, html
-            )
+            soup = BeautifulSoup(demangle(browser.page_source), features="lxml")
 
-            soup = BeautifulSoup(demangled_html, features="lxml")
-
-            # get the container w/ all the links we want
-            container = soup.find(attrs={"class": "businessUnitCardsContainer"})
-
-            try:
-                # get all the a tags in here, and then add their hrefs to our set of links
-                company_elements = container.find_all("a", attrs={"class": "wrapper"})
-                company_links.update(
-                    [element.attrs.get("href") for element in company_elements]
-                )
-            except AttributeError:
-                # if we try to access something here, it means we didn't get the element we wanted.
-                # that's ok, we just need to continue as normal
-                pass
+            # add the hrefs of every company on the page to our set of links
+            company_links.update(parse_company_links(soup))
 
             try:
                 # So the "next page" button sometimes gets covered by this span that hovers over it
@@ -110,6 +194,26 @@ def get_companies():
 
 if __name__ == "__main__":
     # If we're running this script directly, we will refresh our company list.
-    company_links = get_companies()
-    with open(os.path.join(BASE_DIR, "companies.txt"), "w") as f:
+    arg_parser = argparse.ArgumentParser(description="Refresh companies.txt")
+    arg_parser.add_argument(
+        "--http", action="store_true", help="fetch the listing pages directly instead of driving chrome"
+    )
+    arg_parser.add_argument("--workers", type=int, default=16, help="subcategories to crawl at once (--http only)")
+    args = arg_parser.parse_args()
+
+    companies_path = os.path.join(BASE_DIR, "companies.txt")
+    failed = []
+    if args.http:
+        company_links, failed = get_companies_http(workers=args.workers)
+    else:
+        company_links = get_companies()
+
+    if failed and os.path.exists(companies_path):
+        # we haven't got the companies from the subcategories that failed, so keep whatever we had before
+        with open(companies_path) as f:
+            company_links.update(line.strip() for line in f if line.strip())
+    with open(companies_path, "w") as f:
         f.write("\n".join(company_links))
+    if failed:
+        print(f"Kept the companies already in {companies_path}, since {len(failed)} subcategories failed")
+        sys.exit(1)
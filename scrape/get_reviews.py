@@ -28,13 +28,17 @@ Review details:
 I'm going to try a class based approach for this one, since it'll take the longest and it'll need to be fairly robust.
 
 """
+import argparse
+import asyncio
 import csv
+import gzip
 import multiprocessing
+import queue
 import threading
 import os
 import re
 import time
-from dataclasses import asdict, dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from itertools import cycle, zip_longest
 from time import sleep
 import logging
@@ -42,62 +46,22 @@ import logging
 logging.basicConfig(filename='missing_pages.txt',level=logging.CRITICAL)
 
 import requests
-from bs4 import BeautifulSoup
 
+import metrics
+import parsers
 import settings
+from crawl_state import CrawlState
+from dedupe import CompanyDeduper, Deduplicator, FingerprintIndex
+from http_cache import ResponseCache
+from models import Company, CompanyReviews, Review, review_key
+from rate_control import ControlledSession, RateController, backoff
+from sessions import build_session
+from sinks import HEADERS, ReviewSink, file_sink
+from work_queue import Job, Lease, default_worker, open_queue
 
 
-@dataclass
-class Company(object):
-    """ A company with reviews """
-
-    url: str
-    name: str
-    categories: list
-    review_count: int
-    rating: int
-
-
-@dataclass
-class Review(object):
-    """ A review for a company """
-
-    company_url: str
-    title: str
-    body: str
-    rating: int
-
-
-@dataclass
-class CompanyReviews(object):
-    """ The flatfile review, which will be used for sentiment analysis """
-
-    company_url: str
-    company_name: str
-    company_review_count: int
-    company_rating: int
-    company_categories: str
-    review_rating: int
-    review_title: str
-    review_body: str
-
-    @classmethod
-    def from_company_and_review(cls, company: Company, review: Review):
-        """ Instantiates from a ``Company`` and a ``Review`` object """
-        return cls(
-            company_url=company.url,
-            company_name=company.name,
-            company_categories=",".join(company.categories),
-            company_review_count=company.review_count,
-            company_rating=company.rating,
-            review_title=review.title,
-            review_body=review.body,
-            review_rating=review.rating,
-        )
-
-    def as_dict(self) -> dict:
-        """ Serializes to a json/csv compatible dictionary. I just hate the default name... """
-        return asdict(self)
+# Every ``settings.CRAWL_ENGINE`` that ``CompanyPageCrawler.get_reviews`` knows how to run
+CRAWL_ENGINES = ("log", "threads", "asyncio", "pipeline")
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -111,27 +75,48 @@ def grouper(iterable, n, fillvalue=None):
 class CompanyPageCrawler(object):
     """ A company review page on trustpilot.com """
 
-    rating_map = {
-        "Excellent": 5,
-        "Great": 4,
-        "Average": 3,
-        "Poor": 2,
-        "Bad": 1,
-        "": 0,
-    }
-
-    @staticmethod
-    def remove_whitespace(string: str):
-        """ Strip unwanted characters out of a string """
-        return re.sub(r"\s", "", string)
-
-    @staticmethod
-    def replace_breaks(string: str, replace_char=" "):
-        """ Replace line breaks with ``replace_char`` """
-        return string.replace("\n", replace_char).replace("\r", replace_char)
-
-    def __init__(self):
+    rating_map = parsers.RATING_MAP
+    remove_whitespace = staticmethod(parsers.remove_whitespace)
+    replace_breaks = staticmethod(parsers.replace_breaks)
+
+    def __init__(
+        self,
+        session: requests.Session = None,
+        parser=None,
+        state: CrawlState = None,
+        cache: ResponseCache = None,
+        dedupe: Deduplicator = None,
+    ):
+        # ``soup`` is whatever document ``parser`` builds, which is only actual soup for the "soup" parser
         self.soup = None
+        self.parser = parser or parsers.get_parser(settings.PARSER)
+        # one pooled session for every page we fetch, so we're not doing a handshake per request
+        self.session = session or build_session()
+        if settings.RATE_CONTROL:
+            # every request goes through the rate controller, so it can find how fast we can go without getting
+            # throttled (and retry if we do)
+            self.controller = RateController(
+                max_limit=settings.CRAWL_CONCURRENCY,
+                host_rate=settings.HOST_RATE,
+                host_burst=settings.HOST_BURST,
+            )
+            self.session = ControlledSession(self.session, self.controller, settings.MAX_RETRIES)
+        # if we've got a crawl state, we keep it up to date as we go
+        self.state = state
+        if cache is None and settings.CACHE_MODE != "off":
+            cache = ResponseCache(settings.CACHE_DIR, settings.CACHE_MAX_BYTES, settings.CACHE_MODE)
+        self.cache = cache
+        if dedupe is None and settings.DEDUPE:
+            dedupe = Deduplicator(FingerprintIndex(settings.DEDUPE_INDEX_PATH))
+        self.dedupe = dedupe
+        # the "pipeline" engine's parsers, started the first time it runs and kept from one company to the next
+        self.parse_pool = None
+
+    def close(self):
+        """ Shut down anything the crawler started (just the pipeline's parse processes, for now) """
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+            self.parse_pool = None
 
     def get(self, url: str):
         """ 
@@ -139,8 +124,41 @@ class CompanyPageCrawler(object):
         2-  Fetches a url with ``self.soup``, resetting ``retries`` times if an invalid sessionID is found, 
             if the soup isn't pointed at the current page already
         """
-        response = requests.get(settings.BASE_URL + url)
-        self.soup = BeautifulSoup(response.text, features="lxml")
+        response, self.soup = self.fetch_soup(url)
+        return response
+
+    def fetch_soup(self, url: str):
+        """
+        Fetches a url and returns the response with its parsed document, without touching ``self.soup``. Anything that
+        runs concurrently has to use this, since every thread/task needs its own document.
+        """
+        response = self.fetch(url)
+        with metrics.PARSE_SECONDS.time(step="document"):
+            document = self.parser.parse(response.text)
+        return response, document
+
+    def fetch(self, url: str):
+        """
+        Fetch a url (relative to ``settings.BASE_URL``), through the response cache if there is one. Raises
+        ``requests.HTTPError`` for a 4xx or 5xx.
+        """
+        started = time.perf_counter()
+        try:
+            if self.cache:
+                response = self.cache.get(self.session, settings.BASE_URL + url)
+            else:
+                response = self.session.get(settings.BASE_URL + url)
+        except Exception:
+            metrics.FETCH_ERRORS.inc()
+            raise
+        metrics.FETCH_SECONDS.observe(time.perf_counter() - started, status=response.status_code)
+        metrics.FETCH_BYTES.inc(len(response.content))
+        if response.status_code >= 400:
+            # still throttled (or erroring) once the session's out of retries, or not there at all. Either way the
+            # page has to fail, since parsing the error page would find no company (so it'd look inactive) or no
+            # reviews (so it'd look done).
+            metrics.FETCH_ERRORS.inc()
+            raise requests.HTTPError(f"{response.status_code} for {url}", response=response)
         return response
 
     def get_company_reviews(self, company_url: str) -> list:
@@ -158,70 +176,323 @@ class CompanyPageCrawler(object):
             for company, review in zip(cycle([company]), reviews)
         ]
 
+    def stream_company_reviews(
+        self, company_url: str, sink: ReviewSink, first_page: int = 1, last_page: int = None
+    ) -> Company:
+        """
+        Like ``get_company_reviews``, but each page of ``CompanyReview`` goes to ``sink`` as soon as it's parsed,
+        instead of all of them being returned at the end.
+
+        With ``last_page``, only pages ``first_page`` to ``last_page`` get crawled (some other job has the rest), so
+        only its pages (and review count) are marked in the crawl state. Whichever job marks the last of the
+        company's pages done finishes the company, see ``CrawlState.mark_pages``.
+        """
+        company = self.get_company(company_url)
+        page_range = last_page is not None
+        if not company:
+            if self.state and not page_range:
+                self.state.finish_company(company_url, "inactive")
+            return None
+        page_count = (company.review_count // settings.REVIEWS_PER_PAGE) + 1
+        if page_range:
+            # the company might have lost reviews since the range was worked out
+            page_count = min(last_page, page_count)
+            if self.state:
+                self.state.add_companies([company_url])
+                self.state.set_review_counts({company_url: company.review_count})
+        elif self.state:
+            self.state.start_company(company_url, company.review_count, page_count)
+        deduper = None
+        if self.dedupe:
+            deduper = self.dedupe.company(
+                company_url, first_page=first_page, last_page=page_count if page_range else None
+            )
+
+        failed_pages = []
+
+        def write_page(page, reviews):
+            if reviews is None:
+                # the page failed, which ``crawl_page`` has already recorded
+                failed_pages.append(page)
+                return
+            found = len(reviews)
+            if deduper:
+                reviews = deduper.filter(reviews, page)
+            with metrics.WRITE_SECONDS.time():
+                sink.write(
+                    [CompanyReviews.from_company_and_review(company, review) for review in reviews]
+                )
+            metrics.ROWS_WRITTEN.inc(len(reviews))
+            if self.state:
+                self.state.mark_page(company_url, page, "done", found)
+
+        self.get_reviews(company_url, page_count=page_count, on_page=write_page, first_page=first_page)
+        if deduper:
+            self.finish_dedupe(deduper)
+        if self.state and settings.CRAWL_ENGINE != "log" and not page_range:
+            if failed_pages:
+                self.state.finish_company(company_url, "failed", f"{len(failed_pages)} pages failed")
+            else:
+                self.state.finish_company(company_url)
+        return company
+
     def get_company(self, company_url: str) -> Company:
         """ Populate a company object from ``company_url`` """
         self.get(company_url)
+        return self.parser.company(self.soup, company_url)
 
-        # The page header has the company name, and a subheader with the review count/rating
-        header = self.soup.find(attrs={"class": "header-section"})
+    def finish_dedupe(self, deduper: CompanyDeduper):
+        """ Remember the fingerprints for a company we're done with, and record how many duplicates it had """
+        self.dedupe.finish(deduper)
+        if deduper.duplicates:
+            print(f"{deduper.company_url}: dropped {deduper.duplicates} duplicate reviews")
+        if self.state:
+            self.state.set_company_duplicates(deduper.company_url, self.dedupe.duplicates[deduper.company_url])
 
-        try:
-            name = header.find(attrs={"class": "multi-size-header__big"}).text
-        except AttributeError:
-            print(f'Inactive page "{company_url}".')
-            return None
+    def get_reviews(self, company_url: str, page_count: int, on_page=None, first_page: int = 1) -> list:
+        """
+        Populate a list of reviews from pages ``first_page`` to ``page_count`` of ``company_url``, using whichever
+        engine ``settings.CRAWL_ENGINE`` names:
+
+            log:        Don't crawl anything, just log each page url to ``missing_pages.txt`` so they can be sent
+                        to SQS with ``scripts/upload_get_review_events.py``
+            threads:    A thread per page, capped at ``settings.CRAWL_CONCURRENCY`` running at once
+            asyncio:    A single event loop with at most ``settings.CRAWL_CONCURRENCY`` pages in flight
+            pipeline:   Fetch threads, a pool of parser processes, and this thread writing, so parsing can use
+                        every core (see ``get_reviews_pipeline``)
+
+        If ``on_page`` is given, it gets called with the page number and reviews for each page as they come in
+        (never from more than one thread at a time), and nothing is collected or returned. Pages that failed come
+        through with ``None`` for their reviews.
+        """
+        page_nums = list(range(first_page, page_count + 1))
+        reviews = list()
+        if on_page is None:
+            on_page = lambda page, page_reviews: reviews.extend(page_reviews or [])
+
+        if settings.CRAWL_ENGINE == "log":
+            for page_num in page_nums:
+                logging.critical(f"{company_url}?page={page_num}")
+            if self.state:
+                self.state.set_company(company_url, "queued", page_count=page_count)
+                self.state.mark_pages(company_url, page_nums, "queued")
+            return []
 
-        # The subheader has a bunch of spaces in its body that we don't need, and i feel like there might be commas
-        # in the review count, but i haven't found anything w/ 1k reviews so i'm just being cautious.
-        subheader_text = header.find(attrs={"class": "header--inline"}).text
-        subheader_text = subheader_text.replace(",", "")
-        subheader_text = self.replace_breaks(subheader_text)
-        subheader_text = self.remove_whitespace(subheader_text)
+        started = time.perf_counter()
+        if settings.CRAWL_ENGINE == "threads":
+            self.get_reviews_threaded(company_url, page_nums, on_page)
+        elif settings.CRAWL_ENGINE == "asyncio":
+            asyncio.run(self.get_reviews_async(company_url, page_nums, on_page))
+        elif settings.CRAWL_ENGINE == "pipeline":
+            self.get_reviews_pipeline(company_url, page_nums, on_page)
+        else:
+            raise ValueError(
+                f'Unknown crawl engine "{settings.CRAWL_ENGINE}", pick one of {list(CRAWL_ENGINES)}.'
+            )
+        elapsed = time.perf_counter() - started
 
-        # this is just assigns review_count to the first half and rating to the second
-        try:
-            review_count, rating = tuple(subheader_text.split("•"))
-        except ValueError:
-            return None
-        rating = self.rating_map.get(rating, None)
+        # pages/s is what we care about when comparing engines, since every page is one request
+        print(
+            f"{company_url}: {len(page_nums)} pages in {elapsed:.2f}s "
+            f"({len(page_nums) / max(elapsed, 1e-9):.1f} pages/s, {settings.CRAWL_ENGINE})"
+        )
+        if settings.RATE_CONTROL:
+            print(f"Rate control: {self.controller.stats()}")
+        return reviews
 
-        # category_holder = self.soup.find(attrs={"class": "categories"})
-        categories = ""  # [link.text for link in category_holder.find_all("a")]
+    def get_reviews_threaded(self, company_url: str, page_nums: list, on_page):
+        """
+        Fetch every page in ``page_nums`` with its own thread, handing each page's reviews to ``on_page``. If
+        ``on_page`` raises, no more pages get handed to it, and the first error gets raised here once every thread's
+        finished.
+        """
+        lock = threading.Lock()
+        errors = []
+
+        def worker(page_num):
+            page_reviews = self.crawl_page(company_url, page_num)
+            with lock:
+                if errors:
+                    return
+                try:
+                    on_page(page_num, page_reviews)
+                except BaseException as e:
+                    errors.append(e)
+
+        threads = [
+            threading.Thread(target=worker, args=(page_num,)) for page_num in page_nums
+        ]
 
-        return Company(
-            url=company_url,
-            name=name,
-            categories=categories,
-            review_count=int(review_count),
-            rating=rating,
-        )
+        # active_count includes the main thread, hence the +1
+        for thread in threads:
+            if errors:
+                break
+            while threading.active_count() > settings.CRAWL_CONCURRENCY + 1:
+                sleep(0.1)
+            thread.start()
 
-    def get_reviews(self, company_url: str, page_count: int) -> list:
-        """ Populate a list of reviews from ``company_url`` """
-        self.get(company_url)
+        for thread in threads:
+            # threads we never started (we stopped early) have no ident, and can't be joined
+            if thread.ident is not None:
+                thread.join()
+        if errors:
+            raise errors[0]
 
-        self.reviews = list()
+    async def get_reviews_async(self, company_url: str, page_nums: list, on_page):
+        """
+        Fetch every page in ``page_nums`` from one event loop.
 
-        print(page_count)
-        page_nums = [f"?page={i+1}" for i in range(page_count)]
-        for page_num in page_nums:
-            logging.critical(company_url + page_num)
-        return []
+        A semaphore caps how many pages are in flight, and each finished page drops its reviews onto a queue that a
+        single consumer drains into ``on_page``, so nothing but the consumer ever touches the results. ``requests``
+        and the parsers are both blocking, so the fetch + parse for a page runs on a pool that's sized to the
+        semaphore (rather than a thread per page).
 
-        threads = []
-        while page_nums:
-            thread = threading.Thread(target=self.get_reviews_for_page, args=(company_url,page_nums.pop()))
-            threads.append(thread)
-        
-        for thread in threads:
-            while threading.active_count() > 50:
-                sleep(1)
-            thread.start()            
+        A page only gives up its slot once its reviews are on the queue, and the queue is the same size as the
+        semaphore, so a slow ``on_page`` slows down fetching instead of piling up pages in memory.
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(settings.CRAWL_CONCURRENCY)
+        results = asyncio.Queue(maxsize=settings.CRAWL_CONCURRENCY)
+        executor = ThreadPoolExecutor(max_workers=settings.CRAWL_CONCURRENCY)
+
+        async def fetch_page(page_num):
+            async with semaphore:
+                page_reviews = await loop.run_in_executor(
+                    executor, self.crawl_page, company_url, page_num
+                )
+                await results.put((page_num, page_reviews))
+
+        async def consume():
+            for _ in page_nums:
+                on_page(*await results.get())
 
-        for thread in threads:
-            thread.join()
+        try:
+            producers = [asyncio.ensure_future(fetch_page(page_num)) for page_num in page_nums]
+            await consume()
+            await asyncio.gather(*producers)
+        finally:
+            executor.shutdown(wait=False)
 
-        return self.reviews
+    def get_reviews_pipeline(self, company_url: str, page_nums: list, on_page):
+        """
+        Fetch every page in ``page_nums`` in three stages, so parsing (which is cpu bound, and holds the GIL while
+        it's at it) isn't stuck on one core:
+
+            fetch:  ``settings.FETCH_WORKERS`` threads fetch pages, and put the raw bytes on a queue
+            parse:  a thread hands those to ``settings.PARSE_WORKERS`` parser processes, putting each page's future
+                    on a second queue, in the order they went in
+            write:  this thread takes the futures off that queue as they finish, and hands each page to ``on_page``
+
+        Both queues hold at most ``settings.PIPELINE_QUEUE_SIZE`` pages, so if writing falls behind, parsing stops
+        taking pages, the fetchers stop once the first queue fills up, and nothing piles up in memory.
+        """
+        if self.parse_pool is None:
+            # spawned rather than forked, since the pool starts its processes as it needs them, and forking with
+            # the fetch threads running can leave a child holding a lock some thread had at the time
+            self.parse_pool = ProcessPoolExecutor(
+                max_workers=settings.PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        fetched = queue.Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+        parsing = queue.Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+        # set if the writer gives up (``on_page`` raised), so nothing's left blocked on a full queue
+        stopped = threading.Event()
+
+        def put(pages: queue.Queue, item) -> bool:
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch(page_num):
+            if stopped.is_set():
+                return
+            try:
+                response = self.fetch(f"{company_url}?page={page_num}")
+                put(fetched, (page_num, response.content, response.encoding))
+            except Exception as e:
+                put(fetched, (page_num, e, None))
+
+        def parse():
+            for _ in page_nums:
+                while True:
+                    if stopped.is_set():
+                        return
+                    try:
+                        page_num, content, encoding = fetched.get(timeout=0.1)
+                        break
+                    except queue.Empty:
+                        pass
+                if not isinstance(content, Exception):
+                    try:
+                        content = self.parse_pool.submit(
+                            parsers.parse_reviews_page, self.parser.name, company_url, content, encoding
+                        )
+                    except Exception as e:
+                        # e.g. the pool's broken, in which case every page fails, rather than the writer waiting
+                        # forever on pages that'll never come
+                        content = e
+                if not put(parsing, (page_num, content)) and not isinstance(content, Exception):
+                    content.cancel()
+
+        fetchers = ThreadPoolExecutor(max_workers=settings.FETCH_WORKERS)
+        parser_thread = threading.Thread(target=parse, daemon=True)
+        try:
+            for page_num in page_nums:
+                fetchers.submit(fetch, page_num)
+            parser_thread.start()
+
+            for _ in page_nums:
+                page_num, page = parsing.get()
+                try:
+                    if isinstance(page, Exception):
+                        raise page
+                    page_reviews, parse_seconds, fast_path = page.result()
+                except Exception as e:
+                    on_page(page_num, self.page_failed(company_url, page_num, e))
+                    continue
+                if fast_path is not None:
+                    self.parser.record(fast_path)
+                metrics.PARSE_SECONDS.observe(parse_seconds, step="pipeline")
+                metrics.REVIEWS_PER_PAGE.observe(len(page_reviews))
+                on_page(page_num, page_reviews)
+        except BaseException:
+            stopped.set()
+            # throw away whatever's queued up, cancelling any parses that haven't started
+            for pages in (fetched, parsing):
+                while True:
+                    try:
+                        _, page, *_ = pages.get_nowait()
+                    except queue.Empty:
+                        break
+                    if hasattr(page, "cancel"):
+                        page.cancel()
+            raise
+        finally:
+            fetchers.shutdown(wait=True, cancel_futures=True)
+            if parser_thread.is_alive():
+                parser_thread.join()
+
+    def crawl_page(self, company_url: str, page_num: int) -> list:
+        """
+        Get the reviews on page ``page_num`` of a company. One bad page shouldn't sink the whole company, so if
+        anything goes wrong we log the page (like the ``log`` engine would), and return ``None`` instead of reviews.
+        """
+        try:
+            return self.get_reviews_for_page(company_url, f"?page={page_num}")
+        except Exception as e:
+            return self.page_failed(company_url, page_num, e)
+
+    def page_failed(self, company_url: str, page_num: int, error: Exception):
+        """ Record that we couldn't get a page, and log it so it can be picked up again. Always returns ``None``. """
+        print(f"Failed {company_url}?page={page_num}: {error!r}")
+        metrics.PAGE_ERRORS.inc()
+        logging.critical(f"{company_url}?page={page_num}")
+        if self.state:
+            self.state.mark_page(company_url, page_num, "failed", error=repr(error))
+        return None
 
     def get_reviews_for_page(self, company_url: str, page_num: str) -> list:
         """ Fetch all the reviews at a url """
@@ -229,63 +500,240 @@ class CompanyPageCrawler(object):
             return []
         print(f"Company {company_url}, Page {page_num}")
 
-        reviews = list()
-        self.get(company_url + page_num)
-        review_elements = self.soup.find_all(attrs={"class": "review"})
-
-        for review_element in review_elements:
-
-            # title and body can be found by class name
-            title = review_element.find(attrs={"class": "review-content__title"}).text
-            title = self.replace_breaks(title)
-            # Sometimes there's no review body, so we'll pass '' instead
-            body = review_element.find(attrs={"class": "review-content__text"})
-            if not body:
-                body = ""
-            else:
-                # newlines in the body break the csv file and aren't necessary for this anyways, so we'll
-                # replace them with spaces.
-                body = body.text
-                body = self.replace_breaks(body)
+        _, soup = self.fetch_soup(company_url + page_num)
+        return self.parse_reviews(soup, company_url)
 
-            rating_img = review_element.find(attrs={"class": "star-rating"}).find("img")
-            rating = int(rating_img.attrs["src"].split("/")[-1].replace(".svg", "")[-1])
-
-            reviews.append(
-                Review(company_url=company_url, title=title, body=body, rating=rating,)
-            )
-
-        self.reviews += reviews
-        # return reviews
+    def parse_reviews(self, soup, company_url: str) -> list:
+        """ Pull every review out of a review page's document """
+        with metrics.PARSE_SECONDS.time(step="reviews"):
+            reviews = self.parser.reviews(soup, company_url)
+        metrics.REVIEWS_PER_PAGE.observe(len(reviews))
+        return reviews
 
     def save_reviews_for_company(
         self, company_url: str, save_dir: str, file_name: str
-    ) -> list:
-        """ Saves the reviews for a company in save_dir"""
+    ) -> int:
+        """
+        Saves the reviews for a company in save_dir, a page at a time. A ``file_name`` ending in ``.gz`` gets
+        gzipped, and one ending in ``.parquet`` gets written as parquet. Returns how many reviews were saved.
+        """
+        with file_sink(os.path.join(save_dir, file_name)) as sink:
+            self.stream_company_reviews(company_url, sink)
+        return sink.rows_written
+
+    def save_page_range_for_company(
+        self, company_url: str, first_page: int, last_page: int, save_dir: str, file_name: str
+    ) -> int:
+        """ Like ``save_reviews_for_company``, but just pages ``first_page`` to ``last_page`` """
+        with file_sink(os.path.join(save_dir, file_name)) as sink:
+            self.stream_company_reviews(company_url, sink, first_page, last_page)
+        return sink.rows_written
+
+    def refresh_reviews_for_company(
+        self, company_url: str, save_dir: str, file_name: str
+    ) -> int:
+        """
+        Brings a company's saved reviews up to date without crawling the whole thing again.
 
-        reviews = self.get_company_reviews(company_url)
-        if not reviews:
-            return
-        headers = list(reviews[0].as_dict().keys())
+        Trustpilot lists the newest reviews first, so anything new since last time is at the start of page 1. We
+        compare the live review count with the one in the crawl state to see how many pages could have new reviews,
+        and go through them in order until we hit a review we've already got. The new reviews go at the top of the
+        existing file (newest first, same as the site).
 
-        with open(
-            os.path.join(save_dir, file_name), "w", newline="", encoding="utf-8"
-        ) as f:
-            writer = csv.DictWriter(f, headers)
-            writer.writeheader()
-            writer.writerows([review.as_dict() for review in reviews])
+        Anything we don't have a saved csv or review count for gets a full crawl instead (parquet files can't be
+        prepended to, so those always get a full crawl). Returns how many new reviews were saved.
+        """
+        path = os.path.join(save_dir, file_name)
+        known = self.state.company(company_url) if self.state else None
+        if (
+            not known
+            or known["review_count"] is None
+            or not os.path.exists(path)
+            or path.endswith(".parquet")
+        ):
+            return self.save_reviews_for_company(company_url, save_dir, file_name)
 
+        company = self.get_company(company_url)
+        if not company:
+            self.state.finish_company(company_url, "inactive")
+            return 0
 
-def get_review(url: str, save_dir: str):
-    """ Saves a review for a company """
-    if url is None:
+        new_count = company.review_count - known["review_count"]
+        page_count = (company.review_count // settings.REVIEWS_PER_PAGE) + 1
+        if new_count <= 0:
+            self.state.set_company(company_url, "done", review_count=company.review_count, page_count=page_count)
+            return 0
+
+        # we only keep the keys for what we've got, not the reviews themselves
+        with open_reviews(path) as f:
+            saved = {
+                review_key(row["review_title"], row["review_body"], row["review_rating"])
+                for row in csv.DictReader(f)
+            }
+
+        # one more page than the count says, since reviews can get removed as well as added
+        new_reviews = list()
+        for page in range(1, min(new_count // settings.REVIEWS_PER_PAGE + 2, page_count) + 1):
+            page_reviews = self.get_reviews_for_page(company_url, f"?page={page}")
+            fresh = list()
+            for review in page_reviews:
+                if review_key(review.title, review.body, review.rating) in saved:
+                    break
+                fresh.append(review)
+            new_reviews += fresh
+            if len(fresh) < len(page_reviews) or not page_reviews:
+                break
+
+        if self.dedupe:
+            deduper = self.dedupe.company(company_url, incremental=True)
+            new_reviews = deduper.filter(new_reviews)
+            self.finish_dedupe(deduper)
+
+        merge_new_reviews(
+            path,
+            [CompanyReviews.from_company_and_review(company, review) for review in new_reviews],
+        )
+        self.state.set_company(company_url, "done", review_count=company.review_count, page_count=page_count)
+        print(f"{company_url}: {len(new_reviews)} new reviews")
+        return len(new_reviews)
+
+
+def open_reviews(path: str, mode: str = "r"):
+    """ Open a saved reviews csv, gzipped or not """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", newline="", encoding="utf-8")
+    return open(path, mode, newline="", encoding="utf-8")
+
+
+def merge_new_reviews(path: str, new_rows: list):
+    """
+    Put ``new_rows`` at the top of the reviews saved at ``path``. The old rows are streamed across to a new file
+    (rather than read in all at once), which then replaces the old one.
+    """
+    if not new_rows:
+        return
+    merged_path = path + ".merging"
+
+    with open_reviews(path) as old, open_reviews(merged_path, "w") as merged:
+        reader = csv.reader(old)
+        writer = csv.writer(merged)
+        writer.writerow(next(reader))
+        writer.writerows(row.as_row() for row in new_rows)
+        writer.writerows(reader)
+
+    os.replace(merged_path, path)
+
+
+def get_review(url: str, save_dir: str, crawler: CompanyPageCrawler = None, incremental: bool = False):
+    """ Saves a review for a company, or with ``incremental``, just the reviews that are new since last time """
+    if not url:
         return
-    crawler = CompanyPageCrawler()
-    file_name = f"{url}.csv".replace("/review/", "")
-    crawler.save_reviews_for_company(url, save_dir, file_name)
+    crawler = crawler or CompanyPageCrawler()
+    file_name = f"{url}.{settings.OUTPUT_FORMAT}".replace("/review/", "")
+    try:
+        if incremental:
+            crawler.refresh_reviews_for_company(url, save_dir, file_name)
+        else:
+            crawler.save_reviews_for_company(url, save_dir, file_name)
+    except Exception as e:
+        if not crawler.state:
+            raise
+        print(f"Failed {url}: {e!r}")
+        crawler.state.finish_company(url, "failed", repr(e))
+
+
+def crawl_job(crawler: CompanyPageCrawler, job: Job, save_dir: str) -> int:
+    """
+    Crawl a job from the work queue, returning how many reviews were saved. Page ranges get saved as
+    ``<company>%3Fpages=<first>-<last>``, the same as the lambda's, so ``join_paged_files.py`` can stitch them together
+    (the ``?`` is escaped since windows won't have it in a file name).
+    """
+    file_name = f"{job}.{settings.OUTPUT_FORMAT}".replace("/review/", "").replace("?", "%3F")
+    if job.is_page_range:
+        return crawler.save_page_range_for_company(job.company_url, job.first_page, job.last_page, save_dir, file_name)
+    try:
+        return crawler.save_reviews_for_company(job.company_url, save_dir, file_name)
+    except Exception as e:
+        if crawler.state:
+            crawler.state.finish_company(job.company_url, "failed", repr(e))
+        raise
+
+
+def with_retries(call, *args, **kwargs):
+    """
+    ``call(*args, **kwargs)``, trying again with backoff if it raises. For the work queue calls, since the coordinator
+    might be restarting (or its database locked for a moment), and that shouldn't kill the worker. Gives up after
+    ``settings.WORK_QUEUE_RETRIES`` tries.
+    """
+    for attempt in range(settings.WORK_QUEUE_RETRIES):
+        try:
+            return call(*args, **kwargs)
+        except Exception as e:
+            if attempt == settings.WORK_QUEUE_RETRIES - 1:
+                raise
+            print(f"Work queue {call.__name__} failed (attempt {attempt + 1}): {e!r}")
+            sleep(backoff(attempt, base=1))
 
 
-def get_reviews(urls: list):
+def crawl_from_queue(work_queue, worker: str = None, state: CrawlState = None):
+    """
+    Work through jobs from ``work_queue`` (see work_queue.py) until there's none left, heartbeating each one's lease
+    while it's crawled. Any number of these can run at once, on any number of hosts, without treading on each other.
+
+    Once nothing's pending we hang around while anyone else still holds a lease, since their job could fail (or
+    their worker could die), and come back for someone to pick up. Calls to the queue get retried (see
+    ``with_retries``), so a coordinator restart doesn't take the workers down with it.
+    """
+    worker = worker or default_worker()
+    save_dir = os.path.join(settings.BASE_DIR, "reviews")
+    os.makedirs(save_dir, exist_ok=True)
+    crawler = CompanyPageCrawler(state=state)
+    jobs_done = 0
+
+    try:
+        while True:
+            job = with_retries(work_queue.claim, worker)
+            if job is None:
+                if not with_retries(work_queue.counts).get("leased"):
+                    break
+                sleep(settings.WORK_QUEUE_POLL_SECONDS)
+                continue
+
+            with Lease(work_queue, job, worker) as lease:
+                try:
+                    crawl_job(crawler, job, save_dir)
+                except KeyboardInterrupt:
+                    with_retries(work_queue.release, job.id, worker)
+                    raise
+                except Exception as e:
+                    print(f"Failed {job} (attempt {job.attempts}): {e!r}")
+                    with_retries(work_queue.fail, job.id, worker, repr(e))
+                    continue
+            if lease.lost or not with_retries(work_queue.complete, job.id, worker):
+                print(f"Finished {job}, but its lease had already gone to another worker")
+
+            jobs_done += 1
+            if jobs_done % 100 == 0:
+                if crawler.dedupe:
+                    crawler.dedupe.save()
+                export_metrics()
+    finally:
+        crawler.close()
+        if crawler.dedupe:
+            crawler.dedupe.save()
+        export_metrics()
+    print(f"{worker}: no jobs left, finished {jobs_done}")
+
+
+def export_metrics():
+    """ Write out where the metrics are at (see metrics.py), to whichever of the metrics paths are set """
+    if settings.METRICS_JSON_PATH:
+        metrics.REGISTRY.write_json_lines(settings.METRICS_JSON_PATH)
+    if settings.METRICS_PROMETHEUS_PATH:
+        metrics.REGISTRY.write_prometheus(settings.METRICS_PROMETHEUS_PATH)
+
+
+def get_reviews(urls: list, state: CrawlState = None, incremental: bool = False):
     """
     Write reviews for each company to a csv in scrape/reviews/<company_url>.csv
 
@@ -294,18 +742,53 @@ def get_reviews(urls: list):
     """
     save_dir = os.path.join(settings.BASE_DIR, "reviews")
     url_count = len(urls)
-
-    for i, url in enumerate(urls):
-        # print(f"Starting {url} ({i+1} of {url_count})...")
-        get_review(url, save_dir)
-        # print(f"... done with {url} ({url_count-i-1} remaining)!")
+    # sharing the crawler means sharing its session, so connections stay open from one company to the next
+    crawler = CompanyPageCrawler(state=state)
+
+    try:
+        for i, url in enumerate(urls):
+            # print(f"Starting {url} ({i+1} of {url_count})...")
+            get_review(url, save_dir, crawler, incremental)
+            # print(f"... done with {url} ({url_count-i-1} remaining)!")
+            if (i + 1) % 100 == 0:
+                if crawler.dedupe:
+                    crawler.dedupe.save()
+                export_metrics()
+    finally:
+        crawler.close()
+        if crawler.dedupe:
+            crawler.dedupe.save()
+        export_metrics()
 
 
 if __name__ == "__main__":
-    with open(os.path.join(settings.BASE_DIR, "missing_companies.txt")) as f:
-        urls_string = f.read()
-    urls = urls_string.split("\n")
-    get_reviews(urls)
+    arg_parser = argparse.ArgumentParser(description="Crawl reviews for every company we haven't got yet")
+    arg_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="refresh every company we've already crawled with just its new reviews",
+    )
+    arg_parser.add_argument(
+        "--queue",
+        nargs="?",
+        const=settings.WORK_QUEUE_PATH,
+        help="crawl jobs from a work queue (a database path or a coordinator's url, see work_queue.py) instead",
+    )
+    arg_parser.add_argument("--worker", help="this worker's name in the work queue (host:pid by default)")
+    args = arg_parser.parse_args()
+
+    state = CrawlState()
+    if args.queue:
+        crawl_from_queue(open_queue(args.queue), args.worker, state)
+    elif args.incremental:
+        get_reviews(state.companies_with_status("done"), state, incremental=True)
+    else:
+        with open(os.path.join(settings.BASE_DIR, "missing_companies.txt")) as f:
+            urls_string = f.read()
+        state.add_companies(urls_string.split("\n"))
+        # anything we've already finished (or found to be inactive) gets skipped
+        urls = state.remaining_companies()
+        get_reviews(urls, state)
     # single = "/review/kiwi.com"
     # get_review(single, os.path.join(settings.BASE_DIR, "reviews"))
 
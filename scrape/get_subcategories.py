@@ -1,5 +1,6 @@
 """ Scraping subcategories from trustpilot """
 
+import requests
 from bs4 import BeautifulSoup
 from selenium import webdriver
 
@@ -13,6 +14,21 @@ def get_subcategories():
     html = browser.page_source
     browser.close()
 
+    return parse_subcategories(html)
+
+
+def get_subcategories_http(session=None):
+    """
+    The same as ``get_subcategories``, but with a plain http request instead of a browser. Pass ``session`` (say a
+    ``ControlledSession``) to share its connections and rate control.
+    """
+    response = (session or requests).get(BASE_URL + "/categories")
+    response.raise_for_status()
+    return parse_subcategories(response.text)
+
+
+def parse_subcategories(html: str) -> set:
+    """ Pull the subcategory links out of the categories page """
     # We parse the page source to find the first 'section' tag, which is where the subcategory cards are located.
     soup = BeautifulSoup(html, features="lxml")
     subcategory_section = soup.find_all("section")[0]
@@ -0,0 +1,216 @@
+"""
+An on-disk cache for the pages we fetch, so we don't have to keep fetching them.
+
+We end up fetching the same pages a lot: every company page gets fetched once by ``get_company`` and again as page 1
+of its reviews, and every time the parser gets fixed, re-running means downloading everything all over again. With
+the cache on, each page only comes over the network once, and re-parsing the whole lot (``offline`` mode) doesn't
+need the network at all.
+
+The cache has two halves:
+
+    index/  one small json file per url (named by a hash of the url), with the status, headers and validators
+            (ETag/Last-Modified) for the response, plus the hash of its body
+    blobs/  the gzipped bodies, named by a hash of their contents. Lots of urls end up with the exact same body (every
+            page past the last one redirects back to page 1, for example), so they all share one blob.
+
+When the blobs go over ``max_bytes``, the least recently used ones get deleted until we're back under.
+
+Modes:
+
+    on          use whatever's cached, and only fetch what isn't
+    revalidate  ask the server if what's cached is still good (If-None-Match/If-Modified-Since), and only download it
+                again if it's not
+    offline     never touch the network, anything that isn't cached raises ``CacheMiss``
+    off         don't cache anything
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+MODES = ("on", "revalidate", "offline", "off")
+
+
+class CacheMiss(Exception):
+    """ Raised in offline mode when a url isn't cached """
+
+
+class CachedResponse(object):
+    """ Just enough of a ``requests.Response`` for the crawler to not know the difference """
+
+    from_cache = True
+
+    def __init__(self, url: str, status_code: int, headers: dict, content: bytes, encoding: str):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResponseCache(object):
+    """ The response cache (see above). Safe to share between threads. """
+
+    def __init__(self, directory: str, max_bytes: int = 5 * 2 ** 30, mode: str = "on"):
+        if mode not in MODES:
+            raise ValueError(f'Unknown cache mode "{mode}", pick one of {MODES}.')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.join(directory, "index"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path in self.blob_paths())
+
+    def index_path(self, url: str) -> str:
+        digest = sha256(url.encode("utf-8"))
+        return os.path.join(self.directory, "index", digest[:2], digest + ".json")
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.directory, "blobs", digest[:2], digest + ".gz")
+
+    def blob_paths(self):
+        for root, _, files in os.walk(os.path.join(self.directory, "blobs")):
+            for name in files:
+                if name.endswith(".gz"):
+                    yield os.path.join(root, name)
+
+    def load(self, url: str):
+        """ The cached entry and body for ``url``, or ``(None, None)`` """
+        try:
+            with open(self.index_path(url), encoding="utf-8") as f:
+                entry = json.load(f)
+            blob_path = self.blob_path(entry["body"])
+            with open(blob_path, "rb") as f:
+                content = gzip.decompress(f.read())
+            # eviction goes by modified time, so touching the blob marks it as recently used
+            os.utime(blob_path)
+        except (OSError, ValueError, KeyError):
+            # not cached, or the blob got evicted out from under its index entry (which can happen between reading
+            # it and touching it, too)
+            return None, None
+        return entry, content
+
+    def store(self, url: str, response):
+        """ Cache ``response`` for ``url`` """
+        content = response.content
+        digest = sha256(content)
+        blob_path = self.blob_path(digest)
+        if not os.path.exists(blob_path):
+            write_atomic(blob_path, gzip.compress(content))
+            with self.lock:
+                self.size += os.path.getsize(blob_path)
+
+        entry = {
+            "url": response.url,
+            "status_code": response.status_code,
+            "headers": dict(response.headers),
+            "encoding": response.encoding,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "body": digest,
+            "fetched": time.time(),
+        }
+        write_atomic(self.index_path(url), json.dumps(entry).encode("utf-8"))
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ Delete the least recently used blobs until we're at 90% of ``max_bytes`` """
+        with self.lock:
+            blobs = sorted(
+                ((os.path.getmtime(path), os.path.getsize(path), path) for path in self.blob_paths())
+            )
+            target = self.max_bytes * 0.9
+            for _, size, path in blobs:
+                if self.size <= target:
+                    break
+                try:
+                    os.remove(path)
+                    self.size -= size
+                except OSError:
+                    pass
+
+    def count(self, hit: bool):
+        """ Count a hit or a miss (``+=`` isn't atomic, and the crawl threads all share the cache) """
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, session, url: str, **kwargs):
+        """ ``session.get(url)``, going through the cache """
+        if self.mode == "off":
+            return session.get(url, **kwargs)
+
+        entry, content = self.load(url)
+
+        if entry is not None and self.mode in ("on", "offline"):
+            self.count(hit=True)
+            return to_response(entry, content)
+
+        if self.mode == "offline":
+            self.count(hit=False)
+            raise CacheMiss(url)
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        if entry is not None:
+            # revalidate: only send the body again if it's changed
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = session.get(url, headers=headers, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.count(hit=True)
+            entry["fetched"] = time.time()
+            write_atomic(self.index_path(url), json.dumps(entry).encode("utf-8"))
+            return to_response(entry, content)
+
+        self.count(hit=False)
+        if response.status_code != 200:
+            # errors and throttling aren't worth keeping
+            return response
+        self.store(url, response)
+        return response
+
+
+def to_response(entry: dict, content: bytes) -> CachedResponse:
+    return CachedResponse(
+        url=entry["url"],
+        status_code=entry["status_code"],
+        headers=entry["headers"],
+        content=content,
+        encoding=entry["encoding"],
+    )
+
+
+def write_atomic(path: str, data: bytes):
+    """ Write to a temp file and move it into place, so nothing ever reads a half-written file """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
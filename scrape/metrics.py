@@ -0,0 +1,190 @@
+"""
+Counters and histograms for the hot path of a crawl, so we can see which stage (fetch, parse or write) is the slow one.
+
+Everything gets recorded into ``REGISTRY``, and can be written out two ways:
+
+    json lines      one line per metric (and label set) per export, with a timestamp, so a file of them is a history
+                    of the crawl we can load up and plot
+    prometheus      the text format, for node_exporter's textfile collector (or just reading)
+
+The metrics themselves are defined at the bottom, so everything that records them shares the same ones:
+
+    scraper_fetch_seconds           how long each request took, by status
+    scraper_fetch_bytes_total       bytes downloaded (after decompression)
+    scraper_fetch_errors_total      requests that raised instead of getting a response
+    scraper_retries_total           requests retried by the rate controller
+    scraper_parse_seconds           how long each page took to parse
+    scraper_reviews_per_page        reviews found on each review page
+    scraper_fast_path_total         review pages read from embedded json (hit), or that fell back to the tree (miss)
+    scraper_page_errors_total       review pages we gave up on
+    scraper_write_seconds           how long each batch of rows took to write
+    scraper_rows_written_total      rows written
+
+Nothing here needs anything outside the standard library, so it's cheap to import from anywhere.
+"""
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# seconds, from "basically instant" to "something's wrong"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(key: tuple, extra: dict = None) -> str:
+    pairs = list(key) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter(object):
+    """ A number that only goes up, per set of labels """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = dict()
+
+    def inc(self, amount: float = 1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        """ ``(labels, value)`` for every set of labels """
+        with self.lock:
+            return [(dict(key), {"value": value}) for key, value in self.values.items()]
+
+    def prometheus(self) -> list:
+        with self.lock:
+            return [f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Histogram(object):
+    """ Counts of observations falling into ``buckets``, plus their sum, per set of labels """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # labels -> [count per bucket (+ one for everything above the last), sum]
+        self.values = dict()
+
+    def observe(self, value: float, **labels):
+        key = label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observe how long the ``with`` block took """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> list:
+        with self.lock:
+            return [
+                (
+                    dict(key),
+                    {
+                        "count": sum(counts),
+                        "sum": total,
+                        "buckets": dict(zip([str(bucket) for bucket in self.buckets] + ["+Inf"], counts)),
+                    },
+                )
+                for key, (counts, total) in self.values.items()
+            ]
+
+    def prometheus(self) -> list:
+        lines = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                # prometheus buckets are cumulative, ours aren't
+                cumulative = 0
+                for bucket, count in zip([str(bucket) for bucket in self.buckets] + ["+Inf"], counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(key, {'le': bucket})} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+
+class Registry(object):
+    """ Every metric we're keeping, so they can be exported together """
+
+    def __init__(self):
+        self.metrics = dict()
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def json_lines(self) -> list:
+        """ A json line for every metric and label set, as of now """
+        now = time.time()
+        return [
+            json.dumps({"time": now, "name": metric.name, "type": metric.kind, "labels": labels, **values})
+            for metric in self.metrics.values()
+            for labels, values in metric.samples()
+        ]
+
+    def prometheus(self) -> str:
+        """ Everything, in prometheus' text format """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.prometheus())
+        return "\n".join(lines) + "\n"
+
+    def write_json_lines(self, path: str):
+        """ Add a snapshot of everything to the end of ``path`` """
+        with open(path, "a", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in self.json_lines())
+
+    def write_prometheus(self, path: str):
+        """ Replace ``path`` with the current values (all at once, so a scrape never sees half a file) """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(temp_path, path)
+
+
+REGISTRY = Registry()
+
+FETCH_SECONDS = REGISTRY.histogram("scraper_fetch_seconds", "Time taken by each request, by status")
+FETCH_BYTES = REGISTRY.counter("scraper_fetch_bytes_total", "Bytes downloaded, after decompression")
+FETCH_ERRORS = REGISTRY.counter("scraper_fetch_errors_total", "Requests that raised instead of getting a response")
+RETRIES = REGISTRY.counter("scraper_retries_total", "Requests retried by the rate controller")
+PARSE_SECONDS = REGISTRY.histogram("scraper_parse_seconds", "Time taken to parse each page")
+REVIEWS_PER_PAGE = REGISTRY.histogram(
+    "scraper_reviews_per_page", "Reviews found on each review page", buckets=(0, 1, 5, 10, 15, 19, 20, 25)
+)
+FAST_PATH = REGISTRY.counter(
+    "scraper_fast_path_total", "Review pages read from embedded json (hit), or that fell back to the tree (miss)"
+)
+PAGE_ERRORS = REGISTRY.counter("scraper_page_errors_total", "Review pages we gave up on")
+WRITE_SECONDS = REGISTRY.histogram("scraper_write_seconds", "Time taken to write each batch of rows")
+ROWS_WRITTEN = REGISTRY.counter("scraper_rows_written_total", "Rows written")
@@ -0,0 +1,115 @@
+"""
+The records we pull out of trustpilot. These live on their own so the crawler and the parsers can both use them
+without importing each other.
+"""
+
+from dataclasses import dataclass
+
+
+@dataclass
+class Company(object):
+    """ A company with reviews """
+
+    __slots__ = ("url", "name", "categories", "review_count", "rating")
+
+    url: str
+    name: str
+    categories: list
+    review_count: int
+    rating: int
+
+
+@dataclass
+class Review(object):
+    """ A review for a company """
+
+    __slots__ = ("company_url", "title", "body", "rating")
+
+    company_url: str
+    title: str
+    body: str
+    rating: int
+
+
+@dataclass
+class CompanyReviews(object):
+    """
+    The flatfile review, which will be used for sentiment analysis.
+
+    There's one of these for every review we save, so (like ``Company`` and ``Review``) it uses ``__slots__`` instead
+    of a per-instance ``__dict__``, which makes each one a good bit smaller.
+    """
+
+    __slots__ = (
+        "company_url",
+        "company_name",
+        "company_review_count",
+        "company_rating",
+        "company_categories",
+        "review_rating",
+        "review_title",
+        "review_body",
+    )
+
+    company_url: str
+    company_name: str
+    company_review_count: int
+    company_rating: int
+    company_categories: str
+    review_rating: int
+    review_title: str
+    review_body: str
+
+    @classmethod
+    def from_company_and_review(cls, company: Company, review: Review):
+        """ Instantiates from a ``Company`` and a ``Review`` object """
+        return cls(
+            company_url=company.url,
+            company_name=company.name,
+            company_categories=",".join(company.categories),
+            company_review_count=company.review_count,
+            company_rating=company.rating,
+            review_title=review.title,
+            review_body=review.body,
+            review_rating=review.rating,
+        )
+
+    def as_dict(self) -> dict:
+        """
+        Serializes to a json/csv compatible dictionary. I just hate the default name...
+
+        Everything in here is a str or an int, so there's no need for ``dataclasses.asdict`` (which recursively deep
+        copies every field of every row).
+        """
+        return dict(zip(self.__slots__, self.as_row()))
+
+    def as_row(self) -> tuple:
+        """ Serializes to a tuple, in the same order as the fields (and ``HEADERS``) """
+        return (
+            self.company_url,
+            self.company_name,
+            self.company_review_count,
+            self.company_rating,
+            self.company_categories,
+            self.review_rating,
+            self.review_title,
+            self.review_body,
+        )
+
+
+def normalize_text(string: str) -> str:
+    """
+    Review text the way we save it: every run of whitespace (line breaks included, since they'd break the csv) squashed
+    down to one space, and none at either end. The markup pads review text out with newlines and indentation that
+    the embedded json doesn't have, so every parser runs its text through this, and the same review comes out the same
+    no matter which one read it.
+    """
+    return " ".join(string.split())
+
+
+def review_key(title: str, body: str, rating) -> tuple:
+    """
+    What makes a review the same review. Ratings are compared as strings, since that's what we get back when we read
+    them out of a csv, and the text is normalized, so rows saved before the parsers normalized it still match.
+    """
+    return (normalize_text(title), normalize_text(body), str(rating))
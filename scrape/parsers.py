@@ -0,0 +1,394 @@
+"""
+Parsers that turn the html for a company's review page into ``Company`` and ``Review`` objects.
+
+There's three of these:
+
+    soup:   BeautifulSoup (on top of lxml), which is what we started out with. It builds a whole python tree for the
+            page, and then every ``find`` is a walk over that tree.
+
+    lxml:   lxml directly, with xpath. The tree stays in C and the xpath queries run in C too, so this should be a
+            good bit faster, but it's also easier to get subtly wrong, hence ``scripts/benchmark_parsers.py`` checks
+            both of these give back the exact same objects.
+
+    json:   When a page carries its reviews as structured data (a JSON-LD block, or the ``__NEXT_DATA__`` blob the
+            page hydrates from), we can cut that one script block out of the raw html with a regex and ``json.loads``
+            it, without building any tree at all. Pages without it (or where it isn't shaped like we expect) fall back
+            to the soup parser, and it keeps count of how often it got to skip the tree.
+
+All of them follow the same steps: ``parse`` the html into a document, then pull the ``company`` and/or the
+``reviews`` out of that document. Review text always goes through ``models.normalize_text``, so whichever parser
+read a review, it comes out exactly the same (and so does its key and fingerprint).
+"""
+
+import json
+import re
+import threading
+import time
+
+from bs4 import BeautifulSoup
+from lxml import etree
+from lxml import html as lxml_html
+
+import metrics
+from models import Company, Review, normalize_text
+
+RATING_MAP = {
+    "Excellent": 5,
+    "Great": 4,
+    "Average": 3,
+    "Poor": 2,
+    "Bad": 1,
+    "": 0,
+}
+
+
+def remove_whitespace(string: str):
+    """ Strip unwanted characters out of a string """
+    return re.sub(r"\s", "", string)
+
+
+def replace_breaks(string: str, replace_char=" "):
+    """ Replace line breaks with ``replace_char`` """
+    return string.replace("\n", replace_char).replace("\r", replace_char)
+
+
+def rating_from_src(src: str) -> int:
+    """ The star rating image is named like ``stars-4.svg``, so the last character before ``.svg`` is the rating """
+    return int(src.split("/")[-1].replace(".svg", "")[-1])
+
+
+def company_from_header(company_url: str, name: str, subheader_text: str) -> Company:
+    """
+    Build a company from the header text, which is the same no matter how we found it.
+
+    The subheader has a bunch of spaces in its body that we don't need, and i feel like there might be commas in the
+    review count, but i haven't found anything w/ 1k reviews so i'm just being cautious.
+    """
+    subheader_text = subheader_text.replace(",", "")
+    subheader_text = replace_breaks(subheader_text)
+    subheader_text = remove_whitespace(subheader_text)
+
+    # this is just assigns review_count to the first half and rating to the second
+    try:
+        review_count, rating = tuple(subheader_text.split("•"))
+    except ValueError:
+        return None
+    rating = RATING_MAP.get(rating, None)
+
+    categories = ""  # [link.text for link in category_holder.find_all("a")]
+
+    return Company(
+        url=company_url,
+        name=name,
+        categories=categories,
+        review_count=int(review_count),
+        rating=rating,
+    )
+
+
+class SoupParser(object):
+    """ Parses pages with BeautifulSoup """
+
+    name = "soup"
+
+    def __init__(self, features: str = "lxml"):
+        self.features = features
+
+    def parse(self, html: str) -> BeautifulSoup:
+        """ Build the soup for a page """
+        return BeautifulSoup(html, features=self.features)
+
+    def company(self, soup: BeautifulSoup, company_url: str) -> Company:
+        """ Populate a company object from a company page """
+        # The page header has the company name, and a subheader with the review count/rating
+        header = soup.find(attrs={"class": "header-section"})
+
+        try:
+            name = header.find(attrs={"class": "multi-size-header__big"}).text
+        except AttributeError:
+            print(f'Inactive page "{company_url}".')
+            return None
+
+        subheader_text = header.find(attrs={"class": "header--inline"}).text
+        return company_from_header(company_url, name, subheader_text)
+
+    def reviews(self, soup: BeautifulSoup, company_url: str) -> list:
+        """ Pull every review out of a review page """
+        reviews = list()
+
+        for review_element in soup.find_all(attrs={"class": "review"}):
+
+            # title and body can be found by class name
+            title = review_element.find(attrs={"class": "review-content__title"}).text
+            title = normalize_text(title)
+            # Sometimes there's no review body, so we'll pass '' instead
+            body = review_element.find(attrs={"class": "review-content__text"})
+            if not body:
+                body = ""
+            else:
+                # newlines in the body break the csv file and aren't necessary for this anyways, so they
+                # go, along with the markup's indentation
+                body = normalize_text(body.text)
+
+            rating_img = review_element.find(attrs={"class": "star-rating"}).find("img")
+            rating = rating_from_src(rating_img.attrs["src"])
+
+            reviews.append(
+                Review(company_url=company_url, title=title, body=body, rating=rating,)
+            )
+
+        return reviews
+
+
+def has_class(class_name: str) -> str:
+    """
+    Xpath predicate for "has ``class_name`` in its class list", which is what BeautifulSoup does when you
+    ``find(attrs={"class": class_name})``. A plain ``@class="..."`` would miss elements with more than one class.
+    """
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+class LxmlParser(object):
+    """ Parses pages with lxml and xpath, without building a BeautifulSoup tree """
+
+    name = "lxml"
+
+    # compiling these once saves re-parsing the xpath for every page
+    header_xpath = etree.XPath(f"(//*[{has_class('header-section')}])[1]")
+    name_xpath = etree.XPath(f"(.//*[{has_class('multi-size-header__big')}])[1]")
+    subheader_xpath = etree.XPath(f"(.//*[{has_class('header--inline')}])[1]")
+    review_xpath = etree.XPath(f"//*[{has_class('review')}]")
+    title_xpath = etree.XPath(f"(.//*[{has_class('review-content__title')}])[1]")
+    body_xpath = etree.XPath(f"(.//*[{has_class('review-content__text')}])[1]")
+    rating_xpath = etree.XPath(f"(.//*[{has_class('star-rating')}])[1]//img[1]/@src")
+
+    def parse(self, html: str):
+        """ Build the lxml tree for a page """
+        return lxml_html.fromstring(html)
+
+    def company(self, document, company_url: str) -> Company:
+        """ Populate a company object from a company page """
+        header = self.header_xpath(document)
+        name = self.name_xpath(header[0]) if header else []
+        if not name:
+            print(f'Inactive page "{company_url}".')
+            return None
+
+        subheader = self.subheader_xpath(header[0])
+        return company_from_header(
+            company_url, name[0].text_content(), subheader[0].text_content()
+        )
+
+    def reviews(self, document, company_url: str) -> list:
+        """ Pull every review out of a review page """
+        reviews = list()
+
+        for review_element in self.review_xpath(document):
+            title = normalize_text(self.title_xpath(review_element)[0].text_content())
+            body = self.body_xpath(review_element)
+            body = normalize_text(body[0].text_content()) if body else ""
+            rating = rating_from_src(self.rating_xpath(review_element)[0])
+
+            reviews.append(
+                Review(company_url=company_url, title=title, body=body, rating=rating,)
+            )
+
+        return reviews
+
+
+LD_JSON_PATTERN = re.compile(r"<script[^>]*type=[\"']application/ld\+json[\"'][^>]*>(.*?)</script>", re.S | re.I)
+NEXT_DATA_PATTERN = re.compile(r"<script[^>]*id=[\"']__NEXT_DATA__[\"'][^>]*>(.*?)</script>", re.S | re.I)
+
+
+def embedded_review(title, body, rating) -> tuple:
+    """ ``(title, body, rating)``, or ``None`` if any of them aren't what we'd expect to find """
+    if not isinstance(title, str) or not isinstance(body or "", str):
+        return None
+    try:
+        rating = int(rating)
+    except (TypeError, ValueError):
+        return None
+    if not 1 <= rating <= 5:
+        return None
+    return normalize_text(title), normalize_text(body or ""), rating
+
+
+def ld_json_nodes(data):
+    """ Every object in a JSON-LD document, however it's nested (lists, ``@graph``, properties) """
+    if isinstance(data, list):
+        for item in data:
+            yield from ld_json_nodes(item)
+    elif isinstance(data, dict):
+        yield data
+        for value in data.values():
+            if isinstance(value, (list, dict)):
+                yield from ld_json_nodes(value)
+
+
+def ld_json_reviews(data) -> list:
+    """ The reviews in a JSON-LD document, or ``None`` if it hasn't got any (or any of them look wrong) """
+    reviews = []
+    for node in ld_json_nodes(data):
+        types = node.get("@type")
+        if types != "Review" and not (isinstance(types, list) and "Review" in types):
+            continue
+        rating = node.get("reviewRating")
+        review = embedded_review(
+            node.get("headline", node.get("name")),
+            node.get("reviewBody"),
+            rating.get("ratingValue") if isinstance(rating, dict) else None,
+        )
+        if review is None:
+            return None
+        reviews.append(review)
+    return reviews or None
+
+
+def next_data_reviews(data) -> list:
+    """ The reviews in a ``__NEXT_DATA__`` blob, or ``None`` if they aren't where we expect """
+    try:
+        items = data["props"]["pageProps"]["reviews"]
+    except (KeyError, TypeError):
+        return None
+    if not isinstance(items, list) or not items:
+        return None
+    reviews = []
+    for item in items:
+        if not isinstance(item, dict):
+            return None
+        review = embedded_review(item.get("title"), item.get("text"), item.get("rating"))
+        if review is None:
+            return None
+        reviews.append(review)
+    return reviews
+
+
+def embedded_reviews(html: str) -> list:
+    """ ``(title, body, rating)`` for every review embedded in the page as json, or ``None`` if there aren't any """
+    for match in LD_JSON_PATTERN.finditer(html):
+        try:
+            reviews = ld_json_reviews(json.loads(match.group(1)))
+        except ValueError:
+            continue
+        if reviews is not None:
+            return reviews
+
+    match = NEXT_DATA_PATTERN.search(html)
+    if match:
+        try:
+            return next_data_reviews(json.loads(match.group(1)))
+        except ValueError:
+            pass
+    return None
+
+
+class EmbeddedPage(object):
+    """ What ``JsonParser.parse`` gives back: the html, whatever reviews were embedded in it, and a tree on demand """
+
+    __slots__ = ("html", "reviews", "document")
+
+    def __init__(self, html: str, reviews: list):
+        self.html = html
+        self.reviews = reviews
+        self.document = None
+
+
+class JsonParser(object):
+    """
+    Pulls reviews out of the json embedded in a page, falling back to ``fallback`` (the soup parser by default) when
+    there isn't any. The tree for the fallback only gets built if it's needed, so a page that has its reviews
+    embedded never gets one.
+    """
+
+    name = "json"
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback or SoupParser()
+        self.lock = threading.Lock()
+        # pages whose reviews came out of the embedded json, and pages that had to fall back
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, html: str) -> EmbeddedPage:
+        """ Cut the embedded reviews out of a page (no tree gets built here) """
+        return EmbeddedPage(html, embedded_reviews(html))
+
+    def document(self, page: EmbeddedPage):
+        """ The fallback parser's document for the page, built the first time it's needed """
+        if page.document is None:
+            page.document = self.fallback.parse(page.html)
+        return page.document
+
+    def company(self, page: EmbeddedPage, company_url: str) -> Company:
+        """ The company details we want aren't all in the embedded json, so this always goes to the fallback """
+        return self.fallback.company(self.document(page), company_url)
+
+    def reviews(self, page: EmbeddedPage, company_url: str) -> list:
+        """ Pull every review out of a review page, from the embedded json if it's got them """
+        self.record(page.reviews is not None)
+        return self.read_reviews(page, company_url)
+
+    def record(self, hit: bool):
+        """ Count a page as read from the embedded json (a hit), or as having fallen back (a miss) """
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.FAST_PATH.inc(result="hit" if hit else "miss")
+
+    def read_reviews(self, page: EmbeddedPage, company_url: str) -> list:
+        """ ``reviews``, without counting the hit or miss """
+        if page.reviews is None:
+            return self.fallback.reviews(self.document(page), company_url)
+        return [
+            Review(company_url=company_url, title=title, body=body, rating=rating)
+            for title, body, rating in page.reviews
+        ]
+
+    def hit_rate(self) -> float:
+        with self.lock:
+            return self.hits / max(self.hits + self.misses, 1)
+
+
+PARSERS = {
+    SoupParser.name: SoupParser,
+    LxmlParser.name: LxmlParser,
+    JsonParser.name: JsonParser,
+}
+
+
+def get_parser(name: str):
+    """ Get a parser by name (see ``PARSERS``) """
+    try:
+        return PARSERS[name]()
+    except KeyError:
+        raise ValueError(f'Unknown parser "{name}", pick one of {sorted(PARSERS)}.')
+
+
+# one of each parser per process, for ``parse_reviews_page``
+_process_parsers = dict()
+
+
+def parse_reviews_page(parser_name: str, company_url: str, content: bytes, encoding: str = None) -> tuple:
+    """
+    Parse the reviews out of a page's raw bytes, returning ``(reviews, seconds it took, fast path)``. This is what the
+    "pipeline" crawl engine runs in its parser processes, so it only takes (and gives back) things that pickle, and it
+    decodes the bytes here rather than in the crawler, so that's off the crawler's GIL too.
+
+    Counters in a parser process never make it back to the crawler, so rather than ``JsonParser`` counting its hit or
+    miss here, it's handed back (``None`` for the other parsers) for the crawler to ``record``.
+    """
+    started = time.perf_counter()
+    parser = _process_parsers.get(parser_name)
+    if parser is None:
+        parser = _process_parsers[parser_name] = get_parser(parser_name)
+    html = content.decode(encoding or "utf-8", errors="replace")
+    page = parser.parse(html)
+    if isinstance(parser, JsonParser):
+        fast_path = page.reviews is not None
+        reviews = parser.read_reviews(page, company_url)
+    else:
+        fast_path = None
+        reviews = parser.reviews(page, company_url)
+    return reviews, time.perf_counter() - started, fast_path
@@ -0,0 +1,221 @@
+"""
+Works out how hard we can hit trustpilot without getting throttled, instead of us guessing a thread count.
+
+There's three pieces to this:
+
+    RateController      how many requests we let be in flight at once. This goes up slowly while things are going
+                        well, and gets cut right down as soon as they're not (AIMD, same as tcp congestion control):
+
+                            - every good response adds ``1 / limit``, so the limit goes up by about 1 per round trip
+                            - a 429 or 5xx halves it, and so does latency getting way worse than the best we've seen
+                              (that's the server queueing us up, which comes right before it throttles us)
+                            - a ``Retry-After`` stops everything until it's passed
+
+    TokenBucket         a hard cap on requests per second to any one host, however high the limit gets
+
+    ControlledSession   wraps a ``requests.Session`` so every ``get`` goes through the two above, and retries 429s,
+                        5xxs and connection errors with jittered exponential backoff
+
+``settings.CRAWL_CONCURRENCY`` is still the most threads/tasks we'll ever have going, so it's the ceiling on the
+limit, but the limit finds its own way to wherever below that we can actually sustain.
+"""
+
+import email.utils
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+import metrics
+
+# Statuses that mean "slow down"
+THROTTLED = {429, 500, 502, 503, 504}
+
+
+def backoff(attempt: int, base: float = 0.5, cap: float = 60.0) -> float:
+    """ "Full jitter" exponential backoff: anywhere from 0 up to ``base * 2**attempt`` (capped) """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after(response) -> float:
+    """ How many seconds a ``Retry-After`` header tells us to wait (it can be seconds or a date), or ``None`` """
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket(object):
+    """ Allows ``rate`` requests a second, with bursts of up to ``burst`` """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until there's a token, then take it """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateController(object):
+    """ Decides how many requests can be in flight, and when (see above) """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        initial_limit: int = 4,
+        host_rate: float = 50.0,
+        host_burst: float = 10.0,
+        latency_factor: float = 3.0,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.latency_factor = latency_factor
+
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.last_decrease = 0.0
+        self.best_latency = None
+        self.buckets = dict()
+        self.condition = threading.Condition()
+
+        self.responses = 0
+        self.throttled = 0
+        self.decreases = 0
+
+    def bucket(self, host: str) -> TokenBucket:
+        with self.condition:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.host_rate, self.host_burst)
+            return self.buckets[host]
+
+    def acquire(self, host: str):
+        """ Block until we're allowed to send a request to ``host`` """
+        with self.condition:
+            while True:
+                paused = self.resume_at - time.monotonic()
+                if paused > 0:
+                    self.condition.wait(paused)
+                elif self.in_flight >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+        self.bucket(host).acquire()
+
+    def release(self, latency: float, status: int = None, wait: float = None):
+        """
+        A request finished, taking ``latency`` seconds. ``status`` is ``None`` if it didn't get a response at all.
+        ``wait`` is how long the server asked us to hold off for.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.responses += 1
+            now = time.monotonic()
+
+            if wait:
+                self.resume_at = max(self.resume_at, now + wait)
+
+            if status is None or status in THROTTLED:
+                self.throttled += 1
+                self.decrease(now, 0.5)
+            elif self.best_latency is not None and latency > self.best_latency * self.latency_factor:
+                self.decrease(now, 0.7)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            if status is not None and status < 400:
+                self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+
+            self.condition.notify_all()
+
+    def decrease(self, now: float, factor: float):
+        """
+        Cut the limit by ``factor``. Everything that was in flight when things went bad is going to report back bad
+        too, so we only cut once per round trip, otherwise one bad moment would take us all the way down to 1.
+        """
+        window = self.best_latency or 1.0
+        if now - self.last_decrease < window:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * factor)
+        self.decreases += 1
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "responses": self.responses,
+                "throttled": self.throttled,
+                "decreases": self.decreases,
+                "best_latency": self.best_latency,
+            }
+
+
+class ControlledSession(object):
+    """ A ``requests.Session`` whose ``get`` goes through a ``RateController`` and retries """
+
+    def __init__(self, session: requests.Session, controller: RateController, max_retries: int = 5):
+        self.session = session
+        self.controller = controller
+        self.max_retries = max_retries
+        self.retries = 0
+
+    def __getattr__(self, name):
+        # anything we don't wrap (headers, mount, close...) goes straight to the session
+        return getattr(self.session, name)
+
+    def get(self, url: str, **kwargs):
+        host = urlsplit(url).netloc
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+                metrics.RETRIES.inc()
+
+            self.controller.acquire(host)
+            started = time.monotonic()
+            try:
+                response = self.session.get(url, **kwargs)
+            except requests.RequestException:
+                self.controller.release(time.monotonic() - started)
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(backoff(attempt))
+                continue
+
+            wait = retry_after(response) if response.status_code in THROTTLED else None
+            self.controller.release(time.monotonic() - started, response.status_code, wait)
+
+            if response.status_code not in THROTTLED or attempt == self.max_retries:
+                return response
+            # Retry-After already holds everyone up in ``acquire``, but we back off on top of it so all the retries
+            # don't land at the same moment it runs out
+            time.sleep(backoff(attempt))
+
+        return response
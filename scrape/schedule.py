@@ -0,0 +1,287 @@
+"""
+Works out what order to crawl the companies in (and how to cut them up), so the whole crawl finishes as soon as it can.
+
+Crawling in ``companies.txt`` order means a company with tens of thousands of reviews can turn up near the end, and
+then every other worker sits around while one works through it. So instead, this:
+
+1. estimates how many pages every company has, from the review counts in the crawl state. Companies we haven't got a
+   count for get the median of the ones we have, or ``--probe`` fetches their first page to find out.
+2. splits any company with more pages than one worker should be doing on its own into page-range jobs
+3. hands the jobs out biggest first, each to whichever worker's least busy (longest processing time first, or LPT)
+
+LPT's makespan (the time from the first job starting to the last one finishing) is never more than 4/3 of the best
+possible, and usually a lot closer. ``plan`` prints what it predicts next to what crawling in order would take, and
+with ``--enqueue`` adds the jobs to the work queue (see work_queue.py) with their size as their priority, so workers
+pulling from the queue take the biggest first, which is LPT done as the workers free up. Once the crawl's done,
+``report`` compares the prediction with how long it actually took.
+
+Sizes are in page fetches, since that's what a crawl spends its time on. Give ``--seconds-per-page`` (or run
+``report`` after a crawl, which works it out) to see them as times.
+
+Usage (from the repo root):
+
+    python scrape/schedule.py plan --workers 8 --enqueue
+    python scrape/schedule.py report
+"""
+
+import argparse
+import heapq
+import math
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import settings
+from crawl_state import CrawlState
+from work_queue import WorkQueue, open_queue
+
+
+@dataclass
+class PlannedJob(object):
+    """ A company, or a range of its pages, and how many pages that is """
+
+    company_url: str
+    pages: int
+    first_page: int = None
+    last_page: int = None
+
+    @property
+    def cost(self) -> int:
+        # every job fetches the company's first page for its details before it gets on with its own pages
+        return self.pages + 1
+
+    def as_queue_job(self) -> dict:
+        return {
+            "company_url": self.company_url,
+            "first_page": self.first_page,
+            "last_page": self.last_page,
+            "priority": self.cost,
+        }
+
+    def __str__(self):
+        if self.last_page is not None:
+            return f"{self.company_url}?pages={self.first_page}-{self.last_page}"
+        return self.company_url
+
+
+def page_count(review_count: int) -> int:
+    return review_count // settings.REVIEWS_PER_PAGE + 1
+
+
+def estimate_pages(urls: list, review_counts: dict) -> tuple:
+    """
+    ``({url: pages}, how many were guessed)``. Anything not in ``review_counts`` gets the median of the counts we've
+    got for ``urls`` (or for every company, if we've got none of those), which is a better guess than the mean, since
+    a few huge companies drag that way up.
+    """
+    known = sorted(review_counts[url] for url in urls if url in review_counts) or sorted(review_counts.values())
+    median = known[len(known) // 2] if known else 0
+    pages = {url: page_count(review_counts.get(url, median)) for url in urls}
+    return pages, sum(1 for url in urls if url not in review_counts)
+
+
+def probe_review_counts(urls: list, workers: int) -> dict:
+    """
+    Fetch the first page of each of ``urls`` for its review count. Returns ``{url: review count}``, with ``None`` for
+    inactive companies, and leaves out anything that failed.
+    """
+    from get_reviews import CompanyPageCrawler
+
+    crawler = CompanyPageCrawler()
+
+    def probe(url):
+        try:
+            _, document = crawler.fetch_soup(url)
+            company = crawler.parser.company(document, url)
+        except Exception as e:
+            print(f"Couldn't probe {url}: {e!r}")
+            return url, False
+        return url, company.review_count if company else None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return {url: count for url, count in pool.map(probe, urls) if count is not False}
+
+
+def split_limit(pages: dict, workers: int, max_pages: int = None) -> int:
+    """
+    The most pages any one job should have: ``max_pages``, or less if that's more than a worker's fair share of the
+    whole crawl, since one job bigger than that would be the makespan all on its own.
+    """
+    max_pages = max_pages or settings.SCHEDULE_MAX_PAGES_PER_JOB
+    fair_share = math.ceil(sum(pages.values()) / max(workers, 1))
+    return max(1, min(max_pages, fair_share))
+
+
+def split_jobs(pages: dict, max_pages: int) -> list:
+    """ A job per company, except companies with more than ``max_pages`` pages, which get a job per range of pages """
+    jobs = []
+    for url, count in pages.items():
+        if count <= max_pages:
+            jobs.append(PlannedJob(url, count))
+            continue
+        for first in range(1, count + 1, max_pages):
+            last = min(first + max_pages - 1, count)
+            jobs.append(PlannedJob(url, last - first + 1, first, last))
+    return jobs
+
+
+def assign(costs: list, workers: int) -> list:
+    """ Hand out ``costs`` in order, each to whichever worker's least busy. Returns how busy each worker ends up. """
+    loads = [(0, worker) for worker in range(max(workers, 1))]
+    for cost in costs:
+        load, worker = heapq.heappop(loads)
+        heapq.heappush(loads, (load + cost, worker))
+    return sorted(load for load, _ in loads)
+
+
+def makespan(costs: list, workers: int) -> float:
+    """ When the last worker finishes, handing out ``costs`` in order """
+    return assign(costs, workers)[-1]
+
+
+def lpt_makespan(costs: list, workers: int) -> float:
+    """ When the last worker finishes, handing out ``costs`` biggest first """
+    return makespan(sorted(costs, reverse=True), workers)
+
+
+def lower_bound(costs: list, workers: int) -> float:
+    """ No schedule can beat this: everyone busy the whole time, or the biggest job on its own """
+    return max(max(costs, default=0), sum(costs) / max(workers, 1))
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 120:
+        return f"{seconds:.1f}s"
+    minutes = int(seconds // 60)
+    return f"{minutes // 60}h{minutes % 60:02d}m"
+
+
+def format_cost(cost: float, seconds_per_page: float = None) -> str:
+    if not seconds_per_page:
+        return f"{cost:,.0f} pages"
+    return f"{cost:,.0f} pages ({format_duration(cost * seconds_per_page)})"
+
+
+def plan(
+    urls: list,
+    state: CrawlState,
+    workers: int,
+    max_pages: int = None,
+    probe: bool = False,
+    probe_workers: int = 16,
+    seconds_per_page: float = None,
+) -> list:
+    """ Work out the jobs for ``urls``, print what they should take (and what they'd take in order), and return them """
+    review_counts = state.review_counts()
+    if probe:
+        unknown = [url for url in urls if url not in review_counts]
+        probed = probe_review_counts(unknown, probe_workers)
+        inactive = {url for url, count in probed.items() if count is None}
+        state.mark_inactive(inactive)
+        state.set_review_counts({url: count for url, count in probed.items() if count is not None})
+        review_counts = state.review_counts()
+        urls = [url for url in urls if url not in inactive]
+        print(f"Probed {len(probed)} of {len(unknown)} companies we didn't have a review count for")
+
+    pages, guessed = estimate_pages(urls, review_counts)
+    limit = split_limit(pages, workers, max_pages)
+    jobs = split_jobs(pages, limit)
+    split = sum(1 for count in pages.values() if count > limit)
+
+    in_order = [count + 1 for count in pages.values()]
+    costs = [job.cost for job in jobs]
+    lpt = lpt_makespan(costs, workers)
+    naive = makespan(in_order, workers)
+    print(
+        f"{len(urls)} companies ({guessed} estimated), {sum(pages.values()):,} pages, {workers} workers. "
+        f"Split {split} companies over {limit} pages into {len(jobs) - len(urls) + split} page-range jobs."
+    )
+    print(f"    in order, whole companies:  {format_cost(naive, seconds_per_page)}")
+    print(
+        f"    LPT, split:                 {format_cost(lpt, seconds_per_page)}, "
+        f"{(1 - lpt / max(naive, 1)) * 100:.0f}% shorter"
+    )
+    print(f"    lower bound:                {format_cost(lower_bound(costs, workers), seconds_per_page)}")
+    return sorted(jobs, key=lambda job: job.cost, reverse=True)
+
+
+def report(work_queue: WorkQueue, state: CrawlState):
+    """
+    How long the jobs in ``work_queue`` actually took, next to what LPT would have predicted for them, with the
+    seconds per page worked out from the jobs themselves. Only counts each job's last attempt.
+    """
+    finished = work_queue.finished_jobs()
+    if not finished:
+        print("Nothing's finished yet")
+        return
+
+    costs = []
+    for job, _, _, _ in finished:
+        company = None if job.is_page_range else state.company(job.company_url)
+        if job.is_page_range:
+            costs.append(job.last_page - job.first_page + 2)
+        elif company and company["page_count"] is not None:
+            costs.append(company["page_count"] + 1)
+        else:
+            # not crawled into the crawl state (e.g. it was done on another host), so go with what it was planned as
+            costs.append(max(job.priority, 1))
+
+    workers = len({worker for _, worker, _, _ in finished})
+    started = min(started for _, _, started, _ in finished)
+    ended = max(finished_at for _, _, _, finished_at in finished)
+    busy = sum(finished_at - started_at for _, _, started_at, finished_at in finished)
+    actual = ended - started
+    seconds_per_page = busy / sum(costs)
+    predicted = lpt_makespan(costs, workers) * seconds_per_page
+
+    print(
+        f"{len(finished)} jobs, {sum(costs):,} pages, {workers} workers, "
+        f"{seconds_per_page * 1000:.0f}ms a page per worker"
+    )
+    print(f"    predicted makespan (LPT):   {format_duration(predicted)}")
+    print(f"    actual makespan:            {format_duration(actual)} ({actual / max(predicted, 1e-9):.2f}x predicted)")
+    print(f"    workers busy:               {busy / max(actual * workers, 1e-9) * 100:.0f}% of the time")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Plan the crawl biggest companies first, and see how it went")
+    arg_parser.add_argument("--queue", help="work queue database path, settings.WORK_QUEUE_PATH by default")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = commands.add_parser("plan", help="work out the jobs, and what they should take")
+    plan_parser.add_argument("--workers", type=int, required=True, help="how many workers will be crawling")
+    plan_parser.add_argument("--companies", help="a file of company urls (what's left in the crawl state otherwise)")
+    plan_parser.add_argument("--max-pages", type=int, help="split companies with more pages than this")
+    plan_parser.add_argument("--probe", action="store_true", help="fetch review counts we haven't got")
+    plan_parser.add_argument("--probe-workers", type=int, default=16)
+    plan_parser.add_argument("--seconds-per-page", type=float, help="to show times as well as pages")
+    plan_parser.add_argument("--top", type=int, default=10, help="show this many of the biggest jobs")
+    plan_parser.add_argument(
+        "--enqueue", action="store_true", help="add the jobs to the work queue (best on a fresh one, see --queue)"
+    )
+
+    commands.add_parser("report", help="predicted against actual makespan, for what's done in the work queue")
+    args = arg_parser.parse_args()
+
+    crawl_state = CrawlState()
+    if args.command == "plan":
+        if args.companies:
+            with open(args.companies) as f:
+                company_urls = [line.strip() for line in f if line.strip()]
+        else:
+            company_urls = crawl_state.remaining_companies()
+        planned = plan(
+            company_urls,
+            crawl_state,
+            args.workers,
+            args.max_pages,
+            args.probe,
+            args.probe_workers,
+            args.seconds_per_page,
+        )
+        for planned_job in planned[: args.top]:
+            print(f"    {format_cost(planned_job.cost, args.seconds_per_page):>24}  {planned_job}")
+        if args.enqueue:
+            added = open_queue(args.queue).add([planned_job.as_queue_job() for planned_job in planned])
+            print(f"Added {added} jobs to the work queue")
+    elif args.command == "report":
+        report(WorkQueue(args.queue), crawl_state)
@@ -0,0 +1,48 @@
+"""
+Pooled http sessions for talking to trustpilot.
+
+A bare ``requests.get`` opens (and throws away) a brand new connection every time, which means a tcp + tls handshake
+for every page of 20 reviews. A ``requests.Session`` keeps connections alive and reuses them, so we build one here with
+a connection pool big enough for however many pages we've got in flight at once.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import settings
+
+try:
+    # requests (well, urllib3) only knows how to decode brotli if one of these is installed
+    import brotli  # noqa: F401
+
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+
+        ACCEPT_ENCODING = "gzip, deflate, br"
+    except ImportError:
+        ACCEPT_ENCODING = "gzip, deflate"
+
+
+def build_session(pool_size: int = None, pool_hosts: int = None) -> requests.Session:
+    """
+    Build a keep-alive session.
+
+    ``pool_size`` is how many connections we keep open per host, which should match crawl concurrency, otherwise
+    urllib3 opens extra connections and throws them away once the pool is full. ``pool_hosts`` is how many hosts we keep
+    pools for (we really only talk to trustpilot.com and www.trustpilot.com, after redirects).
+    """
+    pool_size = pool_size or settings.POOL_SIZE
+    pool_hosts = pool_hosts or settings.POOL_HOSTS
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_hosts, pool_maxsize=pool_size, pool_block=False
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(
+        {"Accept-Encoding": ACCEPT_ENCODING, "Connection": "keep-alive"}
+    )
+    return session
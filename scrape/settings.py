@@ -26,3 +26,74 @@ MAX_PAGE_LOAD_TIME = 0.1
 
 # Set this to however many reviews there are to a page
 REVIEWS_PER_PAGE = 20
+
+# How get_reviews crawls the review pages for a company. "log" just writes page urls to missing_pages.txt (for the
+# lambda to pick up), "threads", "asyncio" and "pipeline" crawl the pages right here.
+CRAWL_ENGINE = "log"
+
+# The most review pages we'll have in flight at once, no matter the engine
+CRAWL_CONCURRENCY = 50
+
+# The "pipeline" engine's stages: FETCH_WORKERS threads fetching pages, PARSE_WORKERS processes parsing them (so
+# parsing gets every core), and at most PIPELINE_QUEUE_SIZE pages waiting between one stage and the next
+FETCH_WORKERS = CRAWL_CONCURRENCY
+PARSE_WORKERS = os.cpu_count() or 1
+PIPELINE_QUEUE_SIZE = 4 * PARSE_WORKERS
+
+# Connections kept alive per host by the http session (see sessions.py). Anything less than CRAWL_CONCURRENCY means
+# some requests will open a connection just to throw it away.
+POOL_SIZE = CRAWL_CONCURRENCY
+
+# How many hosts we keep connection pools for
+POOL_HOSTS = 4
+
+# Which parser (see parsers.py) turns review pages into objects: "soup" for BeautifulSoup, "lxml" for lxml + xpath,
+# "json" for the reviews embedded in the page as json (falling back to "soup" when there aren't any)
+PARSER = "soup"
+
+# What reviews get written as: "csv", "csv.gz" (gzipped csv) or "parquet" (see columnar.py, needs pyarrow)
+OUTPUT_FORMAT = "csv"
+
+# The on-disk response cache (see http_cache.py). CACHE_MODE is one of "on", "revalidate", "offline" (re-parse what
+# we've already downloaded, without touching the network) or "off".
+CACHE_MODE = "off"
+CACHE_DIR = os.path.join(BASE_DIR, "http_cache")
+CACHE_MAX_BYTES = 5 * 2 ** 30
+
+# Let the rate controller (see rate_control.py) work out how many requests to have in flight, up to CRAWL_CONCURRENCY,
+# backing off and retrying when we get throttled
+RATE_CONTROL = True
+
+# Hard cap on requests per second to any one host (with bursts of up to HOST_BURST), no matter what the controller
+# thinks we can get away with
+HOST_RATE = 50.0
+HOST_BURST = 10
+
+# How many times we retry a request that got throttled, a 5xx or a connection error
+MAX_RETRIES = 5
+
+# Drop duplicate reviews before they're written (see dedupe.py), keeping the fingerprints of everything we've written
+# in DEDUPE_INDEX_PATH between runs
+DEDUPE = True
+DEDUPE_INDEX_PATH = os.path.join(BASE_DIR, "review_fingerprints.bin")
+
+# Where the crawl's metrics (see metrics.py) get exported, every 100 companies and at the end: appended as json lines,
+# and/or rewritten in prometheus' text format. Set either to None to skip it.
+METRICS_JSON_PATH = os.path.join(BASE_DIR, "metrics.jsonl")
+METRICS_PROMETHEUS_PATH = os.path.join(BASE_DIR, "metrics.prom")
+
+# The work queue (see work_queue.py) that ``get_reviews.py --queue`` crawls from. A worker's lease on a job runs out
+# WORK_QUEUE_LEASE_SECONDS after its last heartbeat (it sends one every WORK_QUEUE_HEARTBEAT_SECONDS), and a job that's
+# failed or been abandoned WORK_QUEUE_MAX_ATTEMPTS times is dead. Workers with nothing to do check back every
+# WORK_QUEUE_POLL_SECONDS, while anyone else still has a job that might fail and come back. A call to the queue that
+# fails (say the coordinator's restarting) gets tried WORK_QUEUE_RETRIES times, with backoff, before a worker gives up.
+WORK_QUEUE_PATH = os.path.join(BASE_DIR, "work_queue.sqlite3")
+WORK_QUEUE_LEASE_SECONDS = 300
+WORK_QUEUE_HEARTBEAT_SECONDS = 60
+WORK_QUEUE_MAX_ATTEMPTS = 3
+WORK_QUEUE_POLL_SECONDS = 15
+WORK_QUEUE_RETRIES = 8
+
+# The crawl scheduler (see schedule.py) splits any company with more pages than this into page-range jobs, so no one
+# job holds up the end of the crawl (it goes lower still when that's more than a worker's share of the whole crawl)
+SCHEDULE_MAX_PAGES_PER_JOB = 500
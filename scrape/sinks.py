@@ -0,0 +1,233 @@
+"""
+Sinks that reviews get written to as they come in.
+
+Instead of collecting every review for a company and writing them all at the end (which, for companies with tens of
+thousands of reviews, means holding every one of them in memory a few times over), the crawler hands each page of
+``CompanyReviews`` to a sink as soon as it's parsed. The sink writes them out and forgets them, so we only ever hold
+about a page's worth of reviews.
+
+Every sink works the same way:
+
+    with CsvFileSink(path) as sink:
+        sink.write(page_of_company_reviews)
+"""
+
+import csv
+import gzip
+import io
+from dataclasses import fields
+
+from models import CompanyReviews
+
+HEADERS = [field.name for field in fields(CompanyReviews)]
+
+# S3 won't take multipart parts smaller than 5MB (other than the last one)
+MIN_PART_SIZE = 5 * 2 ** 20
+
+
+class ReviewSink(object):
+    """ Base class for somewhere to write ``CompanyReviews`` to, a page at a time """
+
+    def __init__(self):
+        self.rows_written = 0
+
+    def write(self, rows: list):
+        """ Write a batch of ``CompanyReviews`` """
+        raise NotImplementedError
+
+    def close(self):
+        """ Flush anything that's left and let go of the output """
+
+    def abort(self):
+        """ Give up on the output. By default we keep whatever's been written so far. """
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CsvFileSink(ReviewSink):
+    """
+    Writes reviews to a csv file. The file isn't created until there's something to write, so companies without any
+    reviews don't leave empty files around.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.file = None
+        self.writer = None
+
+    def open(self):
+        """ Open the file for writing """
+        return open(self.path, "w", newline="", encoding="utf-8")
+
+    def write(self, rows: list):
+        if not rows:
+            return
+        if self.file is None:
+            self.file = self.open()
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(HEADERS)
+        self.writer.writerows(row.as_row() for row in rows)
+        self.rows_written += len(rows)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class GzipCsvSink(CsvFileSink):
+    """ Writes reviews to a gzipped csv file """
+
+    def open(self):
+        return gzip.open(self.path, "wt", newline="", encoding="utf-8")
+
+
+class S3MultipartSink(ReviewSink):
+    """
+    Writes reviews as a csv to S3, using a multipart upload so we never have the whole file in memory. Rows get
+    buffered until there's ``part_size`` bytes of them, then that part is uploaded and the buffer starts over.
+
+    If everything fits in one part, we skip the multipart upload and just ``put_object`` it. Like ``CsvFileSink``,
+    nothing gets uploaded if there weren't any rows.
+    """
+
+    def __init__(
+        self,
+        s3,
+        bucket: str,
+        key: str,
+        part_size: int = MIN_PART_SIZE,
+        compress: bool = False,
+        **put_kwargs,
+    ):
+        super().__init__()
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.compress = compress
+        self.put_kwargs = put_kwargs
+        if compress:
+            self.put_kwargs.setdefault("ContentEncoding", "gzip")
+
+        self.upload_id = None
+        self.parts = []
+        # bytes in the parts we've already uploaded
+        self.uploaded_bytes = 0
+        # rows written since the last part was uploaded
+        self.pending = 0
+        self.buffer = io.BytesIO()
+        self.gzip = None
+        self.new_part()
+        # rows get written as text here, then encoded into the buffer. The header goes out with the first rows.
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(HEADERS)
+
+    def new_part(self):
+        """ Start a fresh buffer. Compressed parts are each their own gzip member, which gunzip reads back as one. """
+        self.buffer = io.BytesIO()
+        if self.compress:
+            self.gzip = gzip.GzipFile(fileobj=self.buffer, mode="wb")
+
+    def write(self, rows: list):
+        if not rows:
+            return
+        self.write_rows([row.as_row() for row in rows])
+
+    def write_rows(self, rows: list):
+        """ Write rows that are already tuples in ``HEADERS`` order (e.g. straight out of a csv reader) """
+        if not rows:
+            return
+        self.writer.writerows(rows)
+        self.rows_written += len(rows)
+        self.pending += len(rows)
+
+        encoded = self.text.getvalue().encode("utf-8")
+        self.text.seek(0)
+        self.text.truncate()
+        (self.gzip if self.gzip is not None else self.buffer).write(encoded)
+
+        if self.buffer.tell() >= self.part_size:
+            self.upload_part()
+
+    def finish_part(self) -> bytes:
+        """ Close off the current buffer and get its bytes """
+        if self.gzip is not None:
+            self.gzip.close()
+        return self.buffer.getvalue()
+
+    def upload_part(self):
+        """ Upload whatever's in the buffer as the next part """
+        if self.upload_id is None:
+            upload = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.put_kwargs
+            )
+            self.upload_id = upload["UploadId"]
+
+        part_number = len(self.parts) + 1
+        body = self.finish_part()
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.uploaded_bytes += len(body)
+        self.pending = 0
+        self.new_part()
+
+    @property
+    def size(self) -> int:
+        """ Roughly how big the object is so far (gzip holds a little back until its buffer's flushed) """
+        return self.uploaded_bytes + self.buffer.tell()
+
+    def close(self):
+        if not self.rows_written:
+            return
+
+        if self.upload_id is None:
+            # small enough to never need a multipart upload
+            self.s3.put_object(
+                Bucket=self.bucket, Key=self.key, Body=self.finish_part(), **self.put_kwargs
+            )
+            return
+
+        if self.pending:
+            self.upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        # a half-finished multipart upload sits around (and costs money) until it's aborted
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+
+
+def file_sink(path: str) -> ReviewSink:
+    """ Pick a file sink based on the extension of ``path`` """
+    if path.endswith(".parquet"):
+        # imported here, so pyarrow's only needed if we're actually writing parquet
+        from columnar import ParquetSink
+
+        return ParquetSink(path)
+    if path.endswith(".gz"):
+        return GzipCsvSink(path)
+    return CsvFileSink(path)
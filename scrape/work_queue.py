@@ -0,0 +1,447 @@
+"""
+A work queue for crawling from more than one machine, without going through SQS and the lambda.
+
+Every job is either a whole company, or a range of a company's pages (``first_page`` to ``last_page``). Workers claim
+the highest ``priority`` job there is, and get a lease on it, which they keep pushing back with heartbeats while they
+work. Job statuses go:
+
+    pending     waiting for a worker
+    leased      a worker's got it until ``lease_expires``
+    done        crawled and saved
+    dead        it's failed (or had its lease run out) ``MAX_ATTEMPTS`` times, see ``last_error``
+
+A worker that crashes (or loses its network, or gets killed) just stops heartbeating, so its lease runs out, and the
+next claim puts the job back to pending for someone else, or to dead if that was its last attempt.
+
+There's two ways to get at the queue, with the same methods:
+
+    WorkQueue(path)             the sqlite database itself, for workers on the one machine
+    RemoteWorkQueue(url)        over http, to a coordinator running ``python scrape/work_queue.py serve``, for workers
+                                anywhere else (sqlite's locking can't be trusted over a network filesystem)
+
+``open_queue`` picks the right one for a path or a url.
+
+Usage (from the repo root):
+
+    python scrape/work_queue.py add scrape/missing_companies.txt
+    python scrape/work_queue.py serve --port 8700
+    python scrape/get_reviews.py --queue http://<coordinator>:8700      (on as many hosts as you like)
+    python scrape/work_queue.py status
+"""
+
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    company_url TEXT NOT NULL,
+    first_page INTEGER,
+    last_page INTEGER,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    last_error TEXT,
+    started REAL,
+    finished REAL,
+    updated REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_pages ON jobs (company_url, IFNULL(first_page, 0), IFNULL(last_page, 0));
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority DESC, id);
+CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (status, lease_expires);
+"""
+
+
+# the columns that make up a ``Job``
+JOB_COLUMNS = ("id", "company_url", "first_page", "last_page", "priority", "attempts")
+
+
+@dataclass
+class Job(object):
+    """ A company (or some of its pages) for a worker to crawl """
+
+    id: int
+    company_url: str
+    first_page: int = None
+    last_page: int = None
+    priority: int = 0
+    attempts: int = 0
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row):
+        return cls(**{name: row[name] for name in JOB_COLUMNS})
+
+    @property
+    def is_page_range(self) -> bool:
+        return self.last_page is not None
+
+    def __str__(self):
+        if self.is_page_range:
+            return f"{self.company_url}?pages={self.first_page}-{self.last_page}"
+        return self.company_url
+
+
+def default_worker() -> str:
+    """ A name for this process that no other worker will have """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue(object):
+    """
+    The queue's sqlite database. Safe to share between threads, and between processes on the same machine: every
+    change happens in an ``IMMEDIATE`` transaction, so two workers can never claim the same job.
+    """
+
+    def __init__(self, path: str = None, max_attempts: int = None):
+        self.path = path or settings.WORK_QUEUE_PATH
+        self.max_attempts = max_attempts or settings.WORK_QUEUE_MAX_ATTEMPTS
+        self.lock = threading.Lock()
+        # we manage the transactions ourselves (see ``transaction``), and wait a while for other processes' to finish
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        """ Add any columns that came along after the database was made """
+        columns = {row["name"] for row in self.connection.execute("PRAGMA table_info(jobs)")}
+        for column in ("started", "finished"):
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} REAL")
+
+    @contextmanager
+    def transaction(self):
+        """ Take the database's write lock up front, so nothing can change between our reads and our writes """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, jobs: list) -> int:
+        """
+        Add jobs (dicts of ``company_url``, and optionally ``first_page``, ``last_page`` and ``priority``), leaving
+        any we've already got alone. Returns how many were new.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            before = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO jobs (company_url, first_page, last_page, priority, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    (job["company_url"], job.get("first_page"), job.get("last_page"), job.get("priority", 0), now)
+                    for job in jobs
+                    if job.get("company_url")
+                ),
+            )
+            return connection.total_changes - before
+
+    def add_companies(self, urls: list, priority: int = 0) -> int:
+        """ Add a whole-company job for each of ``urls`` """
+        return self.add([{"company_url": url, "priority": priority} for url in urls])
+
+    def expire_leases(self, connection: sqlite3.Connection, now: float):
+        """ Put every job whose lease has run out back to pending (or dead, if that was its last attempt) """
+        connection.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'dead' ELSE 'pending' END, "
+            "last_error = 'lease expired on ' || IFNULL(worker, '?'), worker = NULL, lease_expires = NULL, "
+            "updated = ? WHERE status = 'leased' AND lease_expires < ?",
+            (self.max_attempts, now, now),
+        )
+
+    def claim(self, worker: str, lease_seconds: float = None) -> Job:
+        """ Lease the highest priority job there is to ``worker``, or return ``None`` if there's nothing pending """
+        lease_seconds = lease_seconds or settings.WORK_QUEUE_LEASE_SECONDS
+        now = time.time()
+        with self.transaction() as connection:
+            self.expire_leases(connection, now)
+            row = connection.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE status = 'pending' ORDER BY priority DESC, id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                "started = ?, updated = ? WHERE id = ?",
+                (worker, now + lease_seconds, now, now, row["id"]),
+            )
+        return Job(**{**dict(row), "attempts": row["attempts"] + 1})
+
+    def heartbeat(self, job_id: int, worker: str, lease_seconds: float = None) -> bool:
+        """ Push ``worker``'s lease on a job back. ``False`` means it isn't ``worker``'s any more. """
+        lease_seconds = lease_seconds or settings.WORK_QUEUE_LEASE_SECONDS
+        now = time.time()
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (now + lease_seconds, now, job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id: int, worker: str) -> bool:
+        """
+        ``worker`` finished a job. ``False`` means its lease had already gone to someone else. Done jobs keep their
+        worker and when they were started, so ``finished_jobs`` can say how long everything actually took.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = 'done', lease_expires = NULL, last_error = NULL, finished = ?, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (now, now, job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, job_id: int, worker: str, error: str) -> bool:
+        """ ``worker`` couldn't do a job, so it goes back to pending, or to dead if it's out of attempts """
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'dead' ELSE 'pending' END, worker = NULL, "
+                "lease_expires = NULL, last_error = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (self.max_attempts, error, time.time(), job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def release(self, job_id: int, worker: str) -> bool:
+        """ Hand a job back without it counting as an attempt (e.g. when a worker's being shut down) """
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = 'pending', attempts = MAX(attempts - 1, 0), worker = NULL, "
+                "lease_expires = NULL, updated = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (time.time(), job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def retry_dead(self) -> int:
+        """ Give every dead job another ``max_attempts`` goes. Returns how many there were. """
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = 'pending', attempts = 0, updated = ? WHERE status = 'dead'", (time.time(),)
+            )
+            return cursor.rowcount
+
+    def counts(self) -> dict:
+        """ How many jobs are in each status (leases that have run out count as pending) """
+        with self.transaction() as connection:
+            self.expire_leases(connection, time.time())
+            rows = connection.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def finished_jobs(self) -> list:
+        """ ``(job, worker, started, finished)`` for every done job, in the order they finished """
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)}, worker, started, finished FROM jobs "
+                "WHERE status = 'done' AND finished IS NOT NULL ORDER BY finished"
+            ).fetchall()
+        return [(Job.from_row(row), row["worker"], row["started"], row["finished"]) for row in rows]
+
+    def dead_jobs(self) -> list:
+        """ ``(job, last error)`` for every dead job """
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)}, last_error FROM jobs WHERE status = 'dead' ORDER BY id"
+            ).fetchall()
+        return [(Job.from_row(row), row["last_error"]) for row in rows]
+
+
+# what the coordinator lets remote workers call, which is everything a worker needs (and ``add``, to fill it up)
+REMOTE_METHODS = ("add", "claim", "heartbeat", "complete", "fail", "release", "retry_dead", "counts")
+
+
+class RemoteWorkQueue(object):
+    """ A ``WorkQueue`` on the other end of ``serve``. Only has the methods in ``REMOTE_METHODS``. """
+
+    def __init__(self, url: str, timeout: float = 30):
+        import requests
+
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def call(self, method: str, **kwargs):
+        response = self.session.post(f"{self.url}/{method}", json=kwargs, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["result"]
+
+    def add(self, jobs: list) -> int:
+        return self.call("add", jobs=jobs)
+
+    def add_companies(self, urls: list, priority: int = 0) -> int:
+        return self.add([{"company_url": url, "priority": priority} for url in urls])
+
+    def claim(self, worker: str, lease_seconds: float = None) -> Job:
+        # our lease length rather than the coordinator's, since it's our heartbeats that have to keep up with it
+        lease_seconds = lease_seconds or settings.WORK_QUEUE_LEASE_SECONDS
+        job = self.call("claim", worker=worker, lease_seconds=lease_seconds)
+        return Job(**job) if job else None
+
+    def heartbeat(self, job_id: int, worker: str, lease_seconds: float = None) -> bool:
+        lease_seconds = lease_seconds or settings.WORK_QUEUE_LEASE_SECONDS
+        return self.call("heartbeat", job_id=job_id, worker=worker, lease_seconds=lease_seconds)
+
+    def complete(self, job_id: int, worker: str) -> bool:
+        return self.call("complete", job_id=job_id, worker=worker)
+
+    def fail(self, job_id: int, worker: str, error: str) -> bool:
+        return self.call("fail", job_id=job_id, worker=worker, error=error)
+
+    def release(self, job_id: int, worker: str) -> bool:
+        return self.call("release", job_id=job_id, worker=worker)
+
+    def retry_dead(self) -> int:
+        return self.call("retry_dead")
+
+    def counts(self) -> dict:
+        return self.call("counts")
+
+    def close(self):
+        self.session.close()
+
+
+def open_queue(address: str = None):
+    """ A ``RemoteWorkQueue`` for an http(s) url, otherwise a ``WorkQueue`` for the sqlite database at ``address`` """
+    address = address or settings.WORK_QUEUE_PATH
+    if address.startswith(("http://", "https://")):
+        return RemoteWorkQueue(address)
+    return WorkQueue(address)
+
+
+class Lease(object):
+    """
+    Keeps a worker's lease on a job alive while the ``with`` block runs, heartbeating every ``interval`` seconds from
+    a background thread. If a heartbeat finds the job's gone to someone else, ``lost`` gets set (the block carries on,
+    since there's no stopping a crawl half way through a page, but there's no point completing it afterwards).
+    """
+
+    def __init__(self, queue, job: Job, worker: str, interval: float = None, lease_seconds: float = None):
+        self.queue = queue
+        self.job = job
+        self.worker = worker
+        self.interval = interval or settings.WORK_QUEUE_HEARTBEAT_SECONDS
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    def beat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.job.id, self.worker, self.lease_seconds):
+                    print(f"Lost the lease on {self.job}")
+                    self.lost = True
+                    return
+            except Exception as e:
+                # the coordinator might just be restarting, and the lease has a while to run yet
+                print(f"Couldn't heartbeat {self.job}: {e!r}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+class QueueHandler(BaseHTTPRequestHandler):
+    """ ``POST /<method>`` with the method's arguments as a json object, for every method in ``REMOTE_METHODS`` """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        method = self.path.strip("/")
+        if method not in REMOTE_METHODS:
+            return self.respond(404, {"error": f"no such method {method!r}"})
+        try:
+            kwargs = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            result = getattr(self.server.queue, method)(**kwargs)
+        except (TypeError, ValueError, KeyError) as e:
+            return self.respond(400, {"error": repr(e)})
+        except sqlite3.OperationalError as e:
+            # most likely "database is locked", which is worth the worker trying again
+            return self.respond(503, {"error": repr(e)})
+        except Exception as e:
+            return self.respond(500, {"error": repr(e)})
+        if isinstance(result, Job):
+            result = asdict(result)
+        return self.respond(200, {"result": result})
+
+    def respond(self, status: int, body: dict):
+        encoded = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        # every heartbeat from every worker would be a lot of lines
+        pass
+
+
+def build_server(queue: WorkQueue, host: str = "0.0.0.0", port: int = 8700) -> ThreadingHTTPServer:
+    """ Build (but don't start) a coordinator for ``queue``. Port 0 picks a free port. """
+    server = ThreadingHTTPServer((host, port), QueueHandler)
+    server.daemon_threads = True
+    server.queue = queue
+    return server
+
+
+def read_urls(path: str) -> list:
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Fill, serve and keep an eye on the crawl's work queue")
+    arg_parser.add_argument("--queue", help="database path (or coordinator url), settings.WORK_QUEUE_PATH by default")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="add a whole-company job for every url in a file")
+    add.add_argument("urls_file")
+    add.add_argument("--priority", type=int, default=0)
+
+    serve = commands.add_parser("serve", help="run a coordinator, so workers on other hosts can use the queue")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=8700)
+
+    commands.add_parser("status", help="how many jobs are in each status, and why the dead ones died")
+    commands.add_parser("retry-dead", help="give every dead job another go")
+    args = arg_parser.parse_args()
+
+    if args.command == "serve":
+        server = build_server(WorkQueue(args.queue), args.host, args.port)
+        print(f"Serving the work queue on http://{args.host}:{server.server_address[1]}")
+        server.serve_forever()
+
+    work_queue = open_queue(args.queue)
+    if args.command == "add":
+        print(f"Added {work_queue.add_companies(read_urls(args.urls_file), args.priority)} jobs")
+    elif args.command == "status":
+        print(work_queue.counts())
+        if isinstance(work_queue, WorkQueue):
+            for job, error in work_queue.dead_jobs():
+                print(f"dead: {job} after {job.attempts} attempts: {error}")
+    elif args.command == "retry-dead":
+        print(f"Retrying {work_queue.retry_dead()} dead jobs")
@@ -0,0 +1,326 @@
+"""
+Benchmarks the crawl engines end to end against ``scripts/fake_trustpilot.py``, so we can see what a change does to
+throughput before pointing it at the real site.
+
+The stand-in runs in its own process, and so does each engine, so they aren't fighting over one GIL and each engine's
+peak memory is its own. Every engine crawls the same ``--companies`` companies, writing them out like a real crawl
+would, and for each one this reports:
+
+    pages/s         successful page fetches a second, over the whole run
+    p50/p99 ms      how long each request took (retries count as their own requests)
+    429s            how many times we got throttled
+    peak RSS MB     the most memory the engine's process used
+
+The engines are every ``CRAWL_ENGINE`` in ``get_reviews.CRAWL_ENGINES`` (other than "log", which doesn't crawl), plus
+"lambda": ``get_reviews_lambda``'s handler, fed the companies as SQS messages, with moto standing in for S3 and SQS
+(it's skipped if moto isn't installed).
+
+Usage (from the repo root):
+
+    python scripts/benchmark_crawlers.py --companies 100 --latency 80 --jitter 40 --max-rps 300
+"""
+
+import argparse
+import gzip
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+
+try:
+    import resource
+except ImportError:
+    # windows, where there's no getrusage, so peak RSS shows as "-"
+    resource = None
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(SCRIPTS_DIR, "..", "scrape"))
+LAMBDA_DIR = os.path.join(SCRIPTS_DIR, "..", "get_reviews_lambda")
+
+from fake_trustpilot import company_urls, serve  # noqa: E402
+
+
+class TimedSession(object):
+    """ Wraps a session to time every request that goes through it """
+
+    def __init__(self, session):
+        self.session = session
+        self.latencies = []
+        self.statuses = []
+        self.lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        started = time.perf_counter()
+        response = self.session.get(url, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.statuses.append(response.status_code)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def peak_rss_mb(who: str = "self") -> float:
+    """ Peak RSS of this process (or with ``who="children"``, its biggest child), or ``None`` without ``resource`` """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if who == "children" else resource.RUSAGE_SELF)
+    # ru_maxrss is in kB on linux
+    return usage.ru_maxrss / 2 ** 10
+
+
+def format_mb(value: float, width: int) -> str:
+    return f"{'-':>{width}}" if value is None else f"{value:>{width}.1f}"
+
+
+def summarize(engine: str, session: TimedSession, elapsed: float, reviews: int, errors: int) -> dict:
+    pages = sum(1 for status in session.statuses if status == 200)
+    return {
+        "engine": engine,
+        "pages": pages,
+        "pages_per_s": pages / max(elapsed, 1e-9),
+        "p50_ms": percentile(session.latencies, 0.50) * 1000,
+        "p99_ms": percentile(session.latencies, 0.99) * 1000,
+        "throttled": sum(1 for status in session.statuses if status == 429),
+        "reviews": reviews,
+        "errors": errors,
+        # the children's is the biggest of any child process we've waited on (so, the pipeline's parse workers, once
+        # its pool's shut down), not their total
+        "peak_rss_mb": peak_rss_mb(),
+        "children_rss_mb": peak_rss_mb("children"),
+    }
+
+
+def crawl_engines() -> list:
+    """ The engines ``get_reviews`` knows about that actually crawl """
+    with tempfile.TemporaryDirectory() as work_dir:
+        # get_reviews logs failed pages to missing_pages.txt in the working directory, which we don't want to touch
+        os.chdir(work_dir)
+        from get_reviews import CRAWL_ENGINES
+
+    return [engine for engine in CRAWL_ENGINES if engine != "log"]
+
+
+def run_engine(engine: str, base_url: str, companies: list, options: dict) -> dict:
+    """ Crawl ``companies`` from ``base_url`` with one of ``get_reviews``'s engines """
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        import settings
+
+        settings.BASE_URL = base_url
+        settings.CRAWL_ENGINE = engine
+        settings.CRAWL_CONCURRENCY = settings.POOL_SIZE = settings.FETCH_WORKERS = options["concurrency"]
+        settings.RATE_CONTROL = options["rate_control"]
+        settings.HOST_RATE = options["host_rate"] or settings.HOST_RATE
+        settings.PARSER = options["parser"] or settings.PARSER
+        settings.CACHE_MODE = "off"
+        settings.DEDUPE = False
+
+        from get_reviews import CompanyPageCrawler
+        from sessions import build_session
+
+        session = TimedSession(build_session(pool_size=options["concurrency"]))
+        crawler = CompanyPageCrawler(session=session)
+
+        reviews = errors = 0
+        started = time.perf_counter()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            for company_url in companies:
+                try:
+                    reviews += crawler.save_reviews_for_company(
+                        company_url, work_dir, company_url.replace("/review/", "") + ".csv"
+                    )
+                except Exception:
+                    errors += 1
+        elapsed = time.perf_counter() - started
+        # waits for the pipeline's parse workers to exit, so they're counted in RUSAGE_CHILDREN
+        crawler.close()
+
+    return summarize(engine, session, elapsed, reviews, errors)
+
+
+class LambdaContext(object):
+    """ Just enough of a lambda context for the handler """
+
+    def get_remaining_time_in_millis(self):
+        return 15 * 60 * 1000
+
+
+def run_lambda(base_url: str, companies: list, options: dict) -> dict:
+    """
+    Feed ``companies`` to the lambda handler as SQS messages, then keep feeding it whatever it sends back to the queue
+    (page ranges for big companies) until the queue's empty. Returns ``None`` if moto isn't installed.
+    """
+    try:
+        from moto import mock_aws
+    except ImportError:
+        return None
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ["POOL_SIZE"] = str(options["concurrency"])
+    os.environ["RECORD_WORKERS"] = str(min(10, options["concurrency"]))
+    sys.path.insert(0, LAMBDA_DIR)
+
+    with mock_aws():
+        import boto3
+
+        s3 = boto3.client("s3")
+        sqs = boto3.client("sqs")
+        s3.create_bucket(Bucket="benchmark")
+        queue_url = sqs.create_queue(QueueName="benchmark")["QueueUrl"]
+
+        import lambda_function
+
+        lambda_function.BASE_URL = base_url
+        lambda_function.S3_BUCKET = "benchmark"
+        lambda_function.SQS_ADDRESS = queue_url
+        session = TimedSession(lambda_function.build_session(options["concurrency"]))
+        lambda_function.crawler._session = session
+
+        def records(bodies):
+            return [
+                {"messageId": str(i), "body": body, "attributes": {"ApproximateReceiveCount": "1"}}
+                for i, body in enumerate(bodies)
+            ]
+
+        errors = 0
+        started = time.perf_counter()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            batches = [companies[i : i + 10] for i in range(0, len(companies), 10)]
+            while batches:
+                for batch in batches:
+                    response = lambda_function.lambda_handler({"Records": records(batch)}, LambdaContext())
+                    errors += len(response["batchItemFailures"])
+
+                # whatever the handler fanned out, 10 at a time like a real trigger would hand them over
+                batches = []
+                while True:
+                    messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get("Messages", [])
+                    if not messages:
+                        break
+                    batches.append([message["Body"] for message in messages])
+                    sqs.delete_message_batch(
+                        QueueUrl=queue_url,
+                        Entries=[
+                            {"Id": str(i), "ReceiptHandle": message["ReceiptHandle"]}
+                            for i, message in enumerate(messages)
+                        ],
+                    )
+        elapsed = time.perf_counter() - started
+
+        # every object is a (maybe gzipped) csv with a header row
+        reviews = 0
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket="benchmark"):
+            for item in page.get("Contents", []):
+                body = s3.get_object(Bucket="benchmark", Key=item["Key"])["Body"].read()
+                if item["Key"].endswith(".gz"):
+                    body = gzip.decompress(body)
+                reviews += max(0, body.count(b"\n") - 1)
+
+    return summarize("lambda", session, elapsed, reviews, errors)
+
+
+def in_process(context, target, args: tuple = ()):
+    """
+    Run ``target(*args)`` in a fresh process and return what it returns. Not a ``Pool``, since pool workers are daemons,
+    and daemons can't start processes of their own (which the "pipeline" engine does).
+    """
+    results = context.Queue()
+    process = context.Process(target=put_result, args=(results, target, args))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def put_result(results, target, args: tuple):
+    results.put(target(*args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--companies", type=int, default=50, help="how many companies every engine crawls")
+    parser.add_argument("--engines", nargs="+", help="engines to run (all of them by default)")
+    parser.add_argument("--concurrency", type=int, default=50, help="CRAWL_CONCURRENCY (and pool size)")
+    parser.add_argument("--no-rate-control", dest="rate_control", action="store_false")
+    parser.add_argument("--host-rate", type=float, help="HOST_RATE, if not the one in settings")
+    parser.add_argument("--latency", type=float, default=50, help="ms the stand-in holds every response")
+    parser.add_argument("--jitter", type=float, default=50, help="up to this many more ms, at random")
+    parser.add_argument("--max-rps", type=float, default=0, help="the stand-in 429s anything faster than this")
+    parser.add_argument("--throttle", type=float, default=0, help="fraction of requests the stand-in 429s anyway")
+    parser.add_argument("--max-reviews", type=int, default=2_000, help="most reviews any one company has")
+    parser.add_argument("--embedded-json", type=float, default=0, help="fraction of pages with JSON-LD reviews")
+    parser.add_argument("--parser", help="PARSER for the crawl engines, if not the one in settings")
+    args = parser.parse_args()
+
+    # fresh processes (not forks of this one), so every engine starts from the same place
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    server_options = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "max_rps": args.max_rps,
+        "throttle": args.throttle,
+        "max_reviews": args.max_reviews,
+        "embedded_json": args.embedded_json,
+    }
+    server = context.Process(target=serve, args=(server_options, ready), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{ready.get(timeout=30)}"
+
+    options = {
+        "concurrency": args.concurrency,
+        "rate_control": args.rate_control,
+        "host_rate": args.host_rate,
+        "parser": args.parser,
+    }
+    companies = company_urls(args.companies)
+
+    try:
+        engines = args.engines or in_process(context, crawl_engines) + ["lambda"]
+
+        runs = []
+        for engine in engines:
+            if engine == "lambda":
+                run = in_process(context, run_lambda, (base_url, companies, options))
+                if run is None:
+                    print("Skipping lambda, it needs moto (pip install moto).")
+                    continue
+            else:
+                run = in_process(context, run_engine, (engine, base_url, companies, options))
+            runs.append(run)
+    finally:
+        server.terminate()
+
+    print(
+        f"\n{args.companies} companies, latency {args.latency:.0f}+{args.jitter:.0f}ms, "
+        f"concurrency {args.concurrency}\n"
+    )
+    print(
+        f"{'engine':<10} {'pages':>7} {'pages/s':>8} {'p50 ms':>7} {'p99 ms':>7} {'429s':>6} "
+        f"{'reviews':>8} {'errors':>6} {'peak RSS MB':>11} {'child RSS MB':>12}"
+    )
+    for run in runs:
+        print(
+            f"{run['engine']:<10} {run['pages']:>7} {run['pages_per_s']:>8.1f} {run['p50_ms']:>7.0f} "
+            f"{run['p99_ms']:>7.0f} {run['throttled']:>6} {run['reviews']:>8} {run['errors']:>6} "
+            f"{format_mb(run['peak_rss_mb'], 11)} {format_mb(run['children_rss_mb'], 12)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
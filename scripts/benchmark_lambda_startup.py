@@ -0,0 +1,109 @@
+"""
+Measures what a cold start of ``get_reviews_lambda`` costs: how long each module takes to import (from
+``python -X importtime``), and how long the whole init takes, in a fresh interpreter each time, like a new lambda
+container gets.
+
+It's measured two ways:
+
+    lazy    just ``import lambda_function``, which is all a cold start does now
+    eager   ``boto3``, ``requests`` and ``bs4`` imported up front, plus the s3 and sqs clients built, which is what
+            a cold start used to do (and what the first invocation still pays for, once)
+
+If ``get_reviews_lambda/package`` exists (see ``deploy.ps1``), it's put on the path, so this measures the bundle that
+actually gets deployed.
+
+Usage (from the repo root):
+
+    python scripts/benchmark_lambda_startup.py --repeat 10 --top 15
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "get_reviews_lambda")
+
+SCENARIOS = {
+    "lazy": "import lambda_function",
+    "eager": (
+        "import boto3, requests, bs4\n"
+        "import lambda_function\n"
+        "lambda_function.client('s3'); lambda_function.client('sqs')"
+    ),
+}
+
+
+def environment() -> dict:
+    """ What a lambda would have: the bundle on the path, and enough config for boto3 to build clients offline """
+    env = dict(os.environ)
+    paths = [LAMBDA_DIR, os.path.join(LAMBDA_DIR, "package")]
+    env["PYTHONPATH"] = os.pathsep.join(paths + [env.get("PYTHONPATH", "")])
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    env.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    env.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    env.setdefault("S3_BUCKET", "benchmark")
+    return env
+
+
+def parse_importtime(stderr: str) -> dict:
+    """ ``{module: (self us, cumulative us)}`` from ``-X importtime`` output """
+    modules = dict()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(own), int(cumulative))
+    return modules
+
+
+def run(code: str, env: dict):
+    """ Run ``code`` in a fresh interpreter, returning ``(seconds, per module import times)`` """
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        cwd=LAMBDA_DIR,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - started
+    if result.returncode:
+        sys.exit(result.stderr)
+    return elapsed, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5, help="cold starts per scenario (medians get reported)")
+    parser.add_argument("--top", type=int, default=10, help="how many of the slowest top level packages to show")
+    args = parser.parse_args()
+
+    env = environment()
+    # one run that doesn't count, so we aren't measuring the disk cache warming up
+    run("import lambda_function", env)
+
+    for scenario, code in SCENARIOS.items():
+        totals = list()
+        cumulative = defaultdict(list)
+        for _ in range(args.repeat):
+            elapsed, modules = run(code, env)
+            totals.append(elapsed)
+            for name, (_, module_cumulative) in modules.items():
+                # only top level packages, since their cumulative time includes everything under them
+                if "." not in name:
+                    cumulative[name].append(module_cumulative)
+
+        interpreter, _ = run("pass", env)
+        print(f"\n{scenario}: {statistics.median(totals) * 1000:.0f}ms total init "
+              f"({interpreter * 1000:.0f}ms of that is the bare interpreter)")
+        slowest = sorted(cumulative.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+        for name, times in slowest[: args.top]:
+            print(f"    {name:<28} {statistics.median(times) / 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
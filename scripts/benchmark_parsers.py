@@ -0,0 +1,167 @@
+"""
+Benchmarks the parsers in ``scrape/parsers.py`` against each other on saved review pages.
+
+Once fetching is concurrent, parsing is where the crawler spends its cpu, so this reports how long each parser takes
+per page and how much memory it peaks at. It also checks every parser pulls the exact same ``Company``/``Review``
+objects out of every page, since a fast parser that's wrong isn't any use.
+
+Each parser runs in its own process, so one parser's peak memory doesn't leak into the next one's numbers.
+
+The "json" parser only takes a fast path when a page has its reviews embedded as json, so for it this also reports
+how many pages hit the fast path, and how much faster than the "soup" parser it was per page. Every parser
+normalizes its review text the same way, so its results have to match exactly too.
+
+Usage (from the repo root):
+
+    # save a few pages to benchmark against
+    python scripts/benchmark_parsers.py --fetch /review/www.amazon.com?page=1 /review/www.amazon.com?page=2
+
+    # or save them from the stand-in (scripts/fake_trustpilot.py --embedded-json 0.8)
+    python scripts/benchmark_parsers.py --base-url http://127.0.0.1:8765 --fetch /review/company-1.example
+
+    # and benchmark
+    python scripts/benchmark_parsers.py
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+from glob import glob
+from urllib.parse import quote
+
+try:
+    import resource
+except ImportError:
+    # not on windows, so max rss shows as "-" there
+    resource = None
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scrape"))
+
+import parsers  # noqa: E402
+
+PAGES_DIR = os.path.join("bench", "pages")
+
+
+def fetch_pages(urls: list, pages_dir: str, base_url: str = "https://trustpilot.com"):
+    """ Save each page in ``urls`` (relative to ``base_url``) to ``pages_dir`` """
+    import requests
+
+    os.makedirs(pages_dir, exist_ok=True)
+    for url in urls:
+        response = requests.get(base_url + url)
+        path = os.path.join(pages_dir, quote(url, safe="") + ".html")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(response.text)
+        print(f"Saved {url} to {path}")
+
+
+def company_url_for(path: str) -> str:
+    """ Saved pages are named after their (quoted) url, so we can recover the company url """
+    return os.path.basename(path).replace("%2F", "/").split("%3F")[0].replace(".html", "")
+
+
+def run_parser(name: str, paths: list, repeat: int) -> dict:
+    """ Parse every page ``repeat`` times with parser ``name``, and report how it went """
+    parser = parsers.get_parser(name)
+    pages = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            pages.append((company_url_for(path), f.read()))
+
+    results = []
+    tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        results = []
+        for company_url, html in pages:
+            document = parser.parse(html)
+            results.append(
+                (parser.company(document, company_url), parser.reviews(document, company_url))
+            )
+    elapsed = time.perf_counter() - started
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # the company only gets parsed off a company's first page, every other page is just its reviews
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for company_url, html in pages:
+            parser.reviews(parser.parse(html), company_url)
+    reviews_elapsed = time.perf_counter() - started
+
+    return {
+        "name": name,
+        # pages that got the fast path, for parsers that have one
+        "hit_rate": parser.hit_rate() if hasattr(parser, "hit_rate") else None,
+        "ms_per_page": elapsed * 1000 / (len(pages) * repeat),
+        "reviews_ms_per_page": reviews_elapsed * 1000 / (len(pages) * repeat),
+        # tracemalloc only sees python allocations, so lxml's C tree shows up in max rss instead
+        "python_peak_mb": python_peak / 2 ** 20,
+        # ru_maxrss is in kB on linux
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10 if resource else None,
+        "results": results,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("--pages-dir", default=PAGES_DIR, help="where saved pages live")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="times to parse every page")
+    arg_parser.add_argument(
+        "--parsers", nargs="+", default=sorted(parsers.PARSERS), help="parsers to compare"
+    )
+    arg_parser.add_argument("--fetch", nargs="+", metavar="URL", help="save these pages first")
+    arg_parser.add_argument("--base-url", default="https://trustpilot.com", help="where --fetch gets pages from")
+    args = arg_parser.parse_args()
+
+    if args.fetch:
+        fetch_pages(args.fetch, args.pages_dir, args.base_url)
+
+    paths = sorted(glob(os.path.join(args.pages_dir, "*.html")))
+    if not paths:
+        sys.exit(f"No saved pages in {args.pages_dir}, save some with --fetch first.")
+
+    # a fresh process per parser (rather than a fork of this one), so memory numbers start from the same place
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for name in args.parsers:
+        with context.Pool(1) as pool:
+            runs.append(pool.apply(run_parser, (name, paths, args.repeat)))
+
+    soup = next((run for run in runs if run["name"] == "soup"), None)
+
+    # "ms/page" is a company's first page (company + reviews), "reviews ms" every other page (just reviews)
+    print(f"{len(paths)} pages, {args.repeat} passes each\n")
+    print(
+        f"{'parser':<8} {'ms/page':>9} {'reviews ms':>11} {'vs soup':>8} {'fast path':>10} "
+        f"{'py peak MB':>11} {'max rss MB':>11}"
+    )
+    for run in runs:
+        speedup = f"{soup['reviews_ms_per_page'] / run['reviews_ms_per_page']:.1f}x" if soup else "-"
+        hit_rate = f"{run['hit_rate']:.0%}" if run["hit_rate"] is not None else "-"
+        max_rss = f"{run['max_rss_mb']:.1f}" if run["max_rss_mb"] is not None else "-"
+        print(
+            f"{run['name']:<8} {run['ms_per_page']:>9.2f} {run['reviews_ms_per_page']:>11.2f} {speedup:>8} "
+            f"{hit_rate:>10} {run['python_peak_mb']:>11.1f} {max_rss:>11}"
+        )
+
+    # every parser should've found exactly what the first one found, down to the whitespace
+    baseline = runs[0]
+    for run in runs[1:]:
+        mismatches = [
+            path
+            for path, expected, actual in zip(paths, baseline["results"], run["results"])
+            if expected != actual
+        ]
+        if mismatches:
+            print(f"\n{run['name']} disagrees with {baseline['name']} on {len(mismatches)} pages:")
+            print("\n".join(f"    {path}" for path in mismatches))
+        else:
+            print(f"\n{run['name']} matches {baseline['name']} on every page.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Benchmarks the record types in ``scrape/models.py`` against plain dataclasses (what they used to be): how many bytes
+each ``CompanyReviews`` takes, and how many rows a second we can turn into csv.
+
+The reviews are made up, but sized like real ones, for one company with ``--reviews`` of them (20k by default).
+
+Usage (from the repo root):
+
+    python scripts/benchmark_records.py --reviews 50000
+"""
+
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scrape"))
+
+from models import Company, CompanyReviews, Review  # noqa: E402
+from sinks import HEADERS  # noqa: E402
+
+
+@dataclass
+class DictCompanyReviews(object):
+    """ ``CompanyReviews`` the way it used to be, with a ``__dict__`` and ``asdict`` """
+
+    company_url: str
+    company_name: str
+    company_review_count: int
+    company_rating: int
+    company_categories: str
+    review_rating: int
+    review_title: str
+    review_body: str
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+WORDS = "great service fast delivery would recommend again terrible slow never ordered price quality".split()
+
+
+def make_reviews(company: Company, count: int) -> list:
+    """ ``count`` made up reviews, with titles and bodies about as long as real ones """
+    random.seed(0)
+    return [
+        Review(
+            company_url=company.url,
+            title=" ".join(random.choices(WORDS, k=5)),
+            body=" ".join(random.choices(WORDS, k=random.randint(10, 120))),
+            rating=random.randint(1, 5),
+        )
+        for _ in range(count)
+    ]
+
+
+def build(cls, company: Company, reviews: list):
+    """ Build a row per review, measuring how much memory the rows (not the strings they share) take """
+    tracemalloc.start()
+    started = time.perf_counter()
+    rows = [
+        cls(
+            company_url=company.url,
+            company_name=company.name,
+            company_categories=",".join(company.categories),
+            company_review_count=company.review_count,
+            company_rating=company.rating,
+            review_title=review.title,
+            review_body=review.body,
+            review_rating=review.rating,
+        )
+        for review in reviews
+    ]
+    elapsed = time.perf_counter() - started
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, size / len(rows), len(rows) / elapsed
+
+
+def serialize_dicts(rows: list) -> float:
+    """ How we used to write rows: ``asdict`` each one into a ``DictWriter`` """
+    f = io.StringIO()
+    writer = csv.DictWriter(f, HEADERS)
+    writer.writeheader()
+    started = time.perf_counter()
+    writer.writerows(row.as_dict() for row in rows)
+    return len(rows) / (time.perf_counter() - started)
+
+
+def serialize_rows(rows: list) -> float:
+    """ How we write them now: a tuple each, into a plain ``csv.writer`` """
+    f = io.StringIO()
+    writer = csv.writer(f)
+    writer.writerow(HEADERS)
+    started = time.perf_counter()
+    writer.writerows(row.as_row() for row in rows)
+    return len(rows) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--reviews", type=int, default=20_000)
+    args = parser.parse_args()
+
+    company = Company(
+        url="/review/www.example.com", name="Example", categories="", review_count=args.reviews, rating=4
+    )
+    reviews = make_reviews(company, args.reviews)
+
+    old_rows, old_bytes, old_build = build(DictCompanyReviews, company, reviews)
+    old_write = serialize_dicts(old_rows)
+    del old_rows
+    new_rows, new_bytes, new_build = build(CompanyReviews, company, reviews)
+    new_write = serialize_rows(new_rows)
+
+    print(f"{args.reviews} reviews for one company\n")
+    print(f"{'':<24} {'bytes/review':>12} {'built rows/s':>13} {'csv rows/s':>11}")
+    print(f"{'dataclass + asdict':<24} {old_bytes:>12.0f} {old_build:>13,.0f} {old_write:>11,.0f}")
+    print(f"{'slots + as_row':<24} {new_bytes:>12.0f} {new_build:>13,.0f} {new_write:>11,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""
+Rolls the lambda's small review objects in S3 up into a handful of big, gzipped, partitioned ones.
+
+The lambda writes an object per company (or per page range), so after a full crawl there's hundreds of thousands of
+tiny objects under ``reviews/``, and listing or reading them back means a request apiece. This reads them all (a pool
+of threads, since it's all waiting on S3) and writes their rows back out as:
+
+    compacted/<run>/<partition>/part-00000.csv.gz
+    compacted/<run>/<partition>/part-00001.csv.gz
+    ...
+    compacted/<run>/manifest.json
+    compacted/<run>/sources.txt.gz
+
+Each part is rolled over once it's about ``--target-mb`` (compressed). What goes in which partition is up to
+``--partition-by``:
+
+    rating      rating=1 ... rating=5, so training on just the 1 and 5 star reviews only reads those
+    url-hash    bucket=00 ... bucket=<--buckets - 1> by a hash of the company url, so every company's reviews are in
+                one place, and the buckets come out about the same size
+
+The manifest lists every part with its partition, row count and size, and ``sources.txt.gz`` every object that went
+into them, so ``--delete-sources`` (which only happens once the manifest's written) can't delete anything that
+wasn't compacted. ``find_missing_reviews.py --sync-s3`` reads the ``sources.txt.gz`` under ``compacted/`` as well as
+what's under ``reviews/``, so deleted sources still count as crawled (give it ``--compacted-prefix`` if you used
+``--output-prefix`` somewhere else).
+
+Objects whose header is missing some of the columns (the lambda's had a few over time) get blanks for those. Any
+without a single one we know aren't reviews, so they get skipped (and left alone by ``--delete-sources``), and listed
+in the manifest under ``skipped``. Rows with a different number of fields to their header are left out, and counted
+under ``rejected_rows`` by object. Their other rows still get compacted, but the object isn't counted as a source, so
+it's not deleted, and the rows we couldn't read aren't lost.
+
+Use ``--endpoint-url`` to run this against a local S3 stand-in (e.g. ``moto_server``) instead of the real thing.
+
+Usage (from the repo root):
+
+    python scripts/compact_reviews.py site-reviews --partition-by rating --target-mb 256
+"""
+
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scrape"))
+
+from sinks import HEADERS, S3MultipartSink  # noqa: E402
+
+URL_COLUMN = HEADERS.index("company_url")
+RATING_COLUMN = HEADERS.index("review_rating")
+
+# some review bodies are longer than the csv module's default limit
+csv.field_size_limit(2 ** 31 - 1)
+
+
+def source_keys(s3, bucket: str, prefix: str):
+    """ Every csv (gzipped or not) under ``prefix`` """
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            if item["Key"].endswith((".csv", ".csv.gz")):
+                yield item["Key"], item["Size"]
+
+
+def read_rows(s3, bucket: str, key: str) -> tuple:
+    """
+    ``(rows, rejected)``: the rows in an object, as tuples in ``HEADERS`` order (whatever order its header has them
+    in), with blanks for any columns it hasn't got, and how many rows were left out for not having as many fields as
+    the header. Raises ``ValueError`` if it hasn't got any of the columns.
+    """
+    response = s3.get_object(Bucket=bucket, Key=key)
+    body = response["Body"].read()
+    if key.endswith(".gz") or response.get("ContentEncoding") == "gzip":
+        body = gzip.decompress(body)
+
+    reader = csv.reader(io.StringIO(body.decode("utf-8"), newline=""))
+    header = next(reader, None)
+    if header is None:
+        return [], 0
+    if header == HEADERS:
+        columns = list(range(len(HEADERS)))
+    else:
+        columns = [header.index(name) if name in header else None for name in HEADERS]
+        if all(column is None for column in columns):
+            raise ValueError(f"none of the review columns in its header {header}")
+
+    rows = []
+    rejected = 0
+    for row in reader:
+        if len(row) == len(header):
+            rows.append(tuple("" if column is None else row[column] for column in columns))
+        elif row:
+            # (blank lines come through as empty rows, and aren't worth counting)
+            rejected += 1
+    return rows, rejected
+
+
+def read_rows_or_skip(s3, bucket: str, key: str) -> tuple:
+    """ ``read_rows``, or ``(None, 0)`` (and a message saying why) if the object can't be read as reviews """
+    try:
+        return read_rows(s3, bucket, key)
+    except (ValueError, csv.Error, gzip.BadGzipFile) as e:
+        # a header we don't know, or a body that isn't (gzipped) utf-8 csv. S3 errors still stop the compaction.
+        print(f"Skipping {key}: {e!r}", file=sys.stderr)
+        return None, 0
+
+
+def partitioner(partition_by: str, buckets: int):
+    """ A function from a row to the name of its partition """
+    if partition_by == "rating":
+        return lambda row: f"rating={row[RATING_COLUMN] or 'unknown'}"
+
+    width = len(str(buckets - 1))
+
+    def url_bucket(row):
+        digest = hashlib.blake2b(row[URL_COLUMN].encode("utf-8"), digest_size=8).digest()
+        return f"bucket={int.from_bytes(digest, 'little') % buckets:0{width}d}"
+
+    return url_bucket
+
+
+class PartitionWriter(object):
+    """ Writes one partition's rows to a series of gzipped parts, rolling over to a new part at ``target_bytes`` """
+
+    def __init__(self, s3, bucket: str, prefix: str, target_bytes: int):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.target_bytes = target_bytes
+        self.sink = None
+        self.parts = []
+
+    def write(self, rows: list):
+        if self.sink is None:
+            key = f"{self.prefix}/part-{len(self.parts):05d}.csv.gz"
+            self.sink = S3MultipartSink(self.s3, self.bucket, key, compress=True, ContentType="text/csv")
+        self.sink.write_rows(rows)
+        if self.sink.size >= self.target_bytes:
+            self.close()
+
+    def close(self):
+        if self.sink is None:
+            return
+        self.sink.close()
+        head = self.s3.head_object(Bucket=self.bucket, Key=self.sink.key)
+        self.parts.append({"key": self.sink.key, "rows": self.sink.rows_written, "bytes": head["ContentLength"]})
+        self.sink = None
+
+    def abort(self):
+        if self.sink is not None:
+            self.sink.abort()
+
+
+def compact(
+    s3,
+    bucket: str,
+    prefix: str,
+    output_prefix: str,
+    partition_by: str,
+    buckets: int,
+    target_bytes: int,
+    workers: int,
+) -> tuple:
+    """ Compact everything under ``prefix`` into ``output_prefix``, returning the manifest and the keys compacted """
+    partition_of = partitioner(partition_by, buckets)
+    writers = dict()
+    sources = []
+    skipped = []
+    rejected_rows = dict()
+    source_bytes = 0
+
+    keys = list(source_keys(s3, bucket, prefix))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # a chunk at a time, so we never hold more than a few objects' rows per thread
+            chunk_size = workers * 4
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start : start + chunk_size]
+                for (key, size), (rows, rejected) in zip(
+                    chunk, pool.map(lambda item: read_rows_or_skip(s3, bucket, item[0]), chunk)
+                ):
+                    if rows is None:
+                        skipped.append(key)
+                        continue
+                    partitions = dict()
+                    for row in rows:
+                        partitions.setdefault(partition_of(row), []).append(row)
+                    for partition, partition_rows in partitions.items():
+                        if partition not in writers:
+                            writers[partition] = PartitionWriter(
+                                s3, bucket, f"{output_prefix}/{partition}", target_bytes
+                            )
+                        writers[partition].write(partition_rows)
+                    if rejected:
+                        # the rows we could read are compacted, but the object isn't a source (so it's not deleted),
+                        # since the ones we couldn't would be gone for good
+                        print(f"{key}: left out {rejected} rows that don't match its header", file=sys.stderr)
+                        rejected_rows[key] = rejected
+                        continue
+                    sources.append(key)
+                    source_bytes += size
+                print(f"{min(start + chunk_size, len(keys))} of {len(keys)} objects read", file=sys.stderr)
+
+        for writer in writers.values():
+            writer.close()
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+    parts = [
+        {"partition": partition, **part}
+        for partition, writer in sorted(writers.items())
+        for part in writer.parts
+    ]
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "source_prefix": prefix,
+        "partition_by": partition_by,
+        "columns": HEADERS,
+        "source_objects": len(sources),
+        "source_bytes": source_bytes,
+        "rows": sum(part["rows"] for part in parts),
+        "bytes": sum(part["bytes"] for part in parts),
+        "parts": parts,
+        "sources": f"{output_prefix}/sources.txt.gz",
+        "skipped": skipped,
+        "rejected_rows": rejected_rows,
+    }, sources
+
+
+def delete_sources(s3, bucket: str, keys: list):
+    """ Delete ``keys``, 1000 at a time (the most ``delete_objects`` takes) """
+    for start in range(0, len(keys), 1000):
+        s3.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[start : start + 1000]], "Quiet": True},
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("bucket")
+    parser.add_argument("--prefix", default="reviews/", help="where the small objects are")
+    parser.add_argument("--output-prefix", help="where the compacted files go (compacted/<timestamp> by default)")
+    parser.add_argument("--partition-by", choices=["rating", "url-hash"], default="rating")
+    parser.add_argument("--buckets", type=int, default=16, help="how many url-hash partitions")
+    parser.add_argument("--target-mb", type=float, default=128, help="roll over to a new part at about this size")
+    parser.add_argument("--workers", type=int, default=32, help="objects read at once")
+    parser.add_argument("--delete-sources", action="store_true", help="delete the small objects afterwards")
+    parser.add_argument("--endpoint-url", help="S3 endpoint, for running against a local stand-in")
+    args = parser.parse_args()
+
+    import boto3
+
+    s3 = boto3.client("s3", endpoint_url=args.endpoint_url)
+    output_prefix = (args.output_prefix or time.strftime("compacted/%Y%m%dT%H%M%S", time.gmtime())).rstrip("/")
+
+    started = time.perf_counter()
+    manifest, sources = compact(
+        s3,
+        args.bucket,
+        args.prefix,
+        output_prefix,
+        args.partition_by,
+        args.buckets,
+        int(args.target_mb * 2 ** 20),
+        args.workers,
+    )
+    s3.put_object(
+        Bucket=args.bucket,
+        Key=manifest["sources"],
+        Body=gzip.compress("\n".join(sources).encode("utf-8")),
+        ContentType="text/plain",
+        ContentEncoding="gzip",
+    )
+    s3.put_object(
+        Bucket=args.bucket,
+        Key=f"{output_prefix}/manifest.json",
+        Body=json.dumps(manifest, indent=2).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+    print(
+        f"Compacted {manifest['source_objects']} objects ({manifest['source_bytes'] / 2 ** 20:.1f} MB) into "
+        f"{len(manifest['parts'])} parts ({manifest['bytes'] / 2 ** 20:.1f} MB, {manifest['rows']} rows) "
+        f"under {output_prefix}/ in {time.perf_counter() - started:.1f}s"
+    )
+    if manifest["skipped"]:
+        print(f"Skipped {len(manifest['skipped'])} objects that couldn't be read, see the manifest")
+    if manifest["rejected_rows"]:
+        print(
+            f"Left out {sum(manifest['rejected_rows'].values())} rows that didn't match their header, from "
+            f"{len(manifest['rejected_rows'])} objects that won't be deleted, see the manifest"
+        )
+
+    if args.delete_sources:
+        delete_sources(s3, args.bucket, sources)
+        print(f"Deleted {len(sources)} source objects")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Converts a folder of review csvs (``.csv`` or ``.csv.gz``) into one parquet file, then compares the two: how much
+space each takes, and how long it takes to load just ``review_body`` and ``review_rating`` (what training needs) out
+of each.
+
+Usage (from the repo root):
+
+    python scripts/csv_to_parquet.py bits/joined reviews.parquet
+"""
+
+import argparse
+import csv
+import gzip
+import os
+import sys
+import time
+from glob import glob
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scrape"))
+
+from columnar import ParquetSink, read_reviews  # noqa: E402
+
+TRAINING_COLUMNS = ["review_body", "review_rating"]
+
+# some review bodies are longer than the csv module's default limit
+csv.field_size_limit(2 ** 31 - 1)
+
+
+def open_csv(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", newline="", encoding="utf-8")
+    return open(path, newline="", encoding="utf-8")
+
+
+def csv_paths(directory: str) -> list:
+    return sorted(glob(os.path.join(directory, "*.csv")) + glob(os.path.join(directory, "*.csv.gz")))
+
+
+def convert(paths: list, output: str, row_group_size: int) -> int:
+    """ Stream every row of every csv into one parquet file """
+    with ParquetSink(output, row_group_size=row_group_size) as sink:
+        for path in paths:
+            with open_csv(path) as f:
+                try:
+                    sink.write_dicts(csv.DictReader(f))
+                except (csv.Error, KeyError, ValueError) as e:
+                    print(f"Skipping the rest of {path}: {e!r}")
+    return sink.rows_written
+
+
+def load_csvs(paths: list) -> int:
+    """ Load the training columns out of the csvs, like we'd have to without parquet """
+    bodies, ratings = [], []
+    for path in paths:
+        with open_csv(path) as f:
+            for row in csv.DictReader(f):
+                bodies.append(row["review_body"])
+                ratings.append(int(row["review_rating"]))
+    return len(bodies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("csv_dir")
+    parser.add_argument("output")
+    parser.add_argument("--row-group-size", type=int, default=100_000)
+    args = parser.parse_args()
+
+    paths = csv_paths(args.csv_dir)
+    if not paths:
+        sys.exit(f"No csvs in {args.csv_dir}")
+
+    started = time.perf_counter()
+    rows = convert(paths, args.output, args.row_group_size)
+    print(f"Converted {rows} rows from {len(paths)} files in {time.perf_counter() - started:.1f}s")
+
+    csv_bytes = sum(os.path.getsize(path) for path in paths)
+    parquet_bytes = os.path.getsize(args.output)
+
+    started = time.perf_counter()
+    load_csvs(paths)
+    csv_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    read_reviews(args.output, columns=TRAINING_COLUMNS).to_pydict()
+    parquet_seconds = time.perf_counter() - started
+
+    print(f"\n{'':<8} {'size MB':>9} {'load s':>8}")
+    print(f"{'csv':<8} {csv_bytes / 2 ** 20:>9.1f} {csv_seconds:>8.2f}")
+    print(f"{'parquet':<8} {parquet_bytes / 2 ** 20:>9.1f} {parquet_seconds:>8.2f}")
+    print(
+        f"\nparquet is {csv_bytes / max(parquet_bytes, 1):.1f}x smaller "
+        f"and loads {csv_seconds / max(parquet_seconds, 1e-9):.1f}x faster"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 Remove-Item ./get_reviews_lambda.zip;
+# Rebuild the bundle from requirements.txt, so nothing the lambda doesn't need sneaks in (boto3 comes with the runtime)
+Remove-Item -Recurse -Force ./get_reviews_lambda/package -ErrorAction SilentlyContinue;
+pip install -r ./get_reviews_lambda/requirements.txt -t ./get_reviews_lambda/package --no-compile --no-deps;
 7z u ./get_reviews_lambda.zip ./get_reviews_lambda/lambda_function.py;
-7z u ./get_reviews_lambda.zip ./get_reviews_lambda/package/*;
+# metadata, bytecode and tests are dead weight that every cold start has to download and unpack
+7z u ./get_reviews_lambda.zip ./get_reviews_lambda/package/* '-xr!*.dist-info' '-xr!__pycache__' '-xr!tests' '-xr!boto3' '-xr!botocore' '-xr!s3transfer';
 aws s3 cp ./get_reviews_lambda.zip s3://site-reviews/get_site_reviews.zip; 
 aws lambda update-function-code --function-name get_site_reviews --s3-bucket site-reviews --s3-key get_site_reviews.zip
-Remove-Item ./get_reviews_lambda.zip;
\ No newline at end of file
+Remove-Item ./get_reviews_lambda.zip;
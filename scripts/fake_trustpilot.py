@@ -0,0 +1,291 @@
+"""
+A stand-in for trustpilot.com, so we can measure (and break) the crawlers without going anywhere near the real site.
+
+It serves made up company review pages in the same markup the parsers in ``scrape/parsers.py`` (and the lambda's
+copy of them) look for. Everything about a company is worked out from its url, so the same url always gets the same
+page, and ``company_urls`` gives you the urls it knows about. Like the real site:
+
+    - a company has ``review_count // 20 + 1`` pages, and asking for a page past the last one redirects back to the
+      company's first page
+    - some companies are inactive: their page is live, but has no name in the header (``--inactive`` of them)
+    - some reviews don't have a body
+    - some pages (``--embedded-json`` of them) carry their reviews as JSON-LD as well
+
+And, so we can see how the crawlers cope:
+
+    --latency/--jitter      every response is held back this many ms (plus up to ``jitter`` more)
+    --max-rps               more requests a second than this get a 429 (with a Retry-After), like a rate limit
+    --throttle              this fraction of requests get a 429 at random, no matter how fast we're going
+    --gzip                  compress responses when asked to, which costs cpu on both ends like the real thing
+
+Usage (from the repo root):
+
+    python scripts/fake_trustpilot.py --port 8765 --latency 80 --max-rps 200
+
+then point ``settings.BASE_URL`` at http://127.0.0.1:8765. ``scripts/benchmark_crawlers.py`` does all of that for you.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+REVIEWS_PER_PAGE = 20
+RATING_WORDS = {1: "Bad", 2: "Poor", 3: "Average", 4: "Great", 5: "Excellent"}
+WORDS = (
+    "great service fast delivery would recommend again terrible slow never ordered price quality support refund "
+    "helpful rude package arrived late damaged friendly staff easy website checkout"
+).split()
+
+
+def company_urls(count: int) -> list:
+    """ The urls of the first ``count`` companies the stand-in knows about """
+    return [f"/review/company-{i}.example" for i in range(count)]
+
+
+def seed_for(*parts) -> int:
+    """ A stable seed for ``parts``, so every page comes out the same every time it's asked for """
+    text = "\x1f".join(str(part) for part in parts)
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class FakeSite(object):
+    """ Works out what's on every page of the stand-in """
+
+    def __init__(self, max_reviews: int = 5_000, inactive: float = 0.02, embedded_json: float = 0):
+        self.max_reviews = max_reviews
+        self.inactive = inactive
+        self.embedded_json = embedded_json
+
+    def company(self, company_url: str) -> dict:
+        """ The made up details for a company """
+        rng = random.Random(seed_for(company_url))
+        # most companies have a handful of reviews and a few have a ton, like the real site
+        review_count = int(rng.paretovariate(1.2) * 20) - 20
+        rating = rng.randint(1, 5)
+        return {
+            "name": company_url.split("/")[-1],
+            "review_count": min(review_count, self.max_reviews),
+            "rating": rating,
+            "inactive": rng.random() < self.inactive,
+        }
+
+    def page_count(self, company: dict) -> int:
+        return company["review_count"] // REVIEWS_PER_PAGE + 1
+
+    def reviews(self, company_url: str, company: dict, page: int) -> list:
+        """ ``(title, body, rating)`` for every review on ``page`` """
+        first = (page - 1) * REVIEWS_PER_PAGE
+        count = max(0, min(REVIEWS_PER_PAGE, company["review_count"] - first))
+        rng = random.Random(seed_for(company_url, page))
+        reviews = []
+        for _ in range(count):
+            rating = rng.randint(1, 5)
+            title = " ".join(rng.choices(WORDS, k=rng.randint(2, 7))).capitalize()
+            body = "" if rng.random() < 0.05 else " ".join(rng.choices(WORDS, k=rng.randint(8, 150)))
+            reviews.append((title, body, rating))
+        return reviews
+
+    def render(self, company_url: str, page: int) -> str:
+        """ The html for ``page`` of a company """
+        company = self.company(company_url)
+        if company["inactive"]:
+            return (
+                "<html><body><div class=\"header-section\"><p>This company's profile isn't active.</p></div>"
+                "</body></html>"
+            )
+
+        parts = [
+            "<html><head><title>Reviews</title></head><body>",
+            '<div class="header-section"><h1><span class="multi-size-header__big">',
+            escape(company["name"]),
+            '</span></h1><span class="header--inline">\n    ',
+            f"{company['review_count']:,}",
+            "\n    &bull;\n    ",
+            RATING_WORDS[company["rating"]],
+            "\n</span></div><section class=\"reviews\">",
+        ]
+        reviews = self.reviews(company_url, company, page)
+        if random.Random(seed_for(company_url, page, "json")).random() < self.embedded_json:
+            parts.append(self.ld_json(company, reviews))
+        for title, body, rating in reviews:
+            parts.append('<article class="review card"><div class="review-content">')
+            parts.append(
+                f'<div class="star-rating star-rating--medium"><img src="https://cdn.example/stars-{rating}.svg" '
+                f'alt="{rating} stars"></div>'
+            )
+            parts.append(f'<h2 class="review-content__title"><a href="#">{escape(title)}</a></h2>')
+            if body:
+                parts.append(f'<p class="review-content__text">\n            {escape(body)}\n        </p>')
+            parts.append("</div></article>")
+        parts.append("</section></body></html>")
+        return "".join(parts)
+
+    @staticmethod
+    def ld_json(company: dict, reviews: list) -> str:
+        """ A JSON-LD block with the company and its reviews, shaped like the ones review sites embed """
+        data = {
+            "@context": "https://schema.org",
+            "@graph": [
+                {
+                    "@type": "LocalBusiness",
+                    "name": company["name"],
+                    "aggregateRating": {"@type": "AggregateRating", "reviewCount": company["review_count"]},
+                    "review": [
+                        {
+                            "@type": "Review",
+                            "headline": title,
+                            "reviewBody": body,
+                            "reviewRating": {"@type": "Rating", "ratingValue": str(rating)},
+                        }
+                        for title, body, rating in reviews
+                    ],
+                }
+            ],
+        }
+        # "</" can't appear inside a script tag
+        encoded = json.dumps(data).replace("</", "<\\/")
+        return f'<script type="application/ld+json">{encoded}</script>'
+
+
+class Throttle(object):
+    """ Lets ``rate`` requests a second through (in bursts of up to ``rate``), and turns the rest away """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class Handler(BaseHTTPRequestHandler):
+    """ Serves ``server.site``, with whatever latency and throttling the server was started with """
+
+    # keep-alive, so pooled sessions actually get to reuse their connections
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        delay = server.latency + random.random() * server.jitter
+        if delay:
+            time.sleep(delay)
+
+        if (server.throttle and random.random() < server.throttle) or (
+            server.limiter and not server.limiter.allow()
+        ):
+            return self.respond(429, b"Too many requests", {"Retry-After": "1"})
+
+        parts = urlsplit(self.path)
+        if not parts.path.startswith("/review/"):
+            return self.respond(404, b"Not found")
+
+        company_url = parts.path
+        page = parse_qs(parts.query).get("page", ["1"])[0]
+        try:
+            page = int(page)
+        except ValueError:
+            return self.respond(404, b"Not found")
+
+        company = server.site.company(company_url)
+        if page > 1 and (company["inactive"] or page > server.site.page_count(company)):
+            # out of pages, so back to the start, like the real site
+            return self.respond(302, b"", {"Location": company_url})
+
+        body = server.site.render(company_url, page).encode("utf-8")
+        return self.respond(200, body, {"Content-Type": "text/html; charset=utf-8"})
+
+    def respond(self, status: int, body: bytes, headers: dict = None):
+        headers = dict(headers or {})
+        if server_gzips(self) and body:
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # a line per request would swamp whatever we're actually trying to look at
+        pass
+
+
+def server_gzips(handler: Handler) -> bool:
+    return handler.server.compress and "gzip" in handler.headers.get("Accept-Encoding", "")
+
+
+def build_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    latency: float = 0,
+    jitter: float = 0,
+    max_rps: float = 0,
+    throttle: float = 0,
+    inactive: float = 0.02,
+    max_reviews: int = 5_000,
+    embedded_json: float = 0,
+    compress: bool = False,
+) -> ThreadingHTTPServer:
+    """ Build (but don't start) the stand-in. ``latency`` and ``jitter`` are in ms. Port 0 picks a free port. """
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.site = FakeSite(max_reviews=max_reviews, inactive=inactive, embedded_json=embedded_json)
+    server.latency = latency / 1000
+    server.jitter = jitter / 1000
+    server.limiter = Throttle(max_rps) if max_rps else None
+    server.throttle = throttle
+    server.compress = compress
+    return server
+
+
+def serve(options: dict, ready=None):
+    """ Run the stand-in until killed, putting its port on ``ready`` (a queue) once it's listening """
+    server = build_server(**options)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0, help="ms to hold every response back")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this many more ms, at random")
+    parser.add_argument("--max-rps", type=float, default=0, help="429 anything faster than this (0 for no limit)")
+    parser.add_argument("--throttle", type=float, default=0, help="fraction of requests to 429 at random")
+    parser.add_argument("--inactive", type=float, default=0.02, help="fraction of companies that are inactive")
+    parser.add_argument("--max-reviews", type=int, default=5_000, help="most reviews any company has")
+    parser.add_argument(
+        "--embedded-json", type=float, default=0, help="fraction of pages that embed their reviews as JSON-LD"
+    )
+    parser.add_argument(
+        "--gzip", dest="compress", action="store_true", help="gzip responses when the client accepts it"
+    )
+    args = parser.parse_args()
+
+    options = vars(args)
+    server = build_server(**options)
+    print(f"Serving a fake trustpilot on http://{args.host}:{server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
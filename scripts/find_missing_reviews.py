@@ -1,30 +1,119 @@
 """
 So, the lambda timed out on some of the bigger scripts, plus some of the abnormal pages.
 This will identify which companies from companies.txt we're missing in ./reviews
+
+That used to mean globbing every csv and diffing it against companies.txt. Now everything lives in the crawl state
+(see ``scrape/crawl_state.py``), so this just:
+
+1. adds anything new in companies.txt to the crawl state
+2. optionally marks what's already been saved, either in a local reviews folder (``--import-dir``, only needed once
+   for files saved before the crawl state existed) or by the lambda in S3 (``--sync-s3``, which includes what
+   ``compact_reviews.py`` has rolled up)
+3. writes whatever's still left to missing_companies.txt
 """
 
+import argparse
+import gzip
 import os
+import re
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scrape"))
+
+from crawl_state import DEFAULT_PATH, CrawlState  # noqa: E402
+
+# the lambda names things reviews/<company>%3Fpage=<n>.csv or reviews/<company>%3Fpages=<first>-<last>.csv
+PAGES_PATTERN = re.compile(r"\?pages?=(\d+)(?:-(\d+))?$")
+
+
+def url_from_file_name(file_name: str) -> str:
+    """ Undo the escaping the crawler and the lambda do to urls when they name files """
+    name = os.path.basename(file_name)
+    name = re.sub(r"\.csv(\.gz)?$", "", name)
+    # I replaced / w/ __ in the lambda at first, then switched to url escaping
+    name = name.replace("%2F", "/").replace("%3F", "?").replace("%3D", "=").replace("__", "/")
+    return "/review/" + name
+
+
+def mark_saved(state: CrawlState, file_names):
+    """
+    Mark the companies/pages that ``file_names`` hold as done. A company saved a page range at a time is done once
+    all its pages are, which ``CrawlState.mark_pages`` takes care of as long as we know its review count.
+    """
+    count = 0
+    for file_name in file_names:
+        url = url_from_file_name(file_name)
+        match = PAGES_PATTERN.search(url)
+        if match:
+            first_page = int(match.group(1))
+            last_page = int(match.group(2) or first_page)
+            company_url = url[: match.start()]
+            state.add_companies([company_url])
+            state.mark_pages(company_url, range(first_page, last_page + 1), "done")
+        else:
+            state.finish_company(url)
+        count += 1
+    return count
+
+
+def s3_keys(bucket: str, prefix: str = "reviews/", endpoint_url: str = None, compacted_prefix: str = "compacted/"):
+    """
+    Every key under ``prefix`` in ``bucket``, plus every key ``compact_reviews.py`` has rolled up into the files under
+    ``compacted_prefix`` (it lists them in a ``sources.txt.gz``), since those might have been deleted since.
+    """
+    import boto3
+
+    s3 = boto3.client("s3", endpoint_url=endpoint_url)
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            yield item["Key"]
+    if not compacted_prefix:
+        return
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=compacted_prefix):
+        for item in page.get("Contents", []):
+            if item["Key"].endswith("/sources.txt.gz"):
+                body = s3.get_object(Bucket=bucket, Key=item["Key"])["Body"].read()
+                yield from filter(None, gzip.decompress(body).decode("utf-8").split("\n"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Work out which companies still need crawling")
+    parser.add_argument("--companies", default=os.path.join("scrape", "companies.txt"))
+    parser.add_argument("--output", default=os.path.join("scrape", "missing_companies.txt"))
+    parser.add_argument("--state", default=DEFAULT_PATH)
+    parser.add_argument("--import-dir", help="mark the csvs in this folder as done")
+    parser.add_argument("--sync-s3", metavar="BUCKET", help="mark what the lambda saved to this bucket as done")
+    parser.add_argument("--endpoint-url", help="a local S3 to sync from instead")
+    parser.add_argument(
+        "--compacted-prefix", default="compacted/", help="where compact_reviews.py put what it rolled up, for --sync-s3"
+    )
+    args = parser.parse_args()
+
+    state = CrawlState(args.state)
 
-from glob import glob
+    with open(args.companies) as f:
+        state.add_companies(f.read().split("\n"))
 
-# fetch all csvs in the reviews folder
-reviews_dir = os.path.join(".", "reviews", "*.csv")
-reviews = glob(reviews_dir)
-# I replaced / w/ __ in the lambda, so we've got to undo that here
-reviews = [
-    review.replace("__", "/").replace(".\\reviews\\", "/review/").replace(".csv", "")
-    for review in reviews
-]
+    if args.import_dir:
+        file_names = [
+            name for name in os.listdir(args.import_dir) if re.search(r"\.csv(\.gz)?$", name)
+        ]
+        print(f"Imported {mark_saved(state, file_names)} files from {args.import_dir}")
 
-companies_path = os.path.join(".", "scrape", "companies.txt")
-with open(companies_path) as f:
-    companies = f.read().split("\n")
+    if args.sync_s3:
+        keys = s3_keys(args.sync_s3, endpoint_url=args.endpoint_url, compacted_prefix=args.compacted_prefix)
+        print(f"Synced {mark_saved(state, keys)} objects from S3")
 
-missing = set(companies) - set(reviews)
+    # anything whose pages were all saved before we knew how many it had (e.g. ``schedule.py plan --probe`` since)
+    print(f"Finished {state.finish_completed_companies()} companies with all their pages saved")
 
-print(len(missing))
+    missing = state.remaining_companies()
+    print(len(missing))
+    print(state.counts())
 
-with open('missing_companies.txt','w') as f:
-    f.write('\n'.join(f))
+    with open(args.output, "w") as f:
+        f.write("\n".join(missing))
 
 
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,26 @@
 So I've got a bunch of pages of downloaded information, now I need to join them
 together to make a set of complete files.
 
-They're all named <url>?page=<page>.csv, so we gan do some glob magic to get
-everything together.
+They're all named <url>?page=<page>.csv (or <url>?pages=<first>-<last>.csv for the
+page ranges the lambda fans big companies out into, and .csv.gz once the lambda
+started gzipping what it uploads), so we can work out which company and pages each
+one holds from its name.
+
+Each company's pages get streamed, in page order, straight into one output file, so
+we never hold more than a page's worth of rows. Reviews shift down a page as new ones
+come in while we're crawling, so the first few reviews on a page can be the same as
+the last few on the page before it. Those get dropped.
+
+Companies are spread over a process pool, so this uses every core.
 """
 from csv import DictReader, DictWriter
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import gzip
 import os
-from glob import glob
-from urllib.parse import unquote, quote
+import re
+import sys
 
 HEADERS = [
     "company_url",
@@ -21,44 +34,127 @@ HEADERS = [
     "review_body",
 ]
 
+REVIEWS_DIR = os.path.join("bits", "reviews")
+JOINED_DIR = os.path.join("bits", "joined")
+
+# How many reviews at the end of one page we check the start of the next against
+REVIEWS_PER_PAGE = 20
+
+# <company>?page=3.csv, <company>%3Fpage%3D3.csv, <company>%3Fpages=1-25.csv.gz, ...
+PAGE_PATTERN = re.compile(r"(?:\?|%3F)pages?(?:=|%3D)(\d+)(?:-\d+)?\.csv(?:\.gz)?$")
+
+
+def split_file_name(file_name: str):
+    """ ``(company, first page)`` for a paged file, or ``None`` if it isn't one """
+    match = PAGE_PATTERN.search(file_name)
+    if not match:
+        return None
+    return file_name[: match.start()], int(match.group(1))
+
+
+def get_company_files(reviews_dir: str = REVIEWS_DIR) -> dict:
+    """
+    fetches each filename for paged files, grouped by company and sorted by page.
+
+    This lists the folder once, rather than globbing it once per company.
+    """
+    companies = defaultdict(list)
+    for entry in os.scandir(reviews_dir):
+        parts = split_file_name(entry.name)
+        if parts:
+            company, page = parts
+            companies[company].append((page, entry.path))
+    return {
+        company: [path for _, path in sorted(pages)] for company, pages in companies.items()
+    }
+
 
-def get_company_files(company):
-    """ fetches each filename for paged files """
-    pattern = os.path.join("bits", "reviews", company + "*.csv")
-    return {_ for _ in glob(pattern)}
+def open_page_file(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
 
 
-def save_company(company):
-    """ Create a file for the joined company file and populate it """
-    new_file = os.path.join("bits", "joined", f"{company.replace('/','%2F')}.csv")
+def row_key(row: dict) -> tuple:
+    return (row["review_title"], row["review_body"], row["review_rating"])
 
-    with open(new_file, "w", encoding="utf-8", newline="") as f:
-        writer = DictWriter(f, fieldnames=HEADERS)
+
+def save_company(company: str, page_files: list, joined_dir: str = JOINED_DIR):
+    """ Create a file for the joined company file and populate it. Returns ``(rows written, duplicates dropped)`` """
+    new_file = os.path.join(joined_dir, f"{company.replace('/','%2F')}.csv")
+    written = dropped = 0
+
+    # the keys for the last page's worth of rows we wrote
+    tail = deque(maxlen=REVIEWS_PER_PAGE)
+
+    with open(new_file, "w", encoding="utf-8", newline="") as out:
+        writer = DictWriter(out, fieldnames=HEADERS)
         writer.writeheader()
 
-    for page_file in get_company_files(company):
-        with open(page_file, encoding="utf-8") as f:
-            reader = DictReader(f, fieldnames=HEADERS)
-            next(reader)  # discard header row
-            rows = []
-            try:
-                for row in reader:
-                    rows.append(row)
-            except Exception as e:
-                print(repr(e))
-        with open(new_file, "a", encoding="utf-8", newline="") as f:
-            writer = DictWriter(f, fieldnames=HEADERS)
-            writer.writerows(rows)
+        for page_file in page_files:
+            previous_tail = set(tail)
+            # only the rows at the very start of a file can be left over from the one before, so once one isn't, we
+            # keep everything after it (two people can leave the same short review, and those aren't duplicates)
+            leading = True
+            with open_page_file(page_file) as f:
+                reader = DictReader(f, fieldnames=HEADERS)
+                next(reader, None)  # discard header row
+                try:
+                    for row in reader:
+                        key = row_key(row)
+                        if leading and key in previous_tail:
+                            dropped += 1
+                            continue
+                        leading = False
+                        writer.writerow(row)
+                        tail.append(key)
+                        written += 1
+                except Exception as e:
+                    print(f"{page_file}: {e!r}")
+
+    return written, dropped
+
+
+def save_company_job(job):
+    """ ``save_company`` for the process pool, which can only hand over one argument """
+    return save_company(*job)
 
 
 def main():
     """ Save all the things """
-    company_file = os.path.join("scrape", "missing_companies.txt")
-    with open(company_file, encoding="utf-8") as f:
-        companies = [_.replace("/review/", "").replace("\n", "") for _ in f.readlines()]
+    parser = argparse.ArgumentParser(description="Join paged review files into one file per company")
+    parser.add_argument("--reviews-dir", default=REVIEWS_DIR)
+    parser.add_argument("--joined-dir", default=JOINED_DIR)
+    parser.add_argument(
+        "--all", action="store_true", help="join every company in the reviews folder, not just the missing ones"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    company_files = get_company_files(args.reviews_dir)
+
+    if args.all:
+        companies = sorted(company_files)
+    else:
+        company_file = os.path.join("scrape", "missing_companies.txt")
+        with open(company_file, encoding="utf-8") as f:
+            companies = [_.replace("/review/", "").replace("\n", "") for _ in f.readlines()]
+        companies = [company for company in companies if company in company_files]
+
+    os.makedirs(args.joined_dir, exist_ok=True)
+    jobs = [(company, company_files[company], args.joined_dir) for company in companies]
+
+    written = dropped = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for i, (company_written, company_dropped) in enumerate(
+            pool.map(save_company_job, jobs, chunksize=8)
+        ):
+            written += company_written
+            dropped += company_dropped
+            if (i + 1) % 500 == 0:
+                print(f"{i + 1} of {len(jobs)} companies joined", file=sys.stderr)
 
-    for company in companies:
-        save_company(company)
+    print(f"Joined {len(jobs)} companies: {written} reviews, {dropped} duplicates dropped at page boundaries")
 
 
 if __name__ == "__main__":
@@ -3,22 +3,25 @@ So, figuring out which companies were inactive was easiest to do by running the
 a logging statement, which is how I generated ``inactive_companies.txt``. Not super
 replicable, but sacrifices must be made.
 
-This removes inactive companies from missing companies. Yes this would be faster
-with set comprehensions, but meh, still runs fast enough.
+This removes inactive companies from missing companies. The crawler marks inactive companies
+in the crawl state itself now, so this only matters for the ones in ``inactive_companies.txt``
+from before that. Once they're marked, missing companies is just the remaining ones.
 """
 
 import os
+import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scrape'))
+
+from crawl_state import CrawlState  # noqa: E402
+
+
+state = CrawlState()
 
 inactive_path = os.path.join('scrape/inactive_companies.txt')
 with open(inactive_path) as f:
-    inactive = f.read().split('\n')
+    state.mark_inactive(f.read().split('\n'))
 
 missing_path = os.path.join('scrape/missing_companies.txt')
-with open(missing_path) as f:
-    missing = f.read().split('\n')
-
-actually_missing = set(missing) - set(inactive)
-
 with open(missing_path, 'w') as f:
-    f.write('\n'.join(actually_missing))
+    f.write('\n'.join(state.remaining_companies()))